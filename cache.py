@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class TTLCache():
+    '''A thread-safe LRU mapping whose entries expire after ttl seconds.
+
+    A ttl of 0 disables the cache.'''
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        if not self.ttl:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if not self.ttl:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_tree(self, key):
+        '''Discard key and every path below it'''
+        prefix = key.rstrip('/') + '/'
+        with self._lock:
+            for child in [child for child in self._entries if child == key or child.startswith(prefix)]:
+                del self._entries[child]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
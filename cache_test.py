@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import time
+from cache import TTLCache
+
+
+class TestTTLCache(object):
+
+    def test_put_then_get(self):
+        cache = TTLCache(60, 10)
+        cache.put("/a", 1)
+        assert cache.get("/a") == 1
+        assert cache.get("/b") is None
+
+    def test_entries_expire(self, monkeypatch):
+        now = [100.0]
+        monkeypatch.setattr(time, "monotonic", lambda: now[0])
+        cache = TTLCache(1, 10)
+        cache.put("/a", 1)
+        now[0] += 2
+        assert cache.get("/a") is None
+        assert len(cache) == 0
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(60, 2)
+        cache.put("/a", 1)
+        cache.put("/b", 2)
+        cache.get("/a")
+        cache.put("/c", 3)
+        assert cache.get("/a") == 1
+        assert cache.get("/b") is None
+
+    def test_discard_tree(self):
+        cache = TTLCache(60, 10)
+        for key in ("/dir", "/dir/a", "/dir/a/b", "/dirt"):
+            cache.put(key, 1)
+        cache.discard_tree("/dir")
+        assert cache.get("/dirt") == 1
+        assert len(cache) == 1
+
+    def test_zero_ttl_disables(self):
+        cache = TTLCache(0, 10)
+        cache.put("/a", 1)
+        assert cache.get("/a") is None
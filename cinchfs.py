@@ -1,15 +1,61 @@
 #!/usr/bin/env python3
 
 import os
-import sys
+import json
+import time
+import shlex
 import errno
+import signal
+import stat
+import tempfile
 import fusefs as fs
+import logging
 import argparse
+import itertools
+import threading
 
+from cache import TTLCache
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from durability import make_durability
+from freespace import FreeSpaceCache
+from handles import FileHandle, HandleTable
+from health import SourceHealth
+from landing import LandingTier
+from migration import EntryGate, Migrations
+from placement import SourceView, WriteLoad, make_placement
+from profiler import Profiler
+from state import IndexState
+from stats import OpStats, TouchCounters
+from tiering import FastTier
+from tracing import TraceWriter
 from utilities import first
+from virtual import VirtualFiles
+from writeback import WriteBuffers
 from fuse import FUSE, FuseOSError
 
 
+log = logging.getLogger(__name__)
+
+# root entries of a source with this prefix belong to cinchfs and its tools, like the balancer's staging directory
+PRIVATE_PREFIX = '.cinchfs'
+# entries being migrated are copied to here on their new source first
+MIGRATION_DIR = PRIVATE_PREFIX + '-moving'
+# files copied at the same time by a rename between sources
+COPY_THREADS = 8
+# ops whose latency tells how well a source answers, the others wait for data or for other sources
+LATENCY_OPS = frozenset(('getattr', 'access', 'readlink', 'readdir', 'open'))
+# where the fuse_file_info sits in the args of ops on open files, when FUSE hands it over with raw_fi
+RAW_FI_ARGS = {'read': 3, 'write': 3, 'truncate': 2, 'flush': 1, 'release': 1, 'fsync': 2, 'getattr': 1}
+# passed on to FUSE unless overridden, fewer and larger requests mean fewer round trips through python
+KERNEL_OPTIONS = {
+    'big_writes': True,
+    'max_read': 128 * 1024,
+    'max_write': 128 * 1024,
+    'max_readahead': 128 * 1024,
+}
+
+
 class DuplicatePathException(Exception):
     pass
 
@@ -17,74 +63,413 @@ class DuplicatePathException(Exception):
 class Filesystem():
 
     def __call__(self, op, *args):
+        if self._profiler.capturing and not self._profiler.profiled():
+            # comes back here with the profiler running
+            return self._profiler.run(self, op, *args)
         if not hasattr(self, op):
             raise FuseOSError(errno.EFAULT)
-        return getattr(self, op)(*args)
+        if op in RAW_FI_ARGS and len(args) > RAW_FI_ARGS[op] and hasattr(args[RAW_FI_ARGS[op]], 'keep_cache'):
+            position = RAW_FI_ARGS[op]
+            args = args[:position] + (args[position].fh,) + args[position + 1:]
+        elif op in ('open', 'create') and hasattr(args[-1], 'keep_cache'):
+            return self._open_raw(op, *args)
+        if args and (self._virtual.owns(args[0]) or op in ('rename', 'link') and self._virtual.owns(args[1])):
+            return self._virtual(op, *args)
 
-    def __init__(self, sources, mountpoint):
+        entries = self._entries(op, args)
+        # an op switching an entry itself has to know it is inside the gate
+        passed, self._local.passed = getattr(self._local, 'passed', ()), entries
+        try:
+            with self._gate.passing(entries):
+                return self._dispatch(op, args)
+        finally:
+            self._local.passed = passed
+
+    def _open_raw(self, op, path, *args):
+        # with raw_fi open and create fill in the fuse_file_info themselves,
+        # which is the only way to tell the kernel what it may keep cached
+        fi = args[-1]
+        if op == 'open':
+            fi.fh = self(op, path, fi.flags)
+        else:
+            fi.fh = self(op, path, *args[:-1])
+        if self._virtual.owns(path):
+            # rendered on open, so the size the kernel got from getattr may already be off
+            fi.direct_io = 1
+        else:
+            handle = self._handles.get(fi.fh)
+            fi.keep_cache = int(handle is not None and handle.keep_cache)
+        return 0
+
+    def _dispatch(self, op, args):
+        # remembered so source touches and stats can be attributed to the op
+        self._local.op = op
+        self._local.source = None
+        start = time.perf_counter_ns()
+        result = None
+        nbytes = 0
+        error = 0
+        try:
+            result = getattr(self, op)(*args)
+            if op == 'read':
+                nbytes = len(result)
+            elif op == 'write':
+                nbytes = result
+            return result
+        except OSError as e:
+            error = e.errno or errno.EIO
+            raise
+        finally:
+            latency = time.perf_counter_ns() - start
+            self._stats.record(op, self._local.source, latency, nbytes, error)
+            if self._local.source is not None:
+                self._health.record(self._local.source, latency if op in LATENCY_OPS else None, error)
+            if self._trace is not None:
+                self._trace.record(op, args, result, start, latency, error)
+
+    def __init__(self, sources, mountpoint, rescan_interval=None, vectored_io=False,
+                 durability='strict', sync_interval=1.0, statfs_ttl=5.0, statfs_timeout=2.0,
+                 attr_ttl=1.0, negative_ttl=1.0, cache_size=65536, state_dir=None, spindown=False,
+                 placement='most-free', trace=None, fast_tier=None, fast_tier_size=10 * 1024 ** 3,
+                 promote_after=4, landing=None, landing_idle=30.0, landing_bandwidth=None, keep_cache=True,
+                 write_buffer=0, probe_timeout=2.0, degrade_latency=1.0, degrade_errors=3,
+                 profile_dir=None, profile_mode='sample', profile_duration=30.0, stats_dir=None,
+                 rename_copy_limit=None):
         self.sources = sources
         self.mountpoint = mountpoint
+        self.rescan_interval = rescan_interval
+        # only requests above the kernel's default max_read and max_write are split up
+        self.vectored_io = vectored_io and hasattr(os, 'preadv')
+        self.spindown = spindown
+        self.keep_cache = keep_cache
+        self.rename_copy_limit = rename_copy_limit
+        self._local = threading.local()
+        self._touches = TouchCounters()
+        # the source that last saw I/O, the root is looked up there so a sleeping disk stays asleep
+        self._awake = sources[0]
+        self._stats = OpStats()
+        self._trace = TraceWriter(trace) if trace else None
+        # stats dumps are written here, stderr is gone once FUSE runs in the background
+        self.stats_dir = stats_dir or tempfile.gettempdir()
+        self._profiler = Profiler(profile_dir or tempfile.gettempdir())
+        self.profile_mode = profile_mode
+        self.profile_duration = profile_duration
+        self._tier = FastTier(fast_tier, fast_tier_size, promote_after) if fast_tier else None
+        self._landing = None
+        self._writeback = WriteBuffers(write_buffer, self._write) if write_buffer else None
+        self._virtual = VirtualFiles()
+        self._virtual.register('stats', lambda: json.dumps(self.stats(), indent=2).encode())
+        self._virtual.register('migrations', lambda: json.dumps(self._migrations.status(), indent=2).encode())
+        self._virtual.register_control('control', self._control)
+        self._gate = EntryGate()
+        self._migrations = Migrations(self.migrate)
+        self._durability = make_durability(durability, sync_interval)
+        # when idle disks must stay asleep, free space is only re-sampled on disks we write to
+        self._free_space = FreeSpaceCache(sources, statfs_ttl, statfs_timeout, self._sample_free_space, passive=spindown)
+        self._write_load = WriteLoad()
+        self._health = SourceHealth(sources, probe_timeout, degrade_latency, degrade_errors)
+        self._placement = make_placement(placement)
+        self._source_view = SourceView(lambda source: self._get_free_blocks(source), self._free_space.get, self._write_load)
+        self._attrs = TTLCache(attr_ttl, cache_size)
+        self._missing = TTLCache(negative_ttl, cache_size)
+        # (mtime, size) of files when they were last opened, they never expire, only fall out of the LRU
+        self._opened = TTLCache(float('inf'), cache_size)
+        self._index = {}
+        self._root_mtimes = {}
+        self._state = IndexState(state_dir) if state_dir else None
+        self._handles = HandleTable()
+        self._pending = set()
+        # paths changed through the mount while their entry migrates, by entry, a trailing / stands for a tree
+        self._migrating = {}
+        self._placement_lock = threading.Lock()
+        # index changes made while a rescan lists the sources, None when no rescan runs
+        self._index_changes = None
+        self._rescan_lock = threading.Lock()
+        self._rescan_stop = threading.Event()
+        self._renames = itertools.count()
+        self._copier = ThreadPoolExecutor(max_workers=COPY_THREADS, thread_name_prefix='cinchfs-copy')
         self._check_for_duplicates()
+        if landing:
+            self._landing = LandingTier(landing, self._destage, landing_idle, landing_bandwidth)
+            for path in self._landing.paths():
+                source = self._owner(path.strip('/').split('/')[0])
+                if source is not None and os.path.lexists(os.path.join(source, path.lstrip('/'))):
+                    # destaged, but the landed copy was never removed
+                    self._landing.forget(path)
+
+    def init(self, path):
+        if self.rescan_interval:
+            threading.Thread(target=self._rescan_loop, name='cinchfs-rescan', daemon=True).start()
+        if self._tier is not None:
+            self._tier.start()
+        if self._landing is not None:
+            self._landing.start()
+        # main() blocks these before FUSE forks into the background, threads started before that are gone
+        blocked = signal.pthread_sigmask(signal.SIG_BLOCK, [])
+        for signum, handler in ((signal.SIGUSR1, self.dump_stats), (signal.SIGUSR2, self.toggle_profile)):
+            if signum in blocked:
+                watch_signal(signum, handler)
+
+    def destroy(self, path):
+        self._rescan_stop.set()
+        self._migrations.close()
+        if self._tier is not None:
+            self._tier.close()
+        if self._landing is not None:
+            self._landing.close()
+        self._save_index()
+        self._durability.close()
+        self._copier.shutdown()
+        self._health.close()
+        self._profiler.stop()
+        if self._trace is not None:
+            self._trace.close()
+        fs.fallback_fds.clear()
 
     def access(self, path, mode):
         return fs.access(self._full_path(path), mode)
 
     def chmod(self, path, mode):
-        return fs.chmod(self._full_path(path), mode)
+        result = fs.chmod(self._full_path(path), mode)
+        self._invalidate(path)
+        return result
 
     def chown(self, path, uid, gid):
-        return fs.chown(self._full_path(path), uid, gid)
+        result = fs.chown(self._full_path(path), uid, gid)
+        self._invalidate(path)
+        return result
 
     def getattr(self, path, fh=None):
-        return fs.getfileattr(self._full_path(path), fh)
+        handle = self._handles.get(fh)
+        if handle is not None:
+            self._flush_buffered(handle.path)
+            self._touch(handle.source)
+            return fs.getfileattr(handle.real_path, handle.fd)
+
+        attrs = self._attrs.get(path)
+        if attrs is not None:
+            return attrs
+        if self._missing.get(path):
+            raise FuseOSError(errno.ENOENT)
+
+        self._flush_buffered(path)
+        try:
+            full_path = self._lookup(path)
+            if full_path is None:
+                raise FuseOSError(errno.ENOENT)
+            attrs = fs.getfileattr(full_path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                self._missing.put(path, True)
+            raise
+        self._attrs.put(path, attrs)
+        return attrs
 
     def mknod(self, path, mode, dev):
-        return fs.mknod(self._full_path(path), mode, dev)
+        if self._landing is not None and stat.S_ISREG(mode):
+            return self._land(path, lambda real_path: fs.mknod(real_path, mode, dev))
+        with self._creating(path) as (_, full_path):
+            return fs.mknod(full_path, mode, dev)
 
     def rmdir(self, path):
-        return fs.rmdir(self._full_path(path))
+        if self._landing is not None and self._landing.children(path):
+            raise FuseOSError(errno.ENOTEMPTY)
+        result = fs.rmdir(self._full_path(path))
+        self._index_discard(path)
+        self._invalidate(path)
+        return result
 
     def mkdir(self, path, mode):
-        return fs.mkdir(self._full_path(path), mode)
+        with self._creating(path) as (_, full_path):
+            return fs.mkdir(full_path, mode)
 
     def unlink(self, path):
-        return fs.unlink(self._full_path(path))
+        self._drop_cached(path)
+        if self._landing is not None and self._landing.get(path):
+            self._landing.forget(path)
+            self._detach(path)
+            self._invalidate(path)
+            return
+        result = fs.unlink(self._full_path(path))
+        self._detach(path)
+        self._index_discard(path)
+        self._invalidate(path)
+        return result
 
     def symlink(self, source, target):
-        return fs.symlink(self._full_path(source), self._full_path(target))
+        with self._creating(source) as (_, full_source):
+            return fs.symlink(full_source, self._full_path(target))
 
     def rename(self, old, new):
-        return fs.rename(self._full_path(old), self._full_path(new))
+        self._flush_buffered(old, tree=True)
+        self._drop_cached(old, tree=True)
+        self._drop_cached(new, tree=True)
+        if self._landing is not None:
+            if self._landing.get(old):
+                return self._rename_landed(old, new)
+            # replaced by old
+            self._landing.forget(new)
+        source, full_old = self._locate(old)
+        replaced = self._open_below(new, tree=True) if old != new else []
+        # a new top-level entry stays on the source it is renamed from
+        with self._creating(new, prefer=source) as (new_source, full_new):
+            if new_source == source:
+                result = fs.rename(full_old, full_new)
+                self._move_handles(old, new, full_old, full_new)
+            else:
+                result = self._rename_across(old, source, full_old, new, new_source, full_new)
+        for handle in replaced:
+            handle.detached = True
+        if self._landing is not None:
+            self._landing.rename(old, new)
+        self._index_discard(old)
+        self._invalidate(old, tree=True)
+        self._invalidate(new, tree=True)
+        return result
 
-    def link(self, source, target):
-        return fs.link(self._full_path(source), self._full_path(target))
+    def link(self, target, source):
+        # like symlink, FUSE passes the new name first
+        if self._landing is not None and self._landing.get(source) is not None:
+            # destaging copies the file, a link to the landed one would be split from it
+            raise FuseOSError(errno.EXDEV)
+        with self._creating(target) as (_, full_target):
+            result = fs.link(self._full_path(source), full_target)
+        # the link count of the existing file changed too
+        self._invalidate(source)
+        return result
 
     def utimens(self, path, times=None):
-        return fs.utimens(self._full_path(path), times)
+        result = fs.utimens(self._full_path(path), times)
+        self._invalidate(path)
+        return result
 
     def open(self, path, flags):
-        return fs.openFile(self._full_path(path), flags)
+        source, full_path = self._locate(path)
+        if flags & os.O_TRUNC:
+            self._changed(path)
+        if self._tier is not None:
+            if flags & os.O_ACCMODE == os.O_RDONLY:
+                # while the file may be written, only the original is current
+                copy = self._tier.lookup(path, full_path) if not self._open_for_writing(path) else None
+                if copy is not None:
+                    try:
+                        fd = fs.openFile(copy.path, flags)
+                        return self._add_opened(FileHandle(fd, path, copy.path, copy.dir, flags))
+                    except FileNotFoundError:
+                        pass  # evicted in the meantime
+            else:
+                self._drop_cached(path)
+        fd = fs.openFile(full_path, flags)
+        return self._add_opened(FileHandle(fd, path, full_path, source, flags))
+
+    def _add_opened(self, handle):
+        # the kernel may keep the pages it cached of a file that has not changed since it was last opened,
+        # writes through the mount keep those pages current, anything else changes the mtime or size
+        if self.keep_cache:
+            st = os.fstat(handle.fd)
+            signature = (st.st_mtime_ns, st.st_size)
+            handle.keep_cache = self._opened.get(handle.path) == signature
+            self._opened.put(handle.path, signature)
+        return self._handles.add(handle)
 
     def create(self, path, mode, fi=None):
-        return fs.create(self._full_path(path), mode, fi)
+        self._drop_cached(path)
+        if self._landing is not None and not self._exists(path):
+            return self._land(path, lambda real_path: fs.create(real_path, mode, fi), os.O_WRONLY)
+        with self._creating(path) as (source, full_path):
+            fd = fs.create(full_path, mode, fi)
+        return self._handles.add(FileHandle(fd, path, full_path, source, os.O_WRONLY))
 
     def read(self, path, length, offset, fh):
-        return fs.read(self._full_path(path), length, offset, fh)
+        handle = self._handles.get(fh)
+        if handle is None:
+            # sometimes read receives a bad fh, fall back to reading by path
+            self._flush_buffered(path)
+            return fs.read(self._full_path(path), length, offset, None)
+        self._flush_buffered(handle.path)
+        self._touch(handle.source)
+        result = fs.read(handle.real_path, length, offset, handle.fd, self.vectored_io)
+        if self._tier is not None and not handle.was_read and not handle.detached:
+            handle.was_read = True
+            if not self._open_for_writing(handle.path):
+                self._tier.read(handle.path, handle.real_path)
+        return result
 
     def write(self, path, buf, offset, fh):
-        return fs.write(self._full_path(path), buf, offset, fh)
+        handle = self._handle(fh)
+        self._touch(handle.source)
+        if not handle.written:
+            self._drop_cached(handle.path)
+        if self._writeback is not None:
+            result = self._writeback.write(handle, buf, offset)
+        else:
+            result = self._write(handle, buf, offset)
+        handle.written = True
+        self._attrs.discard(handle.path)
+        self._changed(handle.path)
+        self._free_space.consume(handle.source, result)
+        self._write_load.record(handle.source, result)
+        return result
+
+    def _write(self, handle, buf, offset):
+        result = fs.write(handle.real_path, buf, offset, handle.fd, self.vectored_io)
+        self._durability.written(handle)
+        return result
+
+    def _flush_buffered(self, path, tree=False):
+        # everything that looks at the file sees what was written to it so far
+        if self._writeback is None:
+            return
+        if tree:
+            self._writeback.flush_tree(path)
+        else:
+            self._writeback.flush_path(path)
 
     def truncate(self, path, length, fh=None):
-        return fs.truncate(self._full_path(path), length, fh)
+        handle = self._handles.get(fh)
+        self._flush_buffered(path if handle is None else handle.path)
+        if handle is not None:
+            self._touch(handle.source)
+            if not handle.written:
+                self._drop_cached(handle.path)
+            result = fs.truncate(handle.real_path, length, handle.fd)
+            handle.written = True
+            self._durability.written(handle)
+            path = handle.path
+        else:
+            self._drop_cached(path)
+            result = fs.truncate(self._full_path(path), length)
+        self._attrs.discard(path)
+        self._changed(path)
+        return result
 
     def flush(self, path, fh):
-        return fs.flush(self._full_path(path), fh)
+        handle = self._handle(fh)
+        self._touch(handle.source)
+        if self._writeback is not None:
+            self._writeback.flush(handle)
+        return self._durability.flush(handle)
 
     def release(self, path, fh):
-        return fs.release(self._full_path(path), fh)
+        handle = self._handles.pop(fh)
+        if handle is None:
+            raise FuseOSError(errno.EBADF)
+        try:
+            if self._writeback is not None:
+                self._writeback.release(handle)
+        finally:
+            result = self._durability.release(handle)
+        if handle.written and self.spindown:
+            # the disk is awake anyway, correct the optimistic free space estimate
+            self._free_space.refresh_source(handle.source)
+        return result
 
     def fsync(self, path, fdatasync, fh):
-        return fs.fsync(self._full_path(path), fdatasync, fh)
+        handle = self._handle(fh)
+        self._touch(handle.source)
+        if self._writeback is not None:
+            self._writeback.flush(handle)
+        return self._durability.fsync(handle, fdatasync)
 
     def statfs(self, path):
         if path == '/':
@@ -94,9 +479,13 @@ class Filesystem():
 
     def readdir(self, path, fh):
         if path == '/':
-            return self._root_readdir(fh)
+            dirents = self._root_readdir(fh)
         else:
-            return fs.readdir(self._full_path(path), fh)
+            dirents = self._cache_listed_attrs(path, fs.readdir(self._full_path(path), fh))
+        if self._landing is not None:
+            dirents = itertools.chain(dirents, self._landing.children(path))
+        # listed inside the op, FUSE would only iterate after the gate, timing and health are done with it
+        return list(dirents)
 
     def readlink(self, path):
         pathname = fs.readlink(self._full_path(path))
@@ -106,61 +495,621 @@ class Filesystem():
         else:
             return pathname
 
+    def _handle(self, fh):
+        handle = self._handles.get(fh)
+        if handle is None:
+            raise FuseOSError(errno.EBADF)
+        return handle
+
     def _check_for_duplicates(self):
         # it is enough to check that there are no duplicates in the root directory of all sources
-        seen = set()
-        for source in self.sources:
-            entities = set(os.listdir(source))
-            duplicates = entities.intersection(seen)
-            if len(duplicates) > 0:
-                raise DuplicatePathException() 
-            seen.update(entities)
+        # the same listing seeds the top-level index used by _full_path
+        stored = self._state.load() if self._state else {}
+        index, duplicates = self._scan_sources(stored)
+        if len(duplicates) > 0:
+            raise DuplicatePathException()
+        self._index = index
+        self._save_index()
+
+    def _scan_sources(self, stored=None):
+        # sources are listed in parallel, but merged in order
+        stored = stored or {}
+        with ThreadPoolExecutor(max_workers=len(self.sources)) as executor:
+            listings = list(executor.map(lambda source: self._list_source(source, stored.get(source)), self.sources))
+
+        index = {}
+        duplicates = set()
+        for source, (mtime, entities) in zip(self.sources, listings):
+            self._root_mtimes[source] = mtime
+            for entity in entities:
+                if entity in index:
+                    duplicates.add(entity)
+                else:
+                    index[entity] = source
+        return index, duplicates
 
-    def _find_source_with_most_free_blocks(self):
-        return max(self.sources, key=self._get_free_blocks)
+    def _list_source(self, source, stored):
+        if not self._health.healthy(source):
+            # a rescan keeps what the index knows of a degraded source rather than waiting for it
+            return self._root_mtimes.get(source), self._indexed(source)
+        # the mtime is taken first, so a change during the listing makes it stale
+        mtime = os.stat(source).st_mtime_ns
+        if stored is not None and stored[0] == mtime:
+            return stored
+        self._touch(source, 'listdir')
+        return mtime, [name for name in os.listdir(source) if not name.startswith(PRIVATE_PREFIX)]
+
+    def _save_index(self):
+        if self._state is None:
+            return
+        listings = dict((source, (mtime, [])) for source, mtime in self._root_mtimes.items())
+        for entity, source in list(self._index.items()):
+            if entity not in self._pending:
+                listings[source][1].append(entity)
+        try:
+            self._state.save(listings)
+        except OSError:
+            log.warning("Could not save the index state", exc_info=True)
+
+    def rescan(self):
+        # pick up changes made directly on the source disks
+        # on a duplicate the first source wins, as it would when probing in order
+        with self._rescan_lock:
+            with self._placement_lock:
+                self._index_changes = []
+            try:
+                index, _ = self._scan_sources()
+                with self._placement_lock:
+                    # what changed through the mount while the sources were listed is newer than the listing
+                    for base_dir, source in self._index_changes:
+                        if source is None:
+                            index.pop(base_dir, None)
+                        else:
+                            index[base_dir] = source
+                    # keep placements reserved by creates that have not reached the disk yet
+                    for base_dir in self._pending:
+                        index.setdefault(base_dir, self._index[base_dir])
+                    self._index = index
+            finally:
+                with self._placement_lock:
+                    self._index_changes = None
+
+    def _rescan_loop(self):
+        while not self._rescan_stop.wait(self.rescan_interval):
+            self.rescan()
+
+    def _choose_source(self):
+        return self._placement.choose(self._health.usable(self.sources), self._source_view)
+
+    def _sample_free_space(self, source):
+        self._touch(source, 'statfs')
+        return fs.statfs(source)
 
     def _get_free_blocks(self, source):
-        return fs.statfs(source)['f_bfree']
+        stv = self._free_space.get(source)
+        # a source that never answered is not a candidate for new data
+        return stv['f_bfree'] if stv is not None else -1
 
     def _full_path(self, partial):
+        return self._locate(partial)[1]
+
+    def _locate(self, partial, create=False, prefer=None):
+        if self._landing is not None and not create:
+            landed = self._landing.get(partial)
+            if landed is not None:
+                return self._landing.dir, landed
+
         # all provided paths are full with the mountpoint as the root
         if partial.startswith('/'):
             partial = partial[1:]
 
-        # re-use an existing file or dir
-        for source in self.sources:
-            path = os.path.join(source, partial)
-            if os.path.exists(path):
-                return path
-
-        # if a base dir exists, then use that source
-        path_parts = partial.split(os.path.sep)
-        if len(path_parts) > 1:
-            # path is more than just a filename
-            base_dir = path_parts[0]
-            for source in self.sources:
-                base_path = os.path.join(source, base_dir)
-                if os.path.exists(base_path):
-                    return os.path.join(source, partial)
-
-        # use disk with most free space
-        source = self._find_source_with_most_free_blocks()
+        base_dir = partial.split(os.path.sep)[0]
+        if not base_dir:
+            # the root exists on every source
+            source = self._root_source()
+            self._touch(source)
+            return source, os.path.join(source, partial)
+
+        # re-use the source of an existing top-level file or dir
+        source = self._owner(base_dir)
+        if source is None and create:
+            # let the placement policy pick a disk
+            source = self._reserve(base_dir, prefer)
+        if source is None:
+            # it exists nowhere, the op fails the same on any source and must not draw a placement
+            source = self._root_source()
+        self._touch(source)
+        return source, os.path.join(source, partial)
+
+    def _reserve(self, base_dir, prefer=None):
+        # racing creates of the same new entry must agree on its source,
+        # so the placement is recorded before the entry exists on disk
+        with self._placement_lock:
+            source = self._index.get(base_dir)
+            if source is None:
+                source = prefer or self._choose_source()
+                self._set_index(base_dir, source)
+                self._pending.add(base_dir)
+            return source
+
+    @contextmanager
+    def _creating(self, path, prefer=None):
+        landed = self._landing.get(path) if self._landing is not None else None
+        if landed is not None:
+            # it exists as a landed file, the op reuses it or fails like it would on a source
+            yield self._landing.dir, landed
+            self._invalidate(path)
+            return
+        source, full_path = self._locate(path, create=True, prefer=prefer)
+        try:
+            yield source, full_path
+        except BaseException:
+            self._unreserve(path)
+            raise
+        self._index_add(path, source)
+        self._invalidate(path)
+
+    def _unreserve(self, path):
+        base_dir = path.strip('/').split('/')[0]
+        with self._placement_lock:
+            if base_dir in self._pending:
+                self._pending.discard(base_dir)
+                self._set_index(base_dir, None)
+
+    def _lookup(self, partial):
+        # like _full_path, but None instead of a placement when the path can't exist
+        if self._landing is not None and self._landing.get(partial) is not None:
+            return self._landing.get(partial)
+        if partial.startswith('/'):
+            partial = partial[1:]
+        base_dir = partial.split(os.path.sep)[0]
+        source = self._owner(base_dir) if base_dir else self._root_source()
+        if source is None:
+            return None
+        self._touch(source)
         return os.path.join(source, partial)
 
+    def _exists(self, path):
+        full_path = self._lookup(path)
+        return full_path is not None and os.path.lexists(full_path)
+
+    def _land(self, path, make, flags=None):
+        # new files are written to the landing source first and destaged once idle
+        parent = os.path.dirname(path)
+        if parent != '/' and not os.path.isdir(self._full_path(parent)):
+            raise FuseOSError(errno.ENOENT)
+        real_path = self._landing.land(path)
+        try:
+            result = make(real_path)
+        except BaseException:
+            self._landing.forget(path)
+            raise
+        self._invalidate(path)
+        if flags is None:
+            return result
+        return self._handles.add(FileHandle(result, path, real_path, self._landing.dir, flags))
+
+    def _rename_landed(self, old, new):
+        # a landed file only changes its path, it stays on the landing source
+        parent = os.path.dirname(new)
+        if parent != '/' and not os.path.isdir(self._full_path(parent)):
+            raise FuseOSError(errno.ENOENT)
+        if self._landing.get(new) is not None:
+            self._landing.forget(new)
+        elif self._exists(new):
+            target = self._full_path(new)
+            if os.path.isdir(target) and not os.path.islink(target):
+                raise FuseOSError(errno.EISDIR)
+            fs.unlink(target)
+            self._index_discard(new)
+        if old != new:
+            self._detach(new)
+        landed = self._landing.get(old)
+        self._landing.rename(old, new)
+        self._move_handles(old, new, landed, landed)
+        self._invalidate(old)
+        self._invalidate(new)
+
+    def _destage(self, path, real_path):
+        # copied at a limited rate while it can still be read, then switched over like a migration
+        if any(handle.real_path == real_path for handle in self._handles):
+            return False
+        before = os.stat(real_path)
+        source, full_path = self._locate(path, create=True)
+        staging = os.path.join(source, MIGRATION_DIR, 'landing-' + os.path.basename(real_path))
+        destaged = False
+        try:
+            os.makedirs(os.path.dirname(staging), exist_ok=True)
+            fs.copy_file(real_path, staging, self._landing.throttle.wait)
+            with self._gate.closed(path.strip('/').split('/')[0]):
+                # renamed, removed, opened or changed while it was copied
+                if self._landing.get(path) != real_path or any(handle.real_path == real_path for handle in self._handles):
+                    return False
+                after = os.stat(real_path)
+                if (after.st_size, after.st_mtime_ns) != (before.st_size, before.st_mtime_ns):
+                    return False
+                os.rename(staging, full_path)
+                # forgetting it removes the landed copy
+                fs.fsync_dir(os.path.dirname(full_path))
+                self._landing.forget(path)
+                self._index_add(path, source)
+                self._invalidate(path)
+                destaged = True
+            return True
+        finally:
+            if not destaged:
+                self._unreserve(path)
+                if os.path.lexists(staging):
+                    os.unlink(staging)
+
+    def _owner(self, base_dir):
+        source = self._index.get(base_dir)
+        if source is None and not self.spindown:
+            source = self._revalidate(base_dir)
+        return source
+
+    def _revalidate(self, base_dir):
+        # the index missed, but the entry may have been created directly on a source
+        for source in self.sources:
+            self._touch(source, 'probe')
+            try:
+                exists = self._health.probe(source, os.path.lexists, os.path.join(source, base_dir))
+            except TimeoutError:
+                # the index still has what a degraded source held when it was last listed
+                continue
+            if exists:
+                with self._placement_lock:
+                    self._set_index(base_dir, source)
+                return source
+        return None
+
+    def _invalidate(self, path, tree=False):
+        # forget cached answers about path and about the directory holding it
+        if tree:
+            self._attrs.discard_tree(path)
+            self._missing.discard_tree(path)
+            self._opened.discard_tree(path)
+        else:
+            self._attrs.discard(path)
+            self._missing.discard(path)
+            self._opened.discard(path)
+        self._attrs.discard(os.path.dirname(path))
+        self._changed(path, tree)
+
+    def _changed(self, path, tree=False):
+        # a migration running for the entry copies the path again in its last pass, whatever its mtime says
+        if not self._migrating:
+            return
+        changed = self._migrating.get(path.strip('/').split('/')[0])
+        if changed is not None:
+            changed.add(path.rstrip('/') + '/' if tree else path)
+
+    def _index_add(self, path, source):
+        parts = path.strip('/').split('/')
+        if parts[0]:
+            with self._placement_lock:
+                self._set_index(parts[0], source)
+                self._pending.discard(parts[0])
+        if len(parts) == 1:
+            self._touch_root(source)
+
+    def _index_discard(self, path):
+        parts = path.strip('/').split('/')
+        if len(parts) == 1:
+            # only removing a top-level entry changes the index
+            with self._placement_lock:
+                source = self._set_index(parts[0], None)
+            if source is not None:
+                self._touch_root(source)
+
+    def _set_index(self, base_dir, source):
+        # called with _placement_lock held, a source of None removes the entry, returns the source it had
+        if self._index_changes is not None:
+            self._index_changes.append((base_dir, source))
+        if source is None:
+            return self._index.pop(base_dir, None)
+        previous, self._index[base_dir] = self._index.get(base_dir), source
+        return previous
+
+    def migrate(self, entry, destination):
+        '''Move a top-level entry to another source while the mount is in use.
+
+        The entry is copied to the destination while it stays in use. Then ops
+        on it are held back for a last pass over the paths changed through
+        the mount meanwhile, the switch of the index and reopening its open
+        files on the new copy.
+        The old copy is removed once ops flow again.'''
+        source = self._owner(entry)
+        old_path = os.path.join(source, entry) if source is not None else None
+        if old_path is None or entry in self._pending or not os.path.lexists(old_path):
+            raise FuseOSError(errno.ENOENT)
+        if destination not in self.sources:
+            raise FuseOSError(errno.EINVAL)
+        if destination == source:
+            return
+
+        staging = os.path.join(destination, MIGRATION_DIR, entry)
+        os.makedirs(os.path.dirname(staging), exist_ok=True)
+        # only what changes from here on is looked at again with ops held back
+        changed = self._migrating[entry] = set()
+        try:
+            fs.sync_tree(old_path, staging, vanishing=True)
+
+            retired = os.path.join(source, MIGRATION_DIR, entry)
+            with self._gate.closed(entry):
+                if not os.path.lexists(old_path):
+                    # removed while it was copied
+                    fs.remove_tree(staging)
+                    raise FuseOSError(errno.ENOENT)
+                self._flush_buffered('/' + entry, tree=True)
+                self._durability.sync()
+                fs.sync_paths(old_path, staging, _changes_below(changed, '/' + entry))
+
+                os.rename(staging, os.path.join(destination, entry))
+                fs.fsync_dir(destination)
+                # the old copy leaves the namespace at once, removing it can take a while
+                os.makedirs(os.path.dirname(retired), exist_ok=True)
+                if os.path.lexists(retired):
+                    fs.remove_tree(retired)
+                os.rename(old_path, retired)
+                with self._placement_lock:
+                    self._set_index(entry, destination)
+                self._touch_root(source)
+                self._touch_root(destination)
+                fs.fallback_fds.discard(old_path)
+                self._invalidate('/' + entry, tree=True)
+                self._follow_handles('/' + entry, '/' + entry, destination)
+        finally:
+            self._migrating.pop(entry, None)
+
+        fs.remove_tree(retired)
+        self._free_space.refresh_source(source)
+        self._free_space.refresh_source(destination)
+
+    def _rename_across(self, old, source, full_old, new, new_source, full_new):
+        # a rename between sources is done like a migration: copied to the new source while old
+        # stays in use, then switched with the gate of its entry closed. The copy runs inside the
+        # rename, with rename_copy_limit one copying more than that many bytes is given up with
+        # EXDEV like between two filesystems, so mv copies it through the mount itself
+        entry = old.strip('/').split('/')[0]
+        self._check_replace(full_old, full_new)
+        if entry in self._migrating:
+            raise FuseOSError(errno.EXDEV)
+        name = f"rename-{next(self._renames)}"
+        staging = os.path.join(new_source, MIGRATION_DIR, name)
+        retired = os.path.join(source, MIGRATION_DIR, name)
+        for path in (staging, retired):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.lexists(path):
+                fs.remove_tree(path)
+        changed = self._migrating[entry] = set()
+        try:
+            fs.sync_tree(full_old, staging, vanishing=True, parallel_map=self._copier.map,
+                         paced=_copy_budget(self.rename_copy_limit) if self.rename_copy_limit else None)
+            with self._gate.closed(entry, held=list(getattr(self._local, 'passed', ())).count(entry)):
+                self._flush_buffered(old, tree=True)
+                self._durability.sync()
+                fs.sync_paths(full_old, staging, _changes_below(changed, old), parallel_map=self._copier.map)
+                os.rename(staging, full_new)
+                fs.fsync_dir(os.path.dirname(full_new))
+                os.rename(full_old, retired)
+                fs.fallback_fds.discard(full_old)
+                self._follow_handles(old, new, new_source)
+        except BlockingIOError:
+            # its entry is being switched by someone else
+            raise FuseOSError(errno.EXDEV)
+        finally:
+            self._migrating.pop(entry, None)
+            if os.path.lexists(staging):
+                fs.remove_tree(staging)
+        fs.remove_tree(retired)
+
+    def _check_replace(self, full_old, full_new):
+        # fail like rename would, before copying anything
+        if not os.path.lexists(full_new):
+            return
+        old_is_dir = os.path.isdir(full_old) and not os.path.islink(full_old)
+        new_is_dir = os.path.isdir(full_new) and not os.path.islink(full_new)
+        if old_is_dir and not new_is_dir:
+            raise FuseOSError(errno.ENOTDIR)
+        if new_is_dir and not old_is_dir:
+            raise FuseOSError(errno.EISDIR)
+        if new_is_dir and os.listdir(full_new):
+            raise FuseOSError(errno.ENOTEMPTY)
+
+    def _follow_handles(self, old, new, source):
+        # files open below old continue on their copy below new on source
+        handles = self._open_below(old, tree=True)
+        if not handles:
+            return
+        # nothing may be left to sync on the fds that are closed here
+        self._durability.sync()
+        for handle in handles:
+            path = new + handle.path[len(old):]
+            real_path = os.path.join(source, path.lstrip('/'))
+            try:
+                self._reopen(handle, real_path)
+            except OSError:
+                # unlinked or renamed while open, it keeps using the old copy
+                log.warning("Could not reopen %s on %s, it stays open on the old copy", handle.path, source)
+                handle.detached = True
+                continue
+            handle.path, handle.real_path, handle.source = path, real_path, source
+
+    def _reopen(self, handle, real_path):
+        # the new file takes over the fd number of the handle, an op still using it reads either
+        # file, while closing it could hand the number to an unrelated file under that op
+        fd = os.open(real_path, handle.flags & ~(os.O_CREAT | os.O_EXCL | os.O_TRUNC))
+        try:
+            os.dup2(fd, handle.fd, inheritable=False)
+        finally:
+            os.close(fd)
+
+    def _open_below(self, path, tree=False):
+        # the handles still following path, and with tree the paths below it
+        prefix = path.rstrip('/') + '/'
+        return [handle for handle in self._handles
+                if not handle.detached and (handle.path == path or tree and handle.path.startswith(prefix))]
+
+    def _open_for_writing(self, path):
+        return any(handle.flags & os.O_ACCMODE != os.O_RDONLY for handle in self._open_below(path))
+
+    def _detach(self, path):
+        # whatever is created at path from now on is another file than the one these have open
+        for handle in self._open_below(path):
+            handle.detached = True
+
+    def _move_handles(self, old, new, full_old, full_new):
+        # files open below old were renamed with it, they keep their file under the new name
+        prefix = full_old.rstrip('/') + '/'
+        for handle in self._open_below(old, tree=True):
+            handle.path = new + handle.path[len(old):]
+            if handle.real_path == full_old or handle.real_path.startswith(prefix):
+                handle.real_path = full_new + handle.real_path[len(full_old):]
+
+    def _drop_cached(self, path, tree=False):
+        # the original is about to change, readers of a fast tier copy go back to it
+        if self._tier is None or not self._tier.invalidate(path, tree):
+            return
+        for handle in self._open_below(path, tree):
+            if not self._tier.holds(handle.real_path):
+                continue
+            source, real_path = self._locate(handle.path)
+            self._reopen(handle, real_path)
+            handle.real_path, handle.source = real_path, source
+
+    def profile(self, mode=None, duration=None):
+        '''Capture where the mount spends its time for duration seconds, returns the file it is written to'''
+        if self._profiler.running():
+            raise FuseOSError(errno.EBUSY)
+        try:
+            return self._profiler.start(mode or self.profile_mode, duration or self.profile_duration)
+        except ValueError:
+            raise FuseOSError(errno.EINVAL)
+
+    def toggle_profile(self):
+        # stops a running capture early, otherwise starts one with the configured mode and duration
+        self._profiler.toggle(self.profile_mode, self.profile_duration)
+
+    def _control(self, line):
+        # migrate <entry> <destination source>, with shell quoting
+        # profile [sample|cprofile] [seconds], profile stop
+        try:
+            words = shlex.split(line)
+        except ValueError:
+            raise FuseOSError(errno.EINVAL)
+        if words and words[0] == 'profile':
+            return self._control_profile(words[1:])
+        if len(words) != 3 or words[0] != 'migrate':
+            raise FuseOSError(errno.EINVAL)
+        _, entry, destination = words
+        if '/' in entry or entry.startswith(PRIVATE_PREFIX) or destination not in self.sources or self._owner(entry) is None:
+            raise FuseOSError(errno.EINVAL)
+        self._migrations.request(entry, destination)
+
+    def _control_profile(self, words):
+        if words == ['stop']:
+            self._profiler.stop()
+            return
+        if len(words) > 2:
+            raise FuseOSError(errno.EINVAL)
+        try:
+            duration = float(words[1]) if len(words) == 2 else None
+        except ValueError:
+            raise FuseOSError(errno.EINVAL)
+        self.profile(words[0] if words else None, duration)
+
+    def _entries(self, op, args):
+        # the top-level entries an op touches, ops wait while one of them switches sources
+        paths = args[:2] if op in ('rename', 'link') else args[:1]
+        return [path.strip('/').split('/')[0] for path in paths if path and path != '/']
+
+    def touches(self):
+        '''{source: {op: count}} of the I/O every source has seen'''
+        return self._touches.snapshot()
+
+    def stats(self):
+        snapshot = self._stats.snapshot()
+        snapshot['touches'] = self.touches()
+        snapshot['open_handles'] = len(self._handles)
+        if self._tier is not None:
+            snapshot['fast_tier'] = self._tier.snapshot()
+        if self._landing is not None:
+            snapshot['landed_files'] = len(self._landing.paths())
+        if self._writeback is not None:
+            snapshot['write_buffered_bytes'] = self._writeback.buffered()
+        snapshot['health'] = self._health.snapshot()
+        snapshot['profile'] = self._profiler.snapshot()
+        return snapshot
+
+    def dump_stats(self):
+        '''Write stats() to a file in stats_dir, returns its path'''
+        path = os.path.join(self.stats_dir, f"cinchfs-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}-stats.json")
+        with open(path, 'w') as f:
+            json.dump(self.stats(), f, indent=2)
+            f.write('\n')
+        log.warning("Stats written to %s", path)
+        return path
+
+    def _touch(self, source, op=None):
+        if op is None:
+            op = getattr(self._local, 'op', None) or 'internal'
+            self._local.source = source
+        self._touches.touch(source, op)
+        self._awake = source
+
+    def _root_source(self):
+        # every source has the root, with spindown it is taken from one that is spinning anyway
+        return self._awake if self.spindown else self.sources[0]
+
+    def _touch_root(self, source):
+        # our own top-level change must not make the persisted listing look stale
+        if self._state is not None:
+            self._root_mtimes[source] = os.stat(source).st_mtime_ns
+
     def _root_readdir(self, fh):
         # When reading the root we need to merge all of the sources
-        dirents = ['.', '..']
+        yield '.'
+        yield '..'
+        if self.spindown:
+            # list the root from the index so sleeping disks stay asleep
+            for name in list(self._index):
+                if name not in self._pending:
+                    yield name
+            return
         for source in self.sources:
-            dirents.extend(os.listdir(source))
-        
-        for r in dirents:
-            yield r
+            self._touch(source, 'readdir')
+            try:
+                listing = self._health.probe(source, lambda: list(fs.scandir(source)))
+            except TimeoutError:
+                # a degraded source is listed from the index
+                yield from self._indexed(source)
+                continue
+            for name, attrs in listing:
+                if name.startswith(PRIVATE_PREFIX):
+                    continue
+                self._attrs.put('/' + name, attrs)
+                yield name, attrs, 0
+
+    def _indexed(self, source):
+        return [name for name, owner in list(self._index.items()) if owner == source and name not in self._pending]
+
+    def _cache_listed_attrs(self, path, dirents):
+        # the kernel follows a listing with a getattr per entry, answer those from the cache
+        for dirent in dirents:
+            if not isinstance(dirent, str):
+                name, attrs, _ = dirent
+                self._attrs.put(os.path.join(path, name), attrs)
+            yield dirent
 
     def _root_statfs(self):
         # The file attributes for the root dir are tricky -- they can't be merged perfectly
         # Present an optimistic number for the available blocks -- even though one directory must fit within one source
         # TODO this assumes all sources have the same blocksize (f_frsize).
-        stvs = [fs.statfs(source) for source in self.sources]
+        stvs = self._free_space.samples()
+        if not stvs:
+            # no source answered within statfs_timeout yet, like while they all spin up
+            raise FuseOSError(errno.EIO)
 
         root_stv = {} 
         root_stv["f_bavail"] = sum((stv['f_bavail'] for stv in stvs))
@@ -175,8 +1124,32 @@ class Filesystem():
         root_stv["f_namemax"] = min((stv['f_namemax'] for stv in stvs))
         return root_stv
 
+def _copy_budget(limit):
+    # paces nothing, but gives up a copy once it copied more than limit bytes
+    copied = [0]
+    lock = threading.Lock()
+
+    def paced(nbytes):
+        with lock:
+            copied[0] += nbytes
+            if copied[0] > limit:
+                raise FuseOSError(errno.EXDEV)
+    return paced
+
+def _changes_below(changed, path):
+    # the changed paths of a migration below path, relative to it for fs.sync_paths
+    paths = []
+    for partial in list(changed):
+        if partial.rstrip('/') == path:
+            paths.append('/' if partial.endswith('/') else '')
+        elif partial.startswith(path + '/'):
+            paths.append(partial[len(path) + 1:])
+    return paths
+
 def parse_mount_options(options):
     dict_options = {}
+    if not options:
+        return dict_options
     for option in options.split(","):
         if '=' in option:
             key, value = option.split('=')
@@ -185,11 +1158,87 @@ def parse_mount_options(options):
             dict_options[option] = True
     return dict_options
 
+def parse_flag(value):
+    if isinstance(value, bool):
+        return value
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+# mount options consumed by cinchfs itself instead of being passed on to FUSE
+CINCHFS_OPTIONS = {
+    'rescan_interval': float,
+    'vectored_io': parse_flag,
+    'durability': str,
+    'sync_interval': float,
+    'statfs_ttl': float,
+    'statfs_timeout': float,
+    'attr_ttl': float,
+    'negative_ttl': float,
+    'cache_size': int,
+    'state_dir': str,
+    'spindown': parse_flag,
+    'placement': str,
+    'trace': str,
+    'fast_tier': lambda value: value.split(':'),
+    'fast_tier_size': int,
+    'promote_after': int,
+    'landing': str,
+    'landing_idle': float,
+    'landing_bandwidth': int,
+    'keep_cache': parse_flag,
+    'write_buffer': int,
+    'probe_timeout': float,
+    'degrade_latency': float,
+    'degrade_errors': int,
+    'profile_dir': str,
+    'profile_mode': str,
+    'profile_duration': float,
+    'stats_dir': str,
+    'rename_copy_limit': int,
+}
+
+def split_mount_options(mount_options):
+    cinchfs_options = {}
+    for key, convert in CINCHFS_OPTIONS.items():
+        if key in mount_options:
+            cinchfs_options[key] = convert(mount_options.pop(key))
+    return cinchfs_options
+
 def main(sources, mountpoint, options=''):
-    cfs = Filesystem(sources, mountpoint)
     mount_options = parse_mount_options(options)
+    cinchfs_options = split_mount_options(mount_options)
+    # serve requests from a single thread unless the threads option is given
+    threads = parse_flag(mount_options.pop('threads', False))
+    cfs = Filesystem(sources, mountpoint, **cinchfs_options)
+    # let the kernel cache the same answers for as long as cinchfs does
+    mount_options.setdefault('entry_timeout', cfs._attrs.ttl)
+    mount_options.setdefault('attr_timeout', cfs._attrs.ttl)
+    mount_options.setdefault('negative_timeout', cfs._missing.ttl)
+    mount_options.update(kernel_options(mount_options))
+    # the main thread sits inside fuse_main and never runs python signal handlers, so these are
+    # blocked in every thread libfuse starts, and waited for on threads of our own from init()
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGUSR1, signal.SIGUSR2})
     # FUSE(cfs, mountpoint, nothreads=True, foreground=True, **{'allow_other': True})
-    FUSE(cfs, mountpoint, nothreads=True, **mount_options)
+    FUSE(cfs, mountpoint, raw_fi=True, nothreads=not threads, **mount_options)
+
+def kernel_options(mount_options):
+    '''KERNEL_OPTIONS with the ones given as mount options overriding them, flags can be turned off with =false'''
+    options = {}
+    for key, default in KERNEL_OPTIONS.items():
+        value = mount_options.get(key, default)
+        options[key] = parse_flag(value) if isinstance(default, bool) else int(value)
+    return options
+
+def watch_signal(signum, handler):
+    # signum must be blocked in every thread, or it is delivered to one of them instead
+    def wait():
+        while True:
+            signal.sigwait({signum})
+            try:
+                handler()
+            except Exception:
+                log.exception("Handling signal %s failed", signum)
+
+    threading.Thread(target=wait, name=f'cinchfs-signal-{signum}', daemon=True).start()
 
 
 if __name__ == '__main__':
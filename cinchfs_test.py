@@ -2,7 +2,17 @@
 
 import pytest
 import os
-from cinchfs import Filesystem, DuplicatePathException
+import errno
+import threading
+import itertools
+import json
+import pstats
+import time
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import fusefs
+from cinchfs import Filesystem, DuplicatePathException, kernel_options, split_mount_options, KERNEL_OPTIONS
 
 
 class TestStartup(object):
@@ -130,7 +140,7 @@ class TestFullPath(object):
         fs.add_mount_point("/disk0", 50)
         fs.add_mount_point("/disk1", 100)
         cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot")
-        assert cfs._full_path("/test") == "/disk1/test"
+        assert cfs._locate("/test", create=True)[1] == "/disk1/test"
 
     def test_fullpath_multiple_empty_sources_new_file_in_directory_uses_the_existing_directory_source(self, fs, monkeypatch):
         # disk1 has more free space, but prefer the existing dir on disk0
@@ -155,5 +165,1023 @@ class TestFullPath(object):
         fs.add_mount_point("/disk0", 50)
         fs.add_mount_point("/disk1", 100)
         cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot")
-        assert cfs._full_path("/dir/") == "/disk1/dir/"
+        assert cfs._locate("/dir/", create=True)[1] == "/disk1/dir/"
+
+
+
+class TestIndex(object):
+
+    def test_index_built_at_startup(self, fs):
+        fs.create_file("/disk0/test0")
+        fs.create_dir("/disk1/dir1")
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot")
+        assert cfs._index == {"test0": "/disk0", "dir1": "/disk1"}
+
+    def test_private_root_entries_are_not_indexed(self, fs):
+        fs.create_dir("/disk0/.cinchfs-moving/dir")
+        fs.create_dir("/disk1/.cinchfs-moving")
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot")
+        assert cfs._index == {}
+        assert list(cfs.readdir("/", None)) == [".", ".."]
+
+    def test_fullpath_does_not_probe_indexed_entries(self, fs, monkeypatch):
+        fs.create_dir("/disk0")
+        fs.create_file("/disk1/dir/test")
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot")
+        monkeypatch.setattr(os.path, "lexists", None)
+        assert cfs._full_path("/dir/test") == "/disk1/dir/test"
+
+    def test_mkdir_adds_to_index(self, fs, monkeypatch):
+        monkeypatch.setattr(Filesystem, "_get_free_blocks", { "/disk0": 50, "/disk1": 100 }.get)
+        fs.create_dir("/disk0")
+        fs.create_dir("/disk1")
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot")
+        cfs.mkdir("/dir", 0o755)
+        assert cfs._index["dir"] == "/disk1"
+        assert os.path.isdir("/disk1/dir")
+
+    def test_unlink_removes_from_index(self, fs):
+        fs.create_file("/disk0/test")
+        cfs = Filesystem(["/disk0"], "/cfsroot")
+        cfs.unlink("/test")
+        assert "test" not in cfs._index
+
+    def test_unlink_nested_keeps_index(self, fs):
+        fs.create_file("/disk0/dir/test")
+        cfs = Filesystem(["/disk0"], "/cfsroot")
+        cfs.unlink("/dir/test")
+        assert cfs._index["dir"] == "/disk0"
+
+    def test_rename_moves_index_entry(self, fs):
+        fs.create_file("/disk0/old")
+        cfs = Filesystem(["/disk0"], "/cfsroot")
+        cfs.rename("/old", "/new")
+        assert "old" not in cfs._index
+        assert cfs._index["new"] == "/disk0"
+
+    def test_fullpath_revalidates_on_miss(self, fs):
+        fs.create_dir("/disk0")
+        fs.create_dir("/disk1")
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot")
+        fs.create_file("/disk1/dir/test")  # created directly on the source
+        assert cfs._full_path("/dir/test") == "/disk1/dir/test"
+        assert cfs._index["dir"] == "/disk1"
+
+    def test_rescan_picks_up_moved_entries(self, fs):
+        fs.create_file("/disk0/test")
+        fs.create_dir("/disk1")
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot")
+        os.rename("/disk0/test", "/disk1/test")  # moved directly on the sources
+        cfs.rescan()
+        assert cfs._full_path("/test") == "/disk1/test"
+
+    @pytest.mark.parametrize("spindown", [False, True])
+    def test_rescan_keeps_changes_made_while_listing(self, fs, monkeypatch, spindown):
+        fs.create_dir("/disk0/gone")
+        fs.create_dir("/disk1")
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot", spindown=spindown)
+        scan = cfs._scan_sources
+
+        def scan_during_changes(stored=None):
+            listed = scan(stored)
+            cfs.mkdir("/new", 0o755)
+            cfs.rmdir("/gone")
+            return listed
+
+        monkeypatch.setattr(cfs, "_scan_sources", scan_during_changes)
+        cfs.rescan()
+        assert "new" in cfs._index
+        assert "gone" not in cfs._index
+        names = [dirent if isinstance(dirent, str) else dirent[0] for dirent in cfs.readdir("/", None)]
+        assert names == [".", "..", "new"]
+
+
+class TestConcurrency(object):
+
+    def test_racing_creates_agree_on_placement(self, tmp_path, monkeypatch):
+        sources = [str(tmp_path / "disk0"), str(tmp_path / "disk1")]
+        for source in sources:
+            os.mkdir(source)
+        # a slow placement decision that keeps changing its mind
+        flips = itertools.count()
+
+        def get_free_blocks(self, source):
+            time.sleep(0.001)
+            return next(flips) % 2 if source == sources[0] else 0.5
+
+        monkeypatch.setattr(Filesystem, "_get_free_blocks", get_free_blocks)
+        cfs = Filesystem(sources, "/cfsroot")
+
+        def create(_):
+            cfs.release("/new", cfs.create("/new", 0o644))
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(create, range(32)))
+
+        assert [os.path.exists(os.path.join(source, "new")) for source in sources].count(True) == 1
+
+    def test_failed_create_releases_reservation(self, fs, monkeypatch):
+        monkeypatch.setattr(Filesystem, "_get_free_blocks", { "/disk0": 50 }.get)
+        fs.create_dir("/disk0")
+        cfs = Filesystem(["/disk0"], "/cfsroot")
+        with pytest.raises(OSError):
+            cfs.mknod("/missing/test", 0o644, 0)
+        assert "missing" not in cfs._index
+
+
+class TestHandles(object):
+
+    def test_read_write_use_handle_without_resolving(self, tmp_path, monkeypatch):
+        (tmp_path / "test").write_text("hello")
+        cfs = Filesystem([str(tmp_path)], "/cfsroot")
+        fh = cfs.open("/test", os.O_RDWR)
+        monkeypatch.setattr(Filesystem, "_locate", None)
+        assert cfs.write("/test", b"J", 0, fh) == 1
+        assert cfs.read("/test", 5, 0, fh) == b"Jello"
+        cfs.truncate("/test", 2, fh)
+        assert cfs.getattr("/test", fh)["st_size"] == 2
+        cfs.flush("/test", fh)
+        cfs.release("/test", fh)
+        assert len(cfs._handles) == 0
+
+    def test_create_registers_handle(self, fs):
+        fs.create_dir("/disk0/dir")
+        cfs = Filesystem(["/disk0"], "/cfsroot")
+        fh = cfs.create("/dir/test", 0o644)
+        handle = cfs._handles.get(fh)
+        assert handle.real_path == "/disk0/dir/test"
+        assert handle.source == "/disk0"
+
+    def test_read_with_unknown_handle_falls_back_to_path(self, tmp_path):
+        (tmp_path / "test").write_text("hello")
+        cfs = Filesystem([str(tmp_path)], "/cfsroot")
+        assert cfs.read("/test", 5, 0, 1234) == b"hello"
+        cfs.destroy("/")
+
+    def test_truncate_without_handle(self, fs):
+        fs.create_file("/disk0/test", contents="hello")
+        cfs = Filesystem(["/disk0"], "/cfsroot")
+        cfs.truncate("/test", 1)
+        assert os.path.getsize("/disk0/test") == 1
+
+
+class TestAttributeCache(object):
+
+    def test_getattr_is_cached(self, fs, monkeypatch):
+        fs.create_file("/disk0/test", contents="hello")
+        cfs = Filesystem(["/disk0"], "/cfsroot")
+        assert cfs.getattr("/test")["st_size"] == 5
+        monkeypatch.setattr(os, "lstat", None)
+        assert cfs.getattr("/test")["st_size"] == 5
+
+    def test_missing_path_is_cached(self, fs, monkeypatch):
+        fs.create_dir("/disk0")
+        fs.create_dir("/disk1")
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot")
+        monkeypatch.setattr(Filesystem, "_get_free_blocks", None)  # no placement sweep
+        with pytest.raises(OSError):
+            cfs.getattr("/missing")
+        monkeypatch.setattr(os.path, "lexists", None)
+        with pytest.raises(OSError):
+            cfs.getattr("/missing")
+
+    def test_create_invalidates_missing_entry(self, fs, monkeypatch):
+        monkeypatch.setattr(Filesystem, "_get_free_blocks", { "/disk0": 50 }.get)
+        fs.create_dir("/disk0")
+        cfs = Filesystem(["/disk0"], "/cfsroot")
+        with pytest.raises(OSError):
+            cfs.getattr("/dir")
+        cfs.mkdir("/dir", 0o755)
+        assert cfs.getattr("/dir")["st_nlink"] >= 1
+
+    def test_chmod_invalidates_attributes(self, fs):
+        fs.create_file("/disk0/test")
+        cfs = Filesystem(["/disk0"], "/cfsroot")
+        cfs.getattr("/test")
+        cfs.chmod("/test", 0o600)
+        assert cfs.getattr("/test")["st_mode"] & 0o777 == 0o600
+
+    def test_rename_invalidates_tree(self, fs):
+        fs.create_file("/disk0/dir/test")
+        fs.create_dir("/disk0/other")
+        cfs = Filesystem(["/disk0"], "/cfsroot")
+        cfs.getattr("/dir/test")
+        with pytest.raises(OSError):
+            cfs.getattr("/other/dir/test")
+        cfs.rename("/dir", "/other/dir")
+        with pytest.raises(OSError):
+            cfs.getattr("/dir/test")
+        assert cfs.getattr("/other/dir/test")["st_size"] == 0
+
+    def test_disabled_cache_reads_through(self, fs):
+        fs.create_file("/disk0/test", contents="hello")
+        cfs = Filesystem(["/disk0"], "/cfsroot", attr_ttl=0)
+        cfs.getattr("/test")
+        with open("/disk0/test", "a") as f:
+            f.write("!")
+        assert cfs.getattr("/test")["st_size"] == 6
+
+
+class TestKernelCache(object):
+
+    def fi(self, flags=os.O_RDONLY):
+        return SimpleNamespace(flags=flags, fh=0, keep_cache=0, direct_io=0)
+
+    def test_unchanged_file_keeps_cache(self, tmp_path):
+        (tmp_path / "test").write_text("hello")
+        cfs = Filesystem([str(tmp_path)], "/cfsroot")
+        fi = self.fi()
+        assert cfs("open", "/test", fi) == 0
+        assert not fi.keep_cache
+        assert cfs("read", "/test", 5, 0, fi) == b"hello"
+        cfs("release", "/test", fi)
+        again = self.fi()
+        cfs("open", "/test", again)
+        assert again.keep_cache
+        assert again.fh != fi.fh
+        cfs("release", "/test", again)
+        assert len(cfs._handles) == 0
+
+    def test_changed_file_drops_cache(self, tmp_path):
+        (tmp_path / "test").write_text("hello")
+        cfs = Filesystem([str(tmp_path)], "/cfsroot")
+        cfs("open", "/test", self.fi())
+        (tmp_path / "test").write_text("hello world")
+        fi = self.fi()
+        cfs("open", "/test", fi)
+        assert not fi.keep_cache
+
+    def test_changes_through_the_mount_drop_cache(self, tmp_path):
+        (tmp_path / "test").write_text("hello")
+        cfs = Filesystem([str(tmp_path)], "/cfsroot")
+        cfs("open", "/test", self.fi())
+        cfs("utimens", "/test", (1, 1))
+        fi = self.fi()
+        cfs("open", "/test", fi)
+        assert not fi.keep_cache
+
+    def test_disabled(self, tmp_path):
+        (tmp_path / "test").write_text("hello")
+        cfs = Filesystem([str(tmp_path)], "/cfsroot", keep_cache=False)
+        cfs("open", "/test", self.fi())
+        fi = self.fi()
+        cfs("open", "/test", fi)
+        assert not fi.keep_cache
+
+    def test_virtual_files_bypass_page_cache(self, fs):
+        fs.create_dir("/disk0")
+        cfs = Filesystem(["/disk0"], "/cfsroot")
+        fi = self.fi()
+        cfs("open", "/.cinchfs/stats", fi)
+        assert fi.direct_io
+        assert json.loads(cfs("read", "/.cinchfs/stats", 1 << 20, 0, fi))
+
+    def test_create_fills_in_handle(self, tmp_path):
+        cfs = Filesystem([str(tmp_path)], "/cfsroot")
+        fi = self.fi(os.O_WRONLY | os.O_CREAT)
+        assert cfs("create", "/test", 0o644, fi) == 0
+        assert cfs("write", "/test", b"hi", 0, fi) == 2
+        cfs("release", "/test", fi)
+        assert (tmp_path / "test").read_bytes() == b"hi"
+
+    def test_kernel_options_can_be_overridden(self):
+        assert kernel_options({}) == KERNEL_OPTIONS
+        options = kernel_options({"big_writes": "false", "max_write": "65536"})
+        assert options["big_writes"] is False
+        assert options["max_write"] == 65536
+        assert options["max_read"] == KERNEL_OPTIONS["max_read"]
+
+    def test_large_requests_are_vectored(self, tmp_path, monkeypatch):
+        mount_options = {"vectored_io": "true", "max_read": "1048576"}
+        cinchfs_options = split_mount_options(mount_options)
+        assert cinchfs_options == {"vectored_io": True}
+        cfs = Filesystem([str(tmp_path)], "/cfsroot", **cinchfs_options)
+        preadv = os.preadv
+        calls = []
+        monkeypatch.setattr(os, "preadv", lambda fd, buffers, offset: calls.append(len(buffers)) or preadv(fd, buffers, offset))
+        data = os.urandom(1 << 20)
+        (tmp_path / "test").write_bytes(b"")
+        fh = cfs.open("/test", os.O_RDWR)
+        assert cfs.write("/test", data, 0, fh) == len(data)
+        assert cfs.read("/test", len(data), 0, fh) == data
+        cfs.release("/test", fh)
+        assert calls == [8]
+
+
+class TestWriteBuffer(object):
+
+    def test_small_writes_are_merged(self, tmp_path, monkeypatch):
+        (tmp_path / "test").write_text("")
+        cfs = Filesystem([str(tmp_path)], "/cfsroot", write_buffer=1 << 20)
+        writes = []
+        write = os.pwrite
+        monkeypatch.setattr(os, "pwrite", lambda fd, buf, offset: writes.append(offset) or write(fd, buf, offset))
+        fh = cfs.open("/test", os.O_WRONLY)
+        for i in range(4):
+            assert cfs.write("/test", b"abcd", i * 4, fh) == 4
+        assert writes == []
+        cfs.flush("/test", fh)
+        cfs.release("/test", fh)
+        assert writes == [0]
+        assert (tmp_path / "test").read_text() == "abcd" * 4
+
+    def test_buffered_writes_are_visible(self, tmp_path):
+        (tmp_path / "test").write_text("hello")
+        cfs = Filesystem([str(tmp_path)], "/cfsroot", write_buffer=1 << 20)
+        fh = cfs.open("/test", os.O_RDWR)
+        cfs.write("/test", b"J", 0, fh)
+        assert cfs.read("/test", 5, 0, fh) == b"Jello"
+        cfs.write("/test", b"!", 5, fh)
+        assert cfs.getattr("/test")["st_size"] == 6
+        cfs.write("/test", b"?", 6, fh)
+        cfs.truncate("/test", 6, fh)
+        assert cfs.getattr("/test", fh)["st_size"] == 6
+        cfs.release("/test", fh)
+        assert (tmp_path / "test").read_text() == "Jello!"
+
+    def test_rename_writes_out_first(self, tmp_path):
+        cfs = Filesystem([str(tmp_path)], "/cfsroot", write_buffer=1 << 20)
+        cfs.mkdir("/dir", 0o755)
+        fh = cfs.create("/dir/test", 0o644)
+        cfs.write("/dir/test", b"hello", 0, fh)
+        cfs.rename("/dir", "/moved")
+        assert (tmp_path / "moved" / "test").read_text() == "hello"
+        cfs.release("/moved/test", fh)
+        assert cfs.stats()["write_buffered_bytes"] == 0
+
+    def test_writes_after_a_rename_are_visible_at_the_new_name(self, tmp_path):
+        cfs = Filesystem([str(tmp_path)], "/cfsroot", write_buffer=1 << 20)
+        fh = cfs.create("/test", 0o644)
+        cfs.write("/test", b"hello", 0, fh)
+        cfs.rename("/test", "/moved")
+        assert cfs.getattr("/moved")["st_size"] == 5
+        cfs.write("/moved", b" world", 5, fh)
+        assert cfs.getattr("/moved")["st_size"] == 11
+        cfs.release("/moved", fh)
+
+    def test_write_out_failures_go_to_the_writing_handle(self, tmp_path, monkeypatch):
+        (tmp_path / "test").write_text("")
+        cfs = Filesystem([str(tmp_path)], "/cfsroot", write_buffer=1 << 20)
+        fh = cfs.open("/test", os.O_WRONLY)
+        cfs.write("/test", b"hello", 0, fh)
+        write = os.pwrite
+
+        def full(fd, buf, offset):
+            raise OSError(errno.ENOSPC, "full")
+        monkeypatch.setattr(os, "pwrite", full)
+        assert cfs.getattr("/test")["st_size"] == 0
+        monkeypatch.setattr(os, "pwrite", write)
+        with pytest.raises(OSError) as e:
+            cfs.flush("/test", fh)
+        assert e.value.errno == errno.ENOSPC
+        cfs.flush("/test", fh)
+        cfs.release("/test", fh)
+
+
+class TestHealth(object):
+
+    def test_degraded_source_is_skipped_for_placement(self, fs, monkeypatch):
+        monkeypatch.setattr(Filesystem, "_get_free_blocks", { "/disk0": 100, "/disk1": 50 }.get)
+        fs.create_dir("/disk0")
+        fs.create_dir("/disk1")
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot")
+        for _ in range(3):
+            cfs._health.record("/disk0", 1000, errno.EIO)
+        cfs.mkdir("/dir", 0o755)
+        assert os.path.isdir("/disk1/dir")
+        assert cfs.stats()["health"]["/disk0"]["state"] == "degraded"
+        cfs.destroy("/")
+
+    def test_slow_fsyncs_do_not_degrade(self, tmp_path, monkeypatch):
+        cfs = Filesystem([str(tmp_path)], "/cfsroot", degrade_latency=0.5)
+        fh = cfs("create", "/test", 0o644)
+        clock = itertools.count(0, 10 ** 9)
+        monkeypatch.setattr(time, "perf_counter_ns", lambda: next(clock))
+        for _ in range(20):
+            cfs("fsync", "/test", 0, fh)
+        assert cfs._health.healthy(str(tmp_path))
+        for _ in range(20):
+            cfs("getattr", "/test", fh)
+        assert not cfs._health.healthy(str(tmp_path))
+        cfs("release", "/test", fh)
+        cfs.destroy("/")
+
+    def test_hung_source_is_listed_from_index(self, tmp_path, monkeypatch):
+        disks = [str(tmp_path / name) for name in ("disk0", "disk1")]
+        for disk in disks:
+            os.makedirs(os.path.join(disk, "dir-" + os.path.basename(disk)))
+        cfs = Filesystem(disks, "/cfsroot", probe_timeout=0.05)
+        hung = threading.Event()
+        scandir = os.scandir
+        monkeypatch.setattr(os, "scandir", lambda path: hung.wait() if path == disks[1] else scandir(path))
+        names = [dirent[0] if isinstance(dirent, tuple) else dirent for dirent in cfs.readdir("/", None)]
+        assert names == [".", "..", "dir-disk0", "dir-disk1"]
+        assert not cfs._health.healthy(disks[1])
+        # unknown names are only looked for on the healthy source
+        with pytest.raises(OSError):
+            cfs.getattr("/missing")
+        hung.set()
+        cfs.destroy("/")
+
+
+class TestProfile(object):
+
+    def test_control_file_captures_ops(self, tmp_path):
+        (tmp_path / "disk0").mkdir()
+        (tmp_path / "disk0" / "test").write_text("hello")
+        cfs = Filesystem([str(tmp_path / "disk0")], "/cfsroot", profile_dir=str(tmp_path))
+        fh = cfs("open", "/.cinchfs/control", os.O_WRONLY)
+        cfs("write", "/.cinchfs/control", b"profile cprofile 60\n", 0, fh)
+        assert cfs.stats()["profile"]["state"] == "running"
+        with pytest.raises(OSError):
+            cfs("write", "/.cinchfs/control", b"profile sample\n", 0, fh)
+        cfs("getattr", "/test")
+        cfs("write", "/.cinchfs/control", b"profile stop\n", 0, fh)
+        cfs("release", "/.cinchfs/control", fh)
+        output = cfs.stats()["profile"]["output"]
+        assert output.startswith(str(tmp_path))
+        assert "getattr" in [function for _, _, function in pstats.Stats(output).stats]
+
+    def test_bad_profile_request_is_rejected(self, fs):
+        fs.create_dir("/disk0")
+        cfs = Filesystem(["/disk0"], "/cfsroot")
+        with pytest.raises(OSError):
+            cfs._control("profile perf")
+        with pytest.raises(OSError):
+            cfs._control("profile sample soon")
+        assert cfs.stats()["profile"]["state"] == "idle"
+
+
+class TestReaddir(object):
+
+    def test_root_readdir_merges_sources_with_attributes(self, fs):
+        fs.create_file("/disk0/test0", contents="a")
+        fs.create_file("/disk1/test1", contents="bb")
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot")
+        dirents = list(cfs.readdir("/", None))
+        assert dirents[:2] == [".", ".."]
+        sizes = dict((name, attrs["st_size"]) for name, attrs, _ in dirents[2:])
+        assert sizes == {"test0": 1, "test1": 2}
+
+    def test_readdir_fills_attribute_cache(self, fs, monkeypatch):
+        fs.create_file("/disk0/dir/test", contents="abc")
+        cfs = Filesystem(["/disk0"], "/cfsroot")
+        names = [dirent[0] if isinstance(dirent, tuple) else dirent for dirent in cfs.readdir("/dir", None)]
+        assert names == [".", "..", "test"]
+        monkeypatch.setattr(os, "lstat", None)
+        assert cfs.getattr("/dir/test")["st_size"] == 3
+
+
+class TestIndexState(object):
+
+    def test_unchanged_sources_are_not_listed_again(self, fs, monkeypatch):
+        fs.create_file("/disk0/test0")
+        fs.create_file("/disk1/test1")
+        Filesystem(["/disk0", "/disk1"], "/cfsroot", state_dir="/state").destroy("/")
+        monkeypatch.setattr(os, "listdir", None)
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot", state_dir="/state")
+        assert cfs._index == {"test0": "/disk0", "test1": "/disk1"}
+
+    def test_changed_source_is_listed_again(self, fs, monkeypatch):
+        fs.create_file("/disk0/test0")
+        fs.create_dir("/disk1")
+        Filesystem(["/disk0", "/disk1"], "/cfsroot", state_dir="/state").destroy("/")
+        fs.create_file("/disk1/test1")
+        os.utime("/disk1", ns=(1, 1))
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot", state_dir="/state")
+        assert cfs._index == {"test0": "/disk0", "test1": "/disk1"}
+
+    def test_changes_through_the_mount_are_saved(self, fs, monkeypatch):
+        monkeypatch.setattr(Filesystem, "_get_free_blocks", { "/disk0": 50 }.get)
+        fs.create_dir("/disk0")
+        cfs = Filesystem(["/disk0"], "/cfsroot", state_dir="/state")
+        cfs.mkdir("/dir", 0o755)
+        cfs.destroy("/")
+        monkeypatch.setattr(os, "listdir", None)
+        assert Filesystem(["/disk0"], "/cfsroot", state_dir="/state")._index == {"dir": "/disk0"}
+
+    def test_stored_duplicates_are_still_detected(self, fs):
+        fs.create_file("/disk0/test")
+        fs.create_dir("/disk1")
+        Filesystem(["/disk0", "/disk1"], "/cfsroot", state_dir="/state").destroy("/")
+        fs.create_file("/disk1/test")
+        os.utime("/disk1", ns=(1, 1))
+        with pytest.raises(DuplicatePathException):
+            Filesystem(["/disk0", "/disk1"], "/cfsroot", state_dir="/state")
+
+
+class TestStatfs(object):
+
+    def test_root_adds_up_the_sources(self, tmp_path):
+        disks = [str(tmp_path / name) for name in ("disk0", "disk1")]
+        for disk in disks:
+            os.makedirs(disk)
+        cfs = Filesystem(disks, "/cfsroot")
+        assert cfs.statfs("/")["f_blocks"] == 2 * os.statvfs(disks[0]).f_blocks
+
+    def test_root_fails_while_no_source_answers(self, tmp_path, monkeypatch):
+        def spinning_up(source):
+            raise OSError(errno.EAGAIN, "spinning up")
+        monkeypatch.setattr(fusefs, "statfs", spinning_up)
+        cfs = Filesystem([str(tmp_path)], "/cfsroot")
+        with pytest.raises(OSError) as e:
+            cfs.statfs("/")
+        assert e.value.errno == errno.EIO
+
+
+class TestSpindown(object):
+
+    def test_only_the_owning_source_is_touched(self, fs, monkeypatch):
+        monkeypatch.setattr(Filesystem, "_get_free_blocks", { "/disk0": 50, "/disk1": 100 }.get)
+        fs.create_dir("/disk0")
+        fs.create_file("/disk1/dir/test")
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot", spindown=True)
+        before = cfs.touches()
+        cfs("getattr", "/dir/test")
+        with pytest.raises(OSError):
+            cfs("getattr", "/missing")
+        assert list(cfs("readdir", "/", None)) == [".", "..", "dir"]
+        after = cfs.touches()
+        assert after["/disk0"] == before["/disk0"]
+        assert after["/disk1"]["getattr"] == 1
+
+    def test_the_root_is_looked_up_on_an_awake_source(self, fs, monkeypatch):
+        fs.create_dir("/disk0")
+        fs.create_file("/disk1/dir/test")
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot", spindown=True)
+        cfs("getattr", "/dir/test")
+        before = cfs.touches()
+        assert cfs("getattr", "/")["st_mode"] & 0o40000
+        cfs("access", "/", os.R_OK)
+        after = cfs.touches()
+        assert after["/disk0"] == before["/disk0"]
+        assert after["/disk1"]["getattr"] == 2
+        assert after["/disk1"]["access"] == 1
+
+    def test_misses_probe_every_source_without_spindown(self, fs):
+        fs.create_dir("/disk0")
+        fs.create_dir("/disk1")
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot")
+        with pytest.raises(OSError):
+            cfs("getattr", "/missing")
+        touches = cfs.touches()
+        assert touches["/disk0"]["probe"] == 1
+        assert touches["/disk1"]["probe"] == 1
+
+
+class TestPlacementPolicy(object):
+
+    def test_round_robin_spreads_new_entries(self, fs, monkeypatch):
+        monkeypatch.setattr(Filesystem, "_get_free_blocks", { "/disk0": 50, "/disk1": 100 }.get)
+        fs.create_dir("/disk0")
+        fs.create_dir("/disk1")
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot", placement="round-robin")
+        for idx in range(4):
+            cfs.mkdir(f"/dir{idx}", 0o755)
+        assert sorted(os.listdir("/disk0")) == ["dir0", "dir2"]
+        assert sorted(os.listdir("/disk1")) == ["dir1", "dir3"]
+
+    def test_failed_lookups_do_not_draw_a_placement(self, fs, monkeypatch):
+        monkeypatch.setattr(Filesystem, "_get_free_blocks", { "/disk0": 50, "/disk1": 100 }.get)
+        fs.create_dir("/disk0")
+        fs.create_dir("/disk1")
+        cfs = Filesystem(["/disk0", "/disk1"], "/cfsroot", placement="round-robin")
+        for op, args in (("open", (os.O_RDONLY,)), ("chmod", (0o644,)), ("unlink", ())):
+            with pytest.raises(OSError):
+                cfs(op, "/missing", *args)
+        cfs.mkdir("/dir0", 0o755)
+        assert os.listdir("/disk0") == ["dir0"]
+
+
+class TestStats(object):
+
+    def test_ops_are_recorded_per_op_and_source(self, fs):
+        fs.create_file("/disk0/test", contents="hello")
+        cfs = Filesystem(["/disk0"], "/cfsroot")
+        cfs("getattr", "/test")
+        with pytest.raises(OSError):
+            cfs("getattr", "/test/missing")
+        stats = cfs.stats()
+        assert stats["ops"]["getattr"]["count"] == 2
+        assert stats["ops"]["getattr"]["errors"] == 1
+        assert stats["sources"]["/disk0"]["count"] == 2
+        assert stats["ops"]["getattr"]["max_ms"] >= stats["ops"]["getattr"]["p50_ms"]
+
+    def test_listings_are_timed_while_they_run(self, tmp_path, monkeypatch):
+        (tmp_path / "dir").mkdir()
+        (tmp_path / "dir" / "test").write_text("")
+        cfs = Filesystem([str(tmp_path)], "/cfsroot")
+        scandir = os.scandir
+
+        def slow_scandir(path):
+            time.sleep(0.05)
+            return scandir(path)
+        monkeypatch.setattr(os, "scandir", slow_scandir)
+        dirents = cfs("readdir", "/dir", None)
+        assert [dirent if isinstance(dirent, str) else dirent[0] for dirent in dirents] == [".", "..", "test"]
+        assert cfs.stats()["ops"]["readdir"]["max_ms"] >= 50
+
+    def test_stats_file_is_served_from_memory(self, fs, monkeypatch):
+        fs.create_file("/disk0/test", contents="hello")
+        cfs = Filesystem(["/disk0"], "/cfsroot")
+        cfs("getattr", "/test")
+        monkeypatch.setattr(Filesystem, "_locate", None)
+        size = cfs("getattr", "/.cinchfs/stats")["st_size"]
+        fh = cfs("open", "/.cinchfs/stats", os.O_RDONLY)
+        contents = cfs("read", "/.cinchfs/stats", size, 0, fh)
+        cfs("release", "/.cinchfs/stats", fh)
+        assert json.loads(contents)["ops"]["getattr"]["count"] == 1
+        assert "stats" in cfs("readdir", "/.cinchfs", None)
+
+    def test_dump_is_written_to_the_stats_dir(self, tmp_path):
+        (tmp_path / "disk0").mkdir()
+        cfs = Filesystem([str(tmp_path / "disk0")], "/cfsroot", stats_dir=str(tmp_path))
+        cfs("getattr", "/")
+        path = cfs.dump_stats()
+        assert os.path.dirname(path) == str(tmp_path)
+        with open(path) as f:
+            assert json.load(f)["ops"]["getattr"]["count"] == 1
+
+    def test_signals_blocked_before_init_are_watched(self, tmp_path):
+        (tmp_path / "disk0").mkdir()
+        cfs = Filesystem([str(tmp_path / "disk0")], "/cfsroot", stats_dir=str(tmp_path))
+        # as main() leaves them for the thread libfuse calls init on
+        blocked = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGUSR1})
+        try:
+            cfs.init("/")
+            # sent to the watcher itself, other threads of the test run don't block it
+            watcher = next(thread for thread in threading.enumerate() if thread.name == f"cinchfs-signal-{signal.SIGUSR1}")
+            signal.pthread_kill(watcher.ident, signal.SIGUSR1)
+            for _ in range(500):
+                if any(name.endswith("-stats.json") for name in os.listdir(tmp_path)):
+                    break
+                time.sleep(0.01)
+            assert any(name.endswith("-stats.json") for name in os.listdir(tmp_path))
+        finally:
+            cfs.destroy("/")
+            signal.pthread_sigmask(signal.SIG_SETMASK, blocked)
+
+    def test_virtual_files_are_read_only(self, fs):
+        fs.create_dir("/disk0")
+        cfs = Filesystem(["/disk0"], "/cfsroot")
+        with pytest.raises(OSError):
+            cfs("mkdir", "/.cinchfs/dir", 0o755)
+        with pytest.raises(OSError):
+            cfs("open", "/.cinchfs/stats", os.O_WRONLY)
+
+
+class TestMigration(object):
+
+    def sources(self, tmp_path):
+        sources = [str(tmp_path / "disk0"), str(tmp_path / "disk1")]
+        for source in sources:
+            os.mkdir(source)
+        return sources
+
+    def test_migrate_moves_entry_and_index(self, tmp_path):
+        sources = self.sources(tmp_path)
+        os.makedirs(os.path.join(sources[0], "dir", "sub"))
+        (tmp_path / "disk0" / "dir" / "sub" / "file").write_text("hello")
+        cfs = Filesystem(sources, "/cfsroot")
+        cfs("getattr", "/dir/sub/file")
+
+        cfs.migrate("dir", sources[1])
+        assert cfs._index["dir"] == sources[1]
+        assert not os.path.exists(os.path.join(sources[0], "dir"))
+        assert os.listdir(os.path.join(sources[0], ".cinchfs-moving")) == []
+        assert (tmp_path / "disk1" / "dir" / "sub" / "file").read_text() == "hello"
+        assert cfs("getattr", "/dir/sub/file")["st_size"] == 5
+
+    def test_open_files_follow_the_migration(self, tmp_path):
+        sources = self.sources(tmp_path)
+        (tmp_path / "disk0" / "file").write_text("hello")
+        cfs = Filesystem(sources, "/cfsroot")
+        fh = cfs("open", "/file", os.O_RDWR)
+        cfs("write", "/file", b"J", 0, fh)
+
+        cfs.migrate("file", sources[1])
+        cfs("write", "/file", b"ELLO", 1, fh)
+        cfs("release", "/file", fh)
+        assert (tmp_path / "disk1" / "file").read_text() == "JELLO"
+
+    def test_renamed_open_files_follow_their_new_name(self, tmp_path):
+        sources = self.sources(tmp_path)
+        os.mkdir(tmp_path / "disk0" / "a")
+        (tmp_path / "disk0" / "a" / "x").write_text("hello")
+        cfs = Filesystem(sources, "/cfsroot")
+        fh = cfs("open", "/a/x", os.O_RDWR)
+        cfs("rename", "/a/x", "/a/y")
+        new = cfs("create", "/a/x", 0o644)
+        cfs("write", "/a/x", b"other", 0, new)
+        cfs("release", "/a/x", new)
+
+        cfs.migrate("a", sources[1])
+        cfs("write", "/a/y", b"J", 0, fh)
+        cfs("release", "/a/y", fh)
+        assert (tmp_path / "disk1" / "a" / "y").read_text() == "Jello"
+        assert (tmp_path / "disk1" / "a" / "x").read_text() == "other"
+
+    def test_unlinked_open_files_do_not_follow_a_new_file(self, tmp_path):
+        sources = self.sources(tmp_path)
+        (tmp_path / "disk0" / "x").write_text("hello")
+        cfs = Filesystem(sources, "/cfsroot")
+        fh = cfs("open", "/x", os.O_RDWR)
+        cfs("unlink", "/x")
+        cfs("release", "/x", cfs("create", "/x", 0o644))
+
+        cfs.migrate("x", sources[1])
+        cfs("write", "/x", b"J", 0, fh)
+        assert cfs("read", "/x", 5, 0, fh) == b"Jello"
+        cfs("release", "/x", fh)
+        assert (tmp_path / "disk1" / "x").read_text() == ""
+
+    def test_writes_during_the_copy_are_copied_whatever_the_mtime(self, tmp_path, monkeypatch):
+        sources = self.sources(tmp_path)
+        (tmp_path / "disk0" / "file").write_text("hello")
+        cfs = Filesystem(sources, "/cfsroot")
+        fh = cfs("open", "/file", os.O_RDWR)
+        sync_tree = fusefs.sync_tree
+        passes = []
+
+        def first_pass_then_write(src, dst, **kwargs):
+            sync_tree(src, dst, **kwargs)
+            if not passes:
+                # a same-size write within the timestamp granularity of the disk
+                st = os.stat(src)
+                cfs("write", "/file", b"J", 0, fh)
+                os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns))
+            passes.append(src)
+        monkeypatch.setattr(fusefs, "sync_tree", first_pass_then_write)
+
+        cfs.migrate("file", sources[1])
+        cfs("release", "/file", fh)
+        assert len(passes) == 1
+        assert (tmp_path / "disk1" / "file").read_text() == "Jello"
+
+    def test_the_last_pass_only_looks_at_changed_paths(self, tmp_path, monkeypatch):
+        sources = self.sources(tmp_path)
+        os.makedirs(tmp_path / "disk0" / "dir" / "sub")
+        for name in ("a", "b", "sub/c"):
+            (tmp_path / "disk0" / "dir" / name).write_text("hello")
+        cfs = Filesystem(sources, "/cfsroot")
+        sync_tree = fusefs.sync_tree
+        sync_entry = fusefs._sync_entry
+        looked_at = []
+        mtimes = []
+
+        def first_pass_then_write(src, dst, **kwargs):
+            sync_tree(src, dst, **kwargs)
+            fh = cfs("open", "/dir/a", os.O_WRONLY)
+            cfs("write", "/dir/a", b"J", 0, fh)
+            cfs("release", "/dir/a", fh)
+            cfs("unlink", "/dir/sub/c")
+            mtimes.append(os.stat(tmp_path / "disk0" / "dir" / "sub").st_mtime_ns)
+            monkeypatch.setattr(fusefs, "_sync_entry", lambda src, *args, **kwargs: looked_at.append(src) or sync_entry(src, *args, **kwargs))
+        monkeypatch.setattr(fusefs, "sync_tree", first_pass_then_write)
+
+        cfs.migrate("dir", sources[1])
+        assert looked_at == [str(tmp_path / "disk0" / "dir" / "a")]
+        assert (tmp_path / "disk1" / "dir" / "a").read_text() == "Jello"
+        assert os.listdir(tmp_path / "disk1" / "dir" / "sub") == []
+        assert os.stat(tmp_path / "disk1" / "dir" / "sub").st_mtime_ns == mtimes[0]
+
+    def test_ops_wait_for_the_switch(self, tmp_path, monkeypatch):
+        sources = self.sources(tmp_path)
+        (tmp_path / "disk0" / "file").write_text("hello")
+        cfs = Filesystem(sources, "/cfsroot")
+        sync = cfs._durability.sync
+        order = []
+
+        def slow_sync():
+            # the write below arrives while the entry is switching
+            order.append("switching")
+            time.sleep(0.1)
+            sync()
+        monkeypatch.setattr(cfs._durability, "sync", slow_sync)
+
+        with ThreadPoolExecutor() as executor:
+            migration = executor.submit(cfs.migrate, "file", sources[1])
+            while not order:
+                time.sleep(0.01)
+            fh = cfs("open", "/file", os.O_WRONLY)
+            cfs("write", "/file", b"J", 0, fh)
+            cfs("release", "/file", fh)
+            migration.result()
+        assert (tmp_path / "disk1" / "file").read_text() == "Jello"
+
+    def test_control_file_requests_migrations(self, tmp_path):
+        sources = self.sources(tmp_path)
+        (tmp_path / "disk0" / "my file").write_text("hello")
+        cfs = Filesystem(sources, "/cfsroot")
+        fh = cfs("open", "/.cinchfs/control", os.O_WRONLY)
+        cfs("write", "/.cinchfs/control", f"migrate 'my file' {sources[1]}\n".encode(), 0, fh)
+        with pytest.raises(OSError):
+            cfs("write", "/.cinchfs/control", b"migrate missing /nowhere\n", 0, fh)
+        cfs("release", "/.cinchfs/control", fh)
+        cfs._migrations.wait()
+
+        fh = cfs("open", "/.cinchfs/migrations", os.O_RDONLY)
+        status = json.loads(cfs("read", "/.cinchfs/migrations", 4096, 0, fh))
+        assert status == [{"entry": "my file", "to": sources[1], "state": "done"}]
+        assert cfs._index["my file"] == sources[1]
+        cfs.destroy("/")
+
+
+class TestFastTier(object):
+
+    def test_hot_files_are_served_from_the_fast_tier(self, tmp_path):
+        os.makedirs(tmp_path / "disk0")
+        os.makedirs(tmp_path / "ssd")
+        (tmp_path / "disk0" / "file").write_text("hello")
+        cfs = Filesystem([str(tmp_path / "disk0")], "/cfsroot", fast_tier=[str(tmp_path / "ssd")], promote_after=1)
+        fh = cfs("open", "/file", os.O_RDONLY)
+        cfs("read", "/file", 5, 0, fh)
+        cfs("release", "/file", fh)
+        cfs._tier.wait()
+
+        fh = cfs("open", "/file", os.O_RDONLY)
+        fd = cfs._handles.get(fh).fd
+        assert cfs._handles.get(fh).source == str(tmp_path / "ssd")
+        assert cfs("read", "/file", 5, 0, fh) == b"hello"
+        assert cfs.stats()["fast_tier"]["hits"] == 1
+
+        # a writer sends the reader back to the original, on the fd number it had
+        wfh = cfs("open", "/file", os.O_WRONLY)
+        cfs("write", "/file", b"J", 0, wfh)
+        cfs("release", "/file", wfh)
+        assert cfs._handles.get(fh).source == str(tmp_path / "disk0")
+        assert cfs._handles.get(fh).fd == fd
+        assert cfs("read", "/file", 5, 0, fh) == b"Jello"
+        cfs("release", "/file", fh)
+        cfs.destroy("/")
+
+    def test_no_copies_while_the_file_is_open_for_writing(self, tmp_path):
+        os.makedirs(tmp_path / "disk0")
+        os.makedirs(tmp_path / "ssd")
+        (tmp_path / "disk0" / "file").write_text("hello")
+        cfs = Filesystem([str(tmp_path / "disk0")], "/cfsroot", fast_tier=[str(tmp_path / "ssd")], promote_after=1)
+        wfh = cfs("open", "/file", os.O_RDWR)
+        fh = cfs("open", "/file", os.O_RDONLY)
+        cfs("read", "/file", 5, 0, fh)
+        cfs("release", "/file", fh)
+        cfs._tier.wait()
+        assert cfs.stats()["fast_tier"]["promotions"] == 0
+
+        cfs("write", "/file", b"J", 0, wfh)
+        cfs("release", "/file", wfh)
+        fh = cfs("open", "/file", os.O_RDONLY)
+        assert cfs("read", "/file", 5, 0, fh) == b"Jello"
+        cfs("release", "/file", fh)
+        cfs.destroy("/")
+
+    def test_first_write_drops_a_copy_made_while_opened_for_writing(self, tmp_path):
+        os.makedirs(tmp_path / "disk0")
+        os.makedirs(tmp_path / "ssd")
+        (tmp_path / "disk0" / "file").write_text("hello")
+        cfs = Filesystem([str(tmp_path / "disk0")], "/cfsroot", fast_tier=[str(tmp_path / "ssd")], promote_after=1)
+        wfh = cfs("open", "/file", os.O_RDWR)
+        # promoted by hand, as a promotion finishing just after the open would
+        cfs._tier.read("/file", str(tmp_path / "disk0" / "file"))
+        cfs._tier.wait()
+        assert cfs.stats()["fast_tier"]["copies"] == 1
+        cfs("write", "/file", b"J", 0, wfh)
+        assert cfs.stats()["fast_tier"]["copies"] == 0
+        cfs("release", "/file", wfh)
+        cfs.destroy("/")
+
+
+class TestLanding(object):
+
+    def filesystem(self, tmp_path):
+        for name in ("disk0", "ssd"):
+            os.makedirs(tmp_path / name, exist_ok=True)
+        os.makedirs(tmp_path / "disk0" / "dir", exist_ok=True)
+        return Filesystem([str(tmp_path / "disk0")], "/cfsroot", landing=str(tmp_path / "ssd"), landing_idle=0)
+
+    def write(self, cfs, path, data):
+        fh = cfs("create", path, 0o644)
+        cfs("write", path, data, 0, fh)
+        cfs("release", path, fh)
+
+    def test_new_files_land_and_are_destaged(self, tmp_path):
+        cfs = self.filesystem(tmp_path)
+        self.write(cfs, "/dir/file", b"hello")
+        self.write(cfs, "/top", b"top")
+        assert not os.path.exists(tmp_path / "disk0" / "dir" / "file")
+        assert "file" in list(cfs("readdir", "/dir", None))
+        assert "top" in list(cfs("readdir", "/", None))
+        assert cfs("getattr", "/dir/file")["st_size"] == 5
+
+        assert cfs._landing.destage_idle() == 2
+        assert (tmp_path / "disk0" / "dir" / "file").read_text() == "hello"
+        assert cfs._index["top"] == str(tmp_path / "disk0")
+        assert cfs._landing.paths() == {}
+        assert os.listdir(tmp_path / "ssd" / ".cinchfs-landing") == ["landed.log"]
+
+    def test_open_files_are_not_destaged(self, tmp_path):
+        cfs = self.filesystem(tmp_path)
+        fh = cfs("create", "/dir/file", 0o644)
+        assert cfs._landing.destage_idle() == 0
+        cfs("release", "/dir/file", fh)
+        assert cfs._landing.destage_idle() == 1
+
+    def test_rename_and_unlink_landed_files(self, tmp_path):
+        cfs = self.filesystem(tmp_path)
+        (tmp_path / "disk0" / "dir" / "existing").write_text("old")
+        self.write(cfs, "/dir/file", b"new")
+        cfs("rename", "/dir/file", "/dir/existing")
+        assert not os.path.exists(tmp_path / "disk0" / "dir" / "existing")
+        fh = cfs("open", "/dir/existing", os.O_RDONLY)
+        assert cfs("read", "/dir/existing", 3, 0, fh) == b"new"
+        cfs("release", "/dir/existing", fh)
+
+        with pytest.raises(OSError):
+            cfs("rmdir", "/dir")
+        cfs("unlink", "/dir/existing")
+        assert cfs._landing.paths() == {}
+        cfs("rmdir", "/dir")
+
+    def test_landed_files_are_linked_once_destaged(self, tmp_path):
+        cfs = self.filesystem(tmp_path)
+        self.write(cfs, "/dir/file", b"hello")
+        with pytest.raises(OSError) as e:
+            cfs("link", "/dir/link", "/dir/file")
+        assert e.value.errno == errno.EXDEV
+        assert not os.path.exists(tmp_path / "disk0" / "dir" / "link")
+
+        cfs._landing.destage_idle()
+        cfs("link", "/dir/link", "/dir/file")
+        assert os.stat(tmp_path / "disk0" / "dir" / "link").st_nlink == 2
+
+    def test_landed_files_survive_a_remount(self, tmp_path):
+        cfs = self.filesystem(tmp_path)
+        self.write(cfs, "/dir/file", b"hello")
+        cfs.destroy("/")
+        cfs = self.filesystem(tmp_path)
+        assert cfs("getattr", "/dir/file")["st_size"] == 5
+
+
+class TestCrossSourceRename(object):
+
+    def filesystem(self, tmp_path):
+        sources = [str(tmp_path / "disk0"), str(tmp_path / "disk1")]
+        os.makedirs(tmp_path / "disk0" / "src" / "dir")
+        (tmp_path / "disk0" / "src" / "dir" / "file").write_text("hello")
+        os.makedirs(tmp_path / "disk1" / "dst")
+        return Filesystem(sources, "/cfsroot")
+
+    def test_directories_are_moved_between_sources(self, tmp_path):
+        cfs = self.filesystem(tmp_path)
+        cfs("rename", "/src/dir", "/dst/dir")
+        assert not os.path.exists(tmp_path / "disk0" / "src" / "dir")
+        assert (tmp_path / "disk1" / "dst" / "dir" / "file").read_text() == "hello"
+        assert os.listdir(tmp_path / "disk1" / ".cinchfs-moving") == []
+
+    def test_open_files_follow_the_rename(self, tmp_path):
+        cfs = self.filesystem(tmp_path)
+        fh = cfs("open", "/src/dir/file", os.O_WRONLY)
+        cfs("rename", "/src/dir/file", "/dst/file")
+        cfs("write", "/dst/file", b"J", 0, fh)
+        cfs("release", "/dst/file", fh)
+        assert (tmp_path / "disk1" / "dst" / "file").read_text() == "Jello"
+
+    def test_writes_during_the_copy_are_carried_over(self, tmp_path, monkeypatch):
+        cfs = self.filesystem(tmp_path)
+        fh = cfs("open", "/src/dir/file", os.O_RDWR)
+        sync_tree = fusefs.sync_tree
+
+        def copy_then_write(src, dst, **kwargs):
+            sync_tree(src, dst, **kwargs)
+            if kwargs.get("vanishing"):
+                # the first pass, done while the entry stays in use
+                cfs("write", "/src/dir/file", b"J", 0, fh)
+        monkeypatch.setattr(fusefs, "sync_tree", copy_then_write)
+
+        cfs("rename", "/src/dir", "/dst/dir")
+        cfs("release", "/dst/dir/file", fh)
+        assert (tmp_path / "disk1" / "dst" / "dir" / "file").read_text() == "Jello"
+        assert os.listdir(tmp_path / "disk0" / ".cinchfs-moving") == []
+
+    def test_large_trees_are_left_to_the_caller_with_a_limit(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(fusefs, "USE_REFLINK", False)
+        cfs = self.filesystem(tmp_path)
+        cfs.rename_copy_limit = 2
+        with pytest.raises(OSError) as e:
+            cfs("rename", "/src/dir", "/dst/dir")
+        assert e.value.errno == errno.EXDEV
+        assert os.path.exists(tmp_path / "disk0" / "src" / "dir" / "file")
+        assert not os.path.exists(tmp_path / "disk1" / "dst" / "dir")
+
+    def test_replacing_fails_like_rename(self, tmp_path):
+        cfs = self.filesystem(tmp_path)
+        os.makedirs(tmp_path / "disk1" / "dst" / "full" / "child")
+        with pytest.raises(OSError):
+            cfs("rename", "/src/dir", "/dst/full")
+        assert os.path.exists(tmp_path / "disk0" / "src" / "dir" / "file")
 
+    def test_new_top_level_entries_stay_on_their_source(self, tmp_path, monkeypatch):
+        cfs = self.filesystem(tmp_path)
+        monkeypatch.setattr(cfs, "_choose_source", lambda: str(tmp_path / "disk1"))
+        cfs("rename", "/src", "/renamed")
+        assert cfs._index["renamed"] == str(tmp_path / "disk0")
+        assert os.path.exists(tmp_path / "disk0" / "renamed" / "dir" / "file")
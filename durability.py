@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import os
+import logging
+import threading
+import fusefs as fs
+
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class StrictDurability():
+    '''Sync on every flush, so every close() waits for the disk'''
+
+    def written(self, handle):
+        pass
+
+    def flush(self, handle):
+        return fs.flush(handle.real_path, handle.fd)
+
+    def fsync(self, handle, fdatasync):
+        return fs.flush(handle.real_path, handle.fd)
+
+    def release(self, handle):
+        return fs.release(handle.real_path, handle.fd)
+
+    def sync(self):
+        '''Get everything written so far onto the disks'''
+        pass
+
+    def close(self):
+        pass
+
+
+class OnDemandDurability(StrictDurability):
+    '''Only sync when an application asks for it with fsync()'''
+
+    def flush(self, handle):
+        pass
+
+    def fsync(self, handle, fdatasync):
+        return fs.fsync(handle.real_path, fdatasync, handle.fd)
+
+
+class BatchedDurability(OnDemandDurability):
+    '''Sync dirty files on a timer, grouped per source so the sources sync in parallel.
+
+    Released files that are still dirty stay open until they have been synced.'''
+
+    def __init__(self, sync_interval):
+        self.sync_interval = sync_interval
+        self._dirty = {}
+        self._syncing = set()
+        self._orphans = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._timer = None
+        self._executor = None
+
+    def written(self, handle):
+        with self._lock:
+            self._dirty.setdefault(handle.source, set()).add(handle.fd)
+            if self._timer is None:
+                self._executor = ThreadPoolExecutor(thread_name_prefix='cinchfs-sync')
+                self._timer = threading.Thread(target=self._sync_loop, name='cinchfs-sync-timer', daemon=True)
+                self._timer.start()
+
+    def release(self, handle):
+        with self._lock:
+            if self._is_dirty(handle.fd):
+                # closed once the pending sync has happened
+                self._orphans.add(handle.fd)
+                return
+        return fs.release(handle.real_path, handle.fd)
+
+    def sync(self):
+        with self._lock:
+            batch, self._dirty = self._dirty, {}
+            for fds in batch.values():
+                self._syncing.update(fds)
+        if self._executor is None:
+            return
+        for _ in self._executor.map(self._sync_source, batch.items()):
+            pass
+
+    def close(self):
+        self._stop.set()
+        self.sync()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def _sync_loop(self):
+        while not self._stop.wait(self.sync_interval):
+            self.sync()
+
+    def _sync_source(self, item):
+        source, fds = item
+        for fd in fds:
+            try:
+                os.fdatasync(fd)
+            except OSError:
+                log.exception("Background sync failed on %s", source)
+            with self._lock:
+                self._syncing.discard(fd)
+                if fd in self._orphans and not self._is_dirty(fd):
+                    self._orphans.discard(fd)
+                    os.close(fd)
+
+    def _is_dirty(self, fd):
+        return fd in self._syncing or any(fd in fds for fds in self._dirty.values())
+
+
+def make_durability(mode, sync_interval):
+    if mode == 'strict':
+        return StrictDurability()
+    if mode == 'fsync':
+        return OnDemandDurability()
+    if mode == 'batched':
+        return BatchedDurability(sync_interval)
+    raise ValueError(f"Unknown durability mode {mode}")
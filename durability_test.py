@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import os
+import pytest
+from durability import BatchedDurability, OnDemandDurability, StrictDurability, make_durability
+from handles import FileHandle
+
+
+@pytest.fixture
+def syncs(monkeypatch):
+    calls = []
+    monkeypatch.setattr(os, "fsync", lambda fd: calls.append(("fsync", fd)))
+    monkeypatch.setattr(os, "fdatasync", lambda fd: calls.append(("fdatasync", fd)))
+    return calls
+
+
+def open_handle(tmp_path, name="test"):
+    path = str(tmp_path / name)
+    return FileHandle(os.open(path, os.O_WRONLY | os.O_CREAT), "/" + name, path, str(tmp_path))
+
+
+class TestDurability(object):
+
+    def test_strict_syncs_on_flush(self, tmp_path, syncs):
+        handle = open_handle(tmp_path)
+        StrictDurability().flush(handle)
+        assert syncs == [("fsync", handle.fd)]
+        os.close(handle.fd)
+
+    def test_on_demand_flush_does_not_sync(self, tmp_path, syncs):
+        handle = open_handle(tmp_path)
+        durability = OnDemandDurability()
+        durability.flush(handle)
+        assert syncs == []
+        durability.fsync(handle, 1)
+        assert syncs == [("fdatasync", handle.fd)]
+        os.close(handle.fd)
+
+    def test_batched_syncs_dirty_handles_on_close(self, tmp_path, syncs):
+        handle = open_handle(tmp_path)
+        durability = BatchedDurability(sync_interval=3600)
+        durability.written(handle)
+        durability.flush(handle)
+        assert syncs == []
+        durability.close()
+        assert syncs == [("fdatasync", handle.fd)]
+        os.close(handle.fd)
+
+    def test_batched_release_keeps_dirty_fd_open_until_synced(self, tmp_path, syncs):
+        handle = open_handle(tmp_path)
+        durability = BatchedDurability(sync_interval=3600)
+        durability.written(handle)
+        durability.release(handle)
+        os.fstat(handle.fd)  # still open
+        durability.close()
+        with pytest.raises(OSError):
+            os.fstat(handle.fd)
+
+    def test_unknown_mode_fails(self):
+        with pytest.raises(ValueError):
+            make_durability("sometimes", 1.0)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import time
+import logging
+import threading
+import fusefs as fs
+
+log = logging.getLogger(__name__)
+
+
+class FreeSpaceCache():
+    '''Recent statfs samples of every source, shared by placement and the root statfs.
+
+    Stale samples are refreshed in the background while the old values keep
+    being served. Sources are sampled concurrently and a source that does not
+    answer within the timeout keeps its previous sample. A passive cache only
+    samples every source once and afterwards only refreshes on request.'''
+
+    def __init__(self, sources, ttl=5.0, timeout=2.0, sample=fs.statfs, passive=False):
+        self.sources = sources
+        self.ttl = ttl
+        self.passive = passive
+        self.timeout = timeout
+        self._sample = sample
+        self._samples = {}
+        self._sampled_at = None
+        self._inflight = set()
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get(self, source):
+        '''The latest sample for source, or None if it has never answered'''
+        self._ensure_fresh()
+        return self._samples.get(source)
+
+    def samples(self):
+        self._ensure_fresh()
+        return [self._samples[source] for source in self.sources if source in self._samples]
+
+    def consume(self, source, nbytes):
+        '''Optimistically account for bytes written since the last sample'''
+        with self._lock:
+            stv = self._samples.get(source)
+            if stv is None:
+                return
+            blocks = -(-nbytes // (stv['f_frsize'] or 1))
+            stv = dict(stv)
+            stv['f_bfree'] = max(0, stv['f_bfree'] - blocks)
+            stv['f_bavail'] = max(0, stv['f_bavail'] - blocks)
+            self._samples[source] = stv
+
+    def refresh(self):
+        self._refresh(self.sources)
+        self._sampled_at = time.monotonic()
+
+    def refresh_source(self, source):
+        self._refresh([source])
+
+    def _refresh(self, sources):
+        workers = []
+        with self._lock:
+            for source in sources:
+                if source in self._inflight:
+                    # still hung from an earlier refresh
+                    continue
+                self._inflight.add(source)
+                workers.append(threading.Thread(target=self._sample_source, args=(source,),
+                                                name='cinchfs-statfs', daemon=True))
+        for worker in workers:
+            worker.start()
+        deadline = time.monotonic() + self.timeout
+        for worker in workers:
+            worker.join(max(0, deadline - time.monotonic()))
+
+    def _ensure_fresh(self):
+        if self._sampled_at is None:
+            self.refresh()
+        elif not self.passive and time.monotonic() - self._sampled_at >= self.ttl:
+            with self._lock:
+                if self._refreshing:
+                    return
+                self._refreshing = True
+            threading.Thread(target=self._background_refresh, name='cinchfs-statfs-refresh', daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        finally:
+            self._refreshing = False
+
+    def _sample_source(self, source):
+        try:
+            stv = self._sample(source)
+            with self._lock:
+                self._samples[source] = stv
+        except OSError:
+            log.warning("Could not sample free space of %s", source, exc_info=True)
+        finally:
+            with self._lock:
+                self._inflight.discard(source)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import threading
+from freespace import FreeSpaceCache
+
+
+def sampler(samples, calls=None):
+    def sample(source):
+        if calls is not None:
+            calls.append(source)
+        return dict(samples[source])
+    return sample
+
+
+def stv(bfree, frsize=100):
+    return {'f_bfree': bfree, 'f_bavail': bfree, 'f_frsize': frsize}
+
+
+class TestFreeSpaceCache(object):
+
+    def test_samples_are_cached_within_ttl(self):
+        calls = []
+        cache = FreeSpaceCache(["/disk0", "/disk1"], ttl=3600, sample=sampler({"/disk0": stv(5), "/disk1": stv(7)}, calls))
+        assert cache.get("/disk0")['f_bfree'] == 5
+        assert cache.get("/disk1")['f_bfree'] == 7
+        assert len(cache.samples()) == 2
+        assert sorted(calls) == ["/disk0", "/disk1"]
+
+    def test_consume_adjusts_optimistically(self):
+        cache = FreeSpaceCache(["/disk0"], ttl=3600, sample=sampler({"/disk0": stv(5)}))
+        cache.get("/disk0")
+        cache.consume("/disk0", 150)
+        assert cache.get("/disk0")['f_bfree'] == 3
+        assert cache.get("/disk0")['f_bavail'] == 3
+
+    def test_hung_source_does_not_block(self):
+        hang = threading.Event()
+
+        def sample(source):
+            if source == "/disk1":
+                hang.wait()
+            return stv(5)
+
+        cache = FreeSpaceCache(["/disk0", "/disk1"], ttl=3600, timeout=0.05, sample=sample)
+        assert cache.get("/disk0")['f_bfree'] == 5
+        assert cache.get("/disk1") is None
+        cache.refresh()  # the hung source is not queried again
+        assert cache._inflight == {"/disk1"}
+        hang.set()
+
+    def test_stale_samples_refresh_in_background(self):
+        release = threading.Event()
+        samples = [stv(5), stv(9)]
+
+        def sample(source):
+            if len(samples) == 1:
+                release.wait()
+            return samples.pop(0)
+
+        cache = FreeSpaceCache(["/disk0"], ttl=0, sample=sample)
+        assert cache.get("/disk0")['f_bfree'] == 5
+        assert cache.get("/disk0")['f_bfree'] == 5  # served stale while refreshing
+        release.set()
+        for thread in threading.enumerate():
+            if thread.name == 'cinchfs-statfs-refresh':
+                thread.join()
+        assert cache._samples["/disk0"]['f_bfree'] == 9
+
+    def test_passive_cache_only_refreshes_on_request(self):
+        calls = []
+        cache = FreeSpaceCache(["/disk0", "/disk1"], ttl=0, sample=sampler({"/disk0": stv(5), "/disk1": stv(7)}, calls), passive=True)
+        cache.get("/disk0")
+        cache.get("/disk1")
+        cache.refresh_source("/disk1")
+        assert sorted(calls) == ["/disk0", "/disk1", "/disk1"]
@@ -1,10 +1,62 @@
 #!/usr/bin/env python3
 
 import os
+import stat
+import fcntl
 import errno
+import shutil
+import threading
 
+from collections import OrderedDict
 from fuse import FuseOSError
 
+# vectored reads and writes are split into iovecs of this size
+VECTORED_CHUNK = 128 * 1024
+# copies between sources hand the kernel this much at a time
+COPY_CHUNK = 8 * 1024 * 1024
+# ioctl that shares the extents of a file on filesystems like btrfs and xfs
+FICLONE = 0x40049409
+# the kernel can't copy between these two files this way, try the next one
+COPY_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+# the ways of copying inside the kernel that are tried before reading and writing
+USE_REFLINK = True
+USE_COPY_FILE_RANGE = hasattr(os, 'copy_file_range')
+USE_SENDFILE = hasattr(os, 'sendfile')
+
+
+class FdPool():
+    '''A small LRU of read-only fds keyed by real path, used when read is given a bad fh'''
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self._fds = OrderedDict()
+        self._lock = threading.Lock()
+
+    def pread(self, path, length, offset):
+        # reads hold the lock so an fd can't be evicted and reused underneath them
+        with self._lock:
+            fd = self._fds.pop(path, None)
+            if fd is None:
+                fd = os.open(path, os.O_RDONLY)
+                while len(self._fds) >= self.maxsize:
+                    os.close(self._fds.popitem(last=False)[1])
+            self._fds[path] = fd
+            return os.pread(fd, length, offset)
+
+    def discard(self, path):
+        '''Forget fds for path and anything below it, they no longer refer to the same file'''
+        prefix = path.rstrip('/') + '/'
+        with self._lock:
+            for key in [key for key in self._fds if key == path or key.startswith(prefix)]:
+                os.close(self._fds.pop(key))
+
+    def clear(self):
+        with self._lock:
+            while self._fds:
+                os.close(self._fds.popitem()[1])
+
+
+fallback_fds = FdPool()
+
 def access(path, mode):
     '''Check file access permissions. This will be called for the access() system call. 
     If the 'default_permissions' mount option is given, this method is not called.'''
@@ -21,17 +73,30 @@ def chown(path, uid, gid):
 
 def getfileattr(path, fh=None):
     '''Get file attributes'''
-    st = os.lstat(path)
+    st = os.lstat(path) if fh is None else os.fstat(fh)
+    return stat_attrs(st)
+
+def stat_attrs(st):
     return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime', 'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid', 'st_blocks'))
 
 def readdir(path, fh):
-    '''Read directory'''
-    dirents = ['.', '..']
+    '''Read directory, passing along the attributes of every entry'''
+    yield '.'
+    yield '..'
     if os.path.isdir(path):
-        dirents.extend(os.listdir(path))
+        for name, attrs in scandir(path):
+            yield name, attrs, 0
 
-    for r in dirents:
-        yield r
+def scandir(path):
+    '''Stream (name, attributes) pairs for the entries of a directory'''
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                # removed while listing
+                continue
+            yield entry.name, stat_attrs(st)
 
 def readlink(path):
     '''Read the target of a symbolic link'''
@@ -53,12 +118,15 @@ def statfs(path):
     return dict((key, getattr(stv, key)) for key in ('f_bavail', 'f_bfree', 'f_blocks', 'f_bsize', 'f_favail', 'f_ffree', 'f_files', 'f_flag', 'f_frsize', 'f_namemax'))
 
 def unlink(path):
+    fallback_fds.discard(path)
     return os.unlink(path)
 
 def symlink(source, target):
     return os.symlink(target, source)
 
 def rename(old, new):
+    fallback_fds.discard(old)
+    fallback_fds.discard(new)
     return os.rename(old, new)
 
 def link(source, target):
@@ -73,27 +141,39 @@ def openFile(path, flags):
 def create(path, mode, fi=None):
     return os.open(path, os.O_WRONLY | os.O_CREAT, mode)
 
-def read(path, length, offset, fh):
+def read(path, length, offset, fh, vectored=False):
+    if fh is None:
+        return fallback_fds.pread(path, length, offset)
     try:
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.read(fh, length)
-    except Exception:
+        if vectored and length > VECTORED_CHUNK:
+            return _preadv(fh, length, offset)
+        return os.pread(fh, length, offset)
+    except OSError as e:
+        if e.errno != errno.EBADF:
+            raise
         # sometimes read receives a bad fh
         # this seems like a fuse bug
-        fh = os.open(path, os.O_RDONLY)
-        os.lseek(fh, offset, os.SEEK_SET)
-        res = os.read(fh, length)
-        os.close(fh)
-        return res
+        return fallback_fds.pread(path, length, offset)
+
+def write(path, buf, offset, fh, vectored=False):
+    if vectored and len(buf) > VECTORED_CHUNK:
+        return os.pwritev(fh, _chunks(memoryview(buf)), offset)
+    return os.pwrite(fh, buf, offset)
 
-def write(path, buf, offset, fh):
-    os.lseek(fh, offset, os.SEEK_SET)
-    return os.write(fh, buf)
+def _preadv(fh, length, offset):
+    buf = bytearray(length)
+    count = os.preadv(fh, _chunks(memoryview(buf)), offset)
+    del buf[count:]
+    return bytes(buf)
+
+def _chunks(view):
+    return [view[i:i + VECTORED_CHUNK] for i in range(0, len(view), VECTORED_CHUNK)]
 
 def truncate(path, length, fh=None):
     '''Change the size of a file'''
-    with open(path, 'r+') as f:
-        f.truncate(length)
+    if fh is None:
+        return os.truncate(path, length)
+    return os.ftruncate(fh, length)
 
 def flush(path, fh):
     '''Possibly flush cached data'''
@@ -105,4 +185,211 @@ def release(path, fh):
 
 def fsync(path, fdatasync, fh):
     '''Synchronize file contents'''
-    return flush(path, fh)
+    if fdatasync:
+        return os.fdatasync(fh)
+    return os.fsync(fh)
+
+def copy_data(fd_in, fd_out, paced=None):
+    '''Copy from the current offset of fd_in to the end, keeping the data in the kernel where possible.
+
+    paced(nbytes) is called after every chunk, it may sleep to limit the rate.'''
+    paced = paced or (lambda nbytes: None)
+    for copy in (_copy_file_range, _sendfile):
+        copied = copy(fd_in, fd_out, paced)
+        if copied is not None:
+            return copied
+    copied = 0
+    while True:
+        buf = os.read(fd_in, COPY_CHUNK)
+        if not buf:
+            return copied
+        copied += os.write(fd_out, buf)
+        paced(len(buf))
+
+def _copy_file_range(fd_in, fd_out, paced):
+    if not USE_COPY_FILE_RANGE:
+        return None
+    return _copy_with(lambda: os.copy_file_range(fd_in, fd_out, COPY_CHUNK), paced)
+
+def _sendfile(fd_in, fd_out, paced):
+    if not USE_SENDFILE:
+        return None
+    return _copy_with(lambda: os.sendfile(fd_out, fd_in, None, COPY_CHUNK), paced)
+
+def _copy_with(copy, paced):
+    # None when not even the first chunk could be copied this way
+    copied = 0
+    while True:
+        try:
+            n = copy()
+        except OSError as e:
+            if copied == 0 and e.errno in COPY_UNSUPPORTED:
+                return None
+            raise
+        if not n:
+            return copied
+        copied += n
+        paced(n)
+
+def copy_file(src, dst, paced=None):
+    '''Copy a regular file with its metadata, the copy is synced before returning.
+
+    Its entry in the directory is not, renaming it into place must be followed by fsync_dir.'''
+    fd_in = os.open(src, os.O_RDONLY)
+    try:
+        fd_out = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            if not _reflink(fd_in, fd_out):
+                copy_data(fd_in, fd_out, paced)
+            os.fsync(fd_out)
+        finally:
+            os.close(fd_out)
+    finally:
+        os.close(fd_in)
+    _copy_metadata(src, dst)
+
+def _reflink(fd_in, fd_out):
+    # only possible when both files are on the same filesystem
+    if not USE_REFLINK:
+        return False
+    try:
+        fcntl.ioctl(fd_out, FICLONE, fd_in)
+        return True
+    except OSError:
+        return False
+
+def sync_tree(src, dst, vanishing=False, parallel_map=map, paced=None):
+    '''Make dst a copy of the file, link or directory tree src, only copying files whose size or mtime differ.
+
+    The files are copied with parallel_map, and paced(nbytes) may limit the
+    rate of every copy. With vanishing, entries removed from src while it is
+    walked are skipped, for copying a tree that is still in use. Hard links
+    are not preserved.'''
+    dirs = []
+    files = []
+    _sync_entry(src, dst, vanishing, None, dirs, files)
+    _sync_contents(dirs, files, vanishing, parallel_map, paced)
+
+def sync_paths(src, dst, paths, parallel_map=map, paced=None):
+    '''Bring paths of dst up to date with src, after sync_tree made dst a copy of it.
+
+    paths are relative to src and dst, the empty path is src itself and a
+    path ending in / stands for its whole tree. Files among them are copied
+    whatever their size and mtime say, nothing else of src is looked at but
+    the directories holding them.'''
+    dirs = []
+    files = []
+    parents = set()
+    trees = []
+    for path in sorted(paths):
+        if any(tree == '/' or path.startswith(tree) for tree in trees):
+            continue
+        name = path.rstrip('/')
+        src_path = os.path.join(src, name) if name else src
+        dst_path = os.path.join(dst, name) if name else dst
+        while name:
+            name = os.path.dirname(name)
+            parents.add(name)
+        if not os.path.lexists(src_path):
+            if os.path.lexists(dst_path):
+                remove_tree(dst_path)
+        elif path.endswith('/'):
+            trees.append(path)
+            _sync_entry(src_path, dst_path, False, _always, dirs, files)
+        else:
+            _sync_entry(src_path, dst_path, False, _always, dirs, files, recursive=False)
+    for name in parents:
+        src_dir, dst_dir = (os.path.join(src, name), os.path.join(dst, name)) if name else (src, dst)
+        if os.path.isdir(src_dir) and os.path.isdir(dst_dir):
+            dirs.append((src_dir, dst_dir))
+    _sync_contents(dirs, files, False, parallel_map, paced)
+
+def _sync_contents(dirs, files, vanishing, parallel_map, paced):
+    for _ in parallel_map(lambda pair: _sync_file(*pair, vanishing, paced), files):
+        pass
+    # deepest first, creating the children changed the mtime of a directory
+    for src_dir, dst_dir in sorted(set(dirs), key=lambda pair: pair[1].count('/'), reverse=True):
+        try:
+            _copy_metadata(src_dir, dst_dir)
+        except FileNotFoundError:
+            if not vanishing:
+                raise
+        fsync_dir(dst_dir)
+
+def _always(path):
+    return True
+
+def fsync_dir(path):
+    '''Make the entries of a directory durable, like files created or renamed into it'''
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _sync_entry(src, dst, vanishing, changed, dirs, files, recursive=True):
+    # regular files and directories are left to _sync_contents, the rest is synced at once
+    # changed(path) tells of files that must be copied whatever their size and mtime say
+    try:
+        st = os.lstat(src)
+        try:
+            dst_st = os.lstat(dst)
+        except FileNotFoundError:
+            dst_st = None
+        if dst_st is not None and stat.S_IFMT(dst_st.st_mode) != stat.S_IFMT(st.st_mode):
+            remove_tree(dst)
+            dst_st = None
+
+        if stat.S_ISDIR(st.st_mode):
+            if dst_st is None:
+                os.mkdir(dst, 0o700)
+            dirs.append((src, dst))
+            if not recursive:
+                return
+            names = os.listdir(src)
+            for name in set(os.listdir(dst)) - set(names):
+                remove_tree(os.path.join(dst, name))
+            for name in names:
+                _sync_entry(os.path.join(src, name), os.path.join(dst, name), vanishing, changed, dirs, files)
+            return
+        elif stat.S_ISLNK(st.st_mode):
+            target = os.readlink(src)
+            if dst_st is not None and os.readlink(dst) != target:
+                os.unlink(dst)
+                dst_st = None
+            if dst_st is None:
+                os.symlink(target, dst)
+        elif stat.S_ISREG(st.st_mode):
+            if (dst_st is None or dst_st.st_size != st.st_size or dst_st.st_mtime_ns != st.st_mtime_ns
+                    or changed is not None and changed(src)):
+                files.append((src, dst))
+            return
+        elif dst_st is None:
+            os.mknod(dst, st.st_mode, st.st_rdev)
+        _copy_metadata(src, dst)
+    except FileNotFoundError:
+        if not vanishing:
+            raise
+
+def _sync_file(src, dst, vanishing, paced):
+    try:
+        copy_file(src, dst, paced)
+    except FileNotFoundError:
+        if not vanishing:
+            raise
+
+def _copy_metadata(src, dst):
+    # chown clears the setuid and setgid bits, the mode is copied after it
+    st = os.lstat(src)
+    try:
+        os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    except PermissionError:
+        pass
+    shutil.copystat(src, dst, follow_symlinks=False)
+
+def remove_tree(path):
+    '''Remove a file, link or whole directory tree'''
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
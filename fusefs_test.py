@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import os
+import pytest
+import fusefs
+from fusefs import FdPool
+
+
+class TestReadWrite(object):
+
+    def test_write_then_read_positional(self, tmp_path):
+        path = str(tmp_path / "test")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        assert fusefs.write(path, b"hello", 0, fd) == 5
+        assert fusefs.write(path, b"J", 0, fd) == 1
+        assert fusefs.read(path, 5, 1, fd) == b"ello"
+        os.close(fd)
+
+    def test_vectored_round_trip(self, tmp_path):
+        path = str(tmp_path / "test")
+        data = os.urandom(fusefs.VECTORED_CHUNK * 3 + 17)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        assert fusefs.write(path, data, 0, fd, vectored=True) == len(data)
+        assert fusefs.read(path, len(data) + 100, 0, fd, vectored=True) == data
+        os.close(fd)
+
+    def test_bad_fh_reads_through_pool(self, tmp_path, monkeypatch):
+        path = str(tmp_path / "test")
+        with open(path, "wb") as f:
+            f.write(b"hello")
+        pool = FdPool()
+        monkeypatch.setattr(fusefs, "fallback_fds", pool)
+        fd = os.open(path, os.O_RDONLY)
+        os.close(fd)
+        assert fusefs.read(path, 2, 0, fd) == b"he"
+        assert fusefs.read(path, 3, 2, None) == b"llo"
+        assert len(pool._fds) == 1
+        pool.clear()
+
+
+class TestFdPool(object):
+
+    def test_pool_is_bounded(self, tmp_path):
+        pool = FdPool(maxsize=2)
+        for idx in range(3):
+            with open(tmp_path / f"test{idx}", "wb") as f:
+                f.write(b"a")
+            pool.pread(str(tmp_path / f"test{idx}"), 1, 0)
+        assert list(pool._fds) == [str(tmp_path / "test1"), str(tmp_path / "test2")]
+        pool.clear()
+
+    def test_discard_forgets_paths_below(self, tmp_path):
+        os.mkdir(tmp_path / "dir")
+        with open(tmp_path / "dir" / "test", "wb") as f:
+            f.write(b"a")
+        pool = FdPool()
+        pool.pread(str(tmp_path / "dir" / "test"), 1, 0)
+        pool.discard(str(tmp_path / "dir"))
+        assert len(pool._fds) == 0
+
+
+class TestCopy(object):
+
+    @pytest.mark.parametrize("reflink,copy_file_range,sendfile", [(True, True, True), (False, True, True), (False, False, True), (False, False, False)])
+    def test_copy_file_falls_back(self, tmp_path, monkeypatch, reflink, copy_file_range, sendfile):
+        monkeypatch.setattr(fusefs, "USE_REFLINK", reflink)
+        monkeypatch.setattr(fusefs, "USE_COPY_FILE_RANGE", copy_file_range and fusefs.USE_COPY_FILE_RANGE)
+        monkeypatch.setattr(fusefs, "USE_SENDFILE", sendfile and fusefs.USE_SENDFILE)
+        monkeypatch.setattr(fusefs, "COPY_CHUNK", 4096)
+        data = os.urandom(3 * 4096 + 100)
+        (tmp_path / "src").write_bytes(data)
+        os.chmod(tmp_path / "src", 0o640)
+        paced = []
+
+        fusefs.copy_file(str(tmp_path / "src"), str(tmp_path / "dst"), paced.append)
+        assert (tmp_path / "dst").read_bytes() == data
+        assert os.stat(tmp_path / "dst").st_mode & 0o777 == 0o640
+        assert reflink or sum(paced) == len(data)
+
+    def test_copy_file_keeps_setuid(self, tmp_path):
+        (tmp_path / "src").write_bytes(b"#!/bin/sh\n")
+        os.chmod(tmp_path / "src", 0o4755)
+        fusefs.copy_file(str(tmp_path / "src"), str(tmp_path / "dst"))
+        assert os.stat(tmp_path / "dst").st_mode & 0o7777 == 0o4755
+
+    def test_sync_tree_copies_everything(self, tmp_path):
+        os.makedirs(tmp_path / "src" / "dir")
+        (tmp_path / "src" / "dir" / "file").write_bytes(b"data" * 1000)
+        os.symlink("dir/file", tmp_path / "src" / "link")
+        fusefs.sync_tree(str(tmp_path / "src"), str(tmp_path / "dst"))
+        assert (tmp_path / "dst" / "dir" / "file").read_bytes() == b"data" * 1000
+        assert os.readlink(tmp_path / "dst" / "link") == "dir/file"
+        assert os.stat(tmp_path / "dst" / "dir").st_mtime_ns == os.stat(tmp_path / "src" / "dir").st_mtime_ns
+
+    def test_sync_tree_only_copies_changes(self, tmp_path, monkeypatch):
+        os.makedirs(tmp_path / "src")
+        (tmp_path / "src" / "same").write_text("same")
+        (tmp_path / "src" / "changed").write_text("old")
+        fusefs.sync_tree(str(tmp_path / "src"), str(tmp_path / "dst"))
+        (tmp_path / "src" / "changed").write_text("new!")
+        os.unlink(tmp_path / "src" / "same")
+        (tmp_path / "src" / "added").write_text("added")
+
+        copied = []
+        copy_file = fusefs.copy_file
+        monkeypatch.setattr(fusefs, "copy_file", lambda src, dst, paced: copied.append(os.path.basename(src)) or copy_file(src, dst, paced))
+        fusefs.sync_tree(str(tmp_path / "src"), str(tmp_path / "dst"))
+        assert sorted(copied) == ["added", "changed"]
+        assert sorted(os.listdir(tmp_path / "dst")) == ["added", "changed"]
+        assert (tmp_path / "dst" / "changed").read_text() == "new!"
+
+    def test_sync_paths_only_syncs_the_given_paths(self, tmp_path):
+        os.makedirs(tmp_path / "src" / "dir")
+        os.makedirs(tmp_path / "src" / "tree")
+        for name in ("same", "dir/gone", "tree/file"):
+            (tmp_path / "src" / name).write_text("old")
+        fusefs.sync_tree(str(tmp_path / "src"), str(tmp_path / "dst"))
+        for name in ("same", "tree/file"):
+            (tmp_path / "src" / name).write_text("new")
+        os.unlink(tmp_path / "src" / "dir" / "gone")
+        (tmp_path / "src" / "dir" / "added").write_text("new")
+
+        fusefs.sync_paths(str(tmp_path / "src"), str(tmp_path / "dst"), ["dir/gone", "dir/added", "tree/"])
+        assert (tmp_path / "dst" / "same").read_text() == "old"
+        assert os.listdir(tmp_path / "dst" / "dir") == ["added"]
+        assert (tmp_path / "dst" / "tree" / "file").read_text() == "new"
+        assert os.stat(tmp_path / "dst" / "dir").st_mtime_ns == os.stat(tmp_path / "src" / "dir").st_mtime_ns
+
+    def test_sync_tree_copies_files_in_parallel(self, tmp_path):
+        os.makedirs(tmp_path / "src" / "dir")
+        for idx in range(4):
+            (tmp_path / "src" / "dir" / f"file{idx}").write_text(str(idx))
+        os.symlink("dir", tmp_path / "src" / "link")
+        copied = []
+
+        def parallel_map(copy, pairs):
+            pairs = list(pairs)
+            copied.extend(src for src, _ in pairs)
+            return map(copy, pairs)
+        fusefs.sync_tree(str(tmp_path / "src"), str(tmp_path / "dst"), parallel_map=parallel_map)
+        assert len(copied) == 4
+        assert (tmp_path / "dst" / "dir" / "file3").read_text() == "3"
+        assert os.readlink(tmp_path / "dst" / "link") == "dir"
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import os
+import itertools
+import threading
+
+
+class FileHandle():
+    '''An open file, resolved once so the data path never has to probe the sources'''
+    def __init__(self, fd, path, real_path, source, flags=os.O_RDWR):
+        self.fd = fd
+        self.path = path
+        self.real_path = real_path
+        self.source = source
+        # to open the same file again after it migrated to another source
+        self.flags = flags
+        self.written = False
+        self.was_read = False
+        # the kernel may keep its cached pages of the file, set when it is opened
+        self.keep_cache = False
+        # its path was unlinked or replaced, the handle keeps its file but no longer follows the path
+        self.detached = False
+
+
+class HandleTable():
+    '''Maps the fh numbers given to FUSE to open FileHandles.
+
+    The numbers are independent of the underlying fds, so a handle can be
+    pointed at a different fd without FUSE noticing.'''
+
+    def __init__(self):
+        self._handles = {}
+        self._numbers = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add(self, handle):
+        with self._lock:
+            fh = next(self._numbers)
+            self._handles[fh] = handle
+        return fh
+
+    def get(self, fh):
+        return self._handles.get(fh)
+
+    def pop(self, fh):
+        with self._lock:
+            return self._handles.pop(fh, None)
+
+    def __len__(self):
+        return len(self._handles)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._handles.values()))
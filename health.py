@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import errno
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+log = logging.getLogger(__name__)
+
+# errors that say something about the disk rather than about the path
+DISK_ERRORS = (errno.EIO, errno.ENXIO, errno.ENODEV, errno.ETIMEDOUT, errno.ESTALE, errno.EROFS)
+# weight of the newest op in the rolling latency
+LATENCY_WEIGHT = 0.1
+# probes of one source that may run at the same time
+PROBE_THREADS = 4
+
+
+class _Source():
+
+    def __init__(self):
+        self.degraded = False
+        self.latency = 0.0
+        self.failing = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.degradations = 0
+        # the last background probe of a degraded source
+        self.retrying = None
+
+
+class SourceHealth():
+    '''Rolling latency, errors and state of every source.
+
+    Every op on a source is recorded, its latency only when given: ops that
+    write or copy data take as long as the data needs, however healthy the
+    disk. A source is degraded once its rolling latency exceeds slow
+    seconds, once max_errors ops in a row failed with a disk error, or once
+    a metadata probe did not answer within timeout seconds. Degraded
+    sources are skipped where cinchfs can do without them and probed in the
+    background until they answer quickly again. A timeout of 0 runs probes
+    inline without one.'''
+
+    def __init__(self, sources, timeout=2.0, slow=1.0, max_errors=3, retry_interval=5.0):
+        self.sources = sources
+        self.timeout = timeout
+        self.slow = slow
+        self.max_errors = max_errors
+        self.retry_interval = retry_interval
+        self._sources = dict((source, _Source()) for source in sources)
+        self._probers = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._retrying = False
+
+    def healthy(self, source):
+        return not self._sources[source].degraded
+
+    def usable(self, sources):
+        '''The healthy ones of sources, or all of them when none is'''
+        return [source for source in sources if not self._sources[source].degraded] or sources
+
+    def record(self, source, latency_ns, error=0):
+        '''An op on source that failed with error, latency_ns is None for ops that say nothing about it'''
+        health = self._sources.get(source)
+        if health is None:
+            return
+        if latency_ns is not None:
+            health.latency += LATENCY_WEIGHT * (latency_ns / 1e9 - health.latency)
+        if error in DISK_ERRORS:
+            health.errors += 1
+            health.failing += 1
+            if health.failing >= self.max_errors:
+                self._degrade(source, f"{health.failing} disk errors in a row")
+        else:
+            health.failing = 0
+        if health.latency > self.slow:
+            self._degrade(source, f"answering in {health.latency * 1000:.0f} ms")
+
+    def probe(self, source, function, *args):
+        '''function(*args) on source, raises TimeoutError if a degraded source or one that does not answer in time'''
+        if self._sources[source].degraded:
+            raise TimeoutError(errno.ETIMEDOUT, f"{source} is degraded")
+        try:
+            return self._call(source, function, *args)
+        except FutureTimeout:
+            self._sources[source].timeouts += 1
+            self._degrade(source, f"no answer within {self.timeout} s")
+            raise TimeoutError(errno.ETIMEDOUT, f"{source} did not answer")
+
+    def snapshot(self):
+        return dict((source, {
+            'state': 'degraded' if health.degraded else 'healthy',
+            'latency_ms': round(health.latency * 1000, 3),
+            'errors': health.errors,
+            'timeouts': health.timeouts,
+            'degradations': health.degradations,
+        }) for source, health in self._sources.items())
+
+    def close(self):
+        self._stop.set()
+        for prober in self._probers.values():
+            prober.shutdown(wait=False)
+
+    def _call(self, source, function, *args):
+        start = time.perf_counter_ns()
+        if self.timeout:
+            result = self._submit(source, function, *args).result(self.timeout)
+        else:
+            result = function(*args)
+        self.record(source, time.perf_counter_ns() - start)
+        return result
+
+    def _submit(self, source, function, *args):
+        # a hung probe keeps its thread, the caller only stops waiting for it
+        with self._lock:
+            if source not in self._probers:
+                self._probers[source] = ThreadPoolExecutor(max_workers=PROBE_THREADS, thread_name_prefix='cinchfs-probe')
+            return self._probers[source].submit(function, *args)
+
+    def _degrade(self, source, reason):
+        health = self._sources[source]
+        with self._lock:
+            if health.degraded:
+                return
+            health.degraded = True
+            health.degradations += 1
+            start = not self._retrying
+            self._retrying = True
+        log.warning("Source %s is degraded, %s", source, reason)
+        if start:
+            threading.Thread(target=self._retry, name='cinchfs-health', daemon=True).start()
+
+    def _retry(self):
+        while not self._stop.wait(self.retry_interval):
+            with self._lock:
+                degraded = [source for source, health in self._sources.items() if health.degraded]
+                if not degraded:
+                    self._retrying = False
+                    return
+            for source in degraded:
+                self._recover(source)
+
+    def _recover(self, source):
+        health = self._sources[source]
+        if health.retrying is not None and not health.retrying.done():
+            # still hung from the last time
+            return
+        start = time.perf_counter_ns()
+        health.retrying = self._submit(source, os.stat, source)
+        try:
+            health.retrying.result(self.timeout or None)
+        except (OSError, FutureTimeout):
+            return
+        latency = (time.perf_counter_ns() - start) / 1e9
+        if latency > self.slow:
+            return
+        health.latency = latency
+        health.failing = 0
+        health.degraded = False
+        log.info("Source %s is healthy again", source)
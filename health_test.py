@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import errno
+import threading
+import pytest
+from health import SourceHealth
+
+
+class TestSourceHealth(object):
+
+    def test_disk_errors_in_a_row_degrade(self):
+        health = SourceHealth(["/disk0", "/disk1"], max_errors=2)
+        health.record("/disk0", 1000, errno.EIO)
+        health.record("/disk0", 1000, errno.ENOENT)
+        health.record("/disk0", 1000, errno.EIO)
+        assert health.healthy("/disk0")
+        health.record("/disk0", 1000, errno.EIO)
+        assert not health.healthy("/disk0")
+        assert health.usable(["/disk0", "/disk1"]) == ["/disk1"]
+        assert health.snapshot()["/disk0"]["errors"] == 3
+        health.close()
+
+    def test_slow_source_degrades(self):
+        health = SourceHealth(["/disk0"], slow=0.5)
+        for _ in range(20):
+            health.record("/disk0", 2 * 10 ** 9)
+        assert not health.healthy("/disk0")
+        # the last source is still used rather than none
+        assert health.usable(["/disk0"]) == ["/disk0"]
+        health.close()
+
+    def test_ops_without_latency_only_count_errors(self):
+        health = SourceHealth(["/disk0"], slow=0.5, max_errors=2)
+        for _ in range(20):
+            health.record("/disk0", None)
+        assert health.healthy("/disk0")
+        assert health.snapshot()["/disk0"]["latency_ms"] == 0
+        health.record("/disk0", None, errno.EIO)
+        health.record("/disk0", None, errno.EIO)
+        assert not health.healthy("/disk0")
+        health.close()
+
+    def test_hung_probe_times_out_and_degrades(self):
+        health = SourceHealth(["/disk0"], timeout=0.05, retry_interval=60)
+        hung = threading.Event()
+        with pytest.raises(TimeoutError):
+            health.probe("/disk0", hung.wait)
+        assert not health.healthy("/disk0")
+        assert health.snapshot()["/disk0"]["timeouts"] == 1
+        # degraded sources are not waited for again
+        with pytest.raises(TimeoutError):
+            health.probe("/disk0", lambda: True)
+        hung.set()
+        health.close()
+
+    def test_degraded_source_recovers(self, tmp_path):
+        source = str(tmp_path)
+        health = SourceHealth([source], retry_interval=0.01)
+        for _ in range(3):
+            health.record(source, 1000, errno.EIO)
+        assert not health.healthy(source)
+        health._stop.wait(0.5)
+        assert health.healthy(source)
+        assert health.probe(source, lambda: 42) == 42
+        health.close()
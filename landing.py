@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import logging
+import itertools
+import threading
+import fusefs as fs
+
+from utilities import Throttle
+
+log = logging.getLogger(__name__)
+
+# kept at the root of the landing source, cinchfs leaves root entries starting with .cinchfs alone
+LANDING_DIR = '.cinchfs-landing'
+LOG_NAME = 'landed.log'
+# landed files the log does not know are recovered at the root of the mount under this prefix
+RECOVERED_PREFIX = 'recovered-'
+
+
+class LandingTier():
+    '''New files are written to a fast source first and moved to their bulk source once idle.
+
+    Landed files are kept flat under a generated name. Which path of the
+    mount each one is lives in memory and in an append-only log next to
+    them, so landed files survive a remount. Every record is synced before
+    the op it belongs to returns. Files are destaged once they
+    have not been modified for idle seconds, by destage(path, real_path),
+    copying at most bandwidth bytes per second. Until then a landed file
+    can't be hard linked, link fails with EXDEV like it does between two
+    filesystems.'''
+
+    def __init__(self, directory, destage, idle=30.0, bandwidth=None):
+        self.dir = directory
+        self.idle = idle
+        self.throttle = Throttle(bandwidth)
+        self._destage = destage
+        self._files_dir = os.path.join(directory, LANDING_DIR)
+        self._landed = {}
+        self._children = {}
+        self._names = itertools.count()
+        self._prefix = str(time.time_ns())
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(self._files_dir, exist_ok=True)
+        self._load()
+
+    def get(self, path):
+        '''The real path of path if it is landed, otherwise None'''
+        return self._landed.get(path)
+
+    def paths(self):
+        with self._lock:
+            return dict(self._landed)
+
+    def children(self, path):
+        '''Names of the landed files directly in the directory path'''
+        with self._lock:
+            return sorted(self._children.get(path, ()))
+
+    def land(self, path):
+        '''Pick the real path a new file at path is created at'''
+        real_path = os.path.join(self._files_dir, f"{self._prefix}-{next(self._names)}")
+        with self._lock:
+            self._add(path, real_path)
+            self._write({'path': path, 'file': os.path.basename(real_path)})
+        return real_path
+
+    def rename(self, old, new):
+        '''Follow a rename of old, a landed file or a directory holding some, to new'''
+        prefix = old.rstrip('/') + '/'
+        with self._lock:
+            moved = [(path, new + path[len(old):]) for path in self._landed if path == old or path.startswith(prefix)]
+            for path, renamed in moved:
+                real_path = self._remove(path)
+                self._add(renamed, real_path)
+                self._write({'path': renamed, 'file': os.path.basename(real_path)})
+
+    def forget(self, path):
+        '''path is no longer landed, its landed file is removed'''
+        with self._lock:
+            real_path = self._remove(path)
+            if real_path is None:
+                return
+            self._write({'file': os.path.basename(real_path), 'gone': True})
+        try:
+            os.unlink(real_path)
+        except FileNotFoundError:
+            pass
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='cinchfs-destage', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            self._log.close()
+
+    def destage_idle(self):
+        '''Destage every landed file that has been idle long enough, returns how many were'''
+        destaged = 0
+        now = time.time()
+        for path, real_path in self.paths().items():
+            try:
+                st = os.stat(real_path)
+            except FileNotFoundError:
+                continue
+            if now - st.st_mtime < self.idle:
+                continue
+            try:
+                if self._destage(path, real_path):
+                    destaged += 1
+            except OSError:
+                log.warning("Destaging %s failed, it stays landed", path, exc_info=True)
+        return destaged
+
+    def _run(self):
+        while not self._stop.wait(max(self.idle / 2, 1.0)):
+            self.destage_idle()
+
+    def _add(self, path, real_path):
+        self._landed[path] = real_path
+        self._children.setdefault(os.path.dirname(path), set()).add(os.path.basename(path))
+
+    def _remove(self, path):
+        real_path = self._landed.pop(path, None)
+        if real_path is not None:
+            children = self._children[os.path.dirname(path)]
+            children.discard(os.path.basename(path))
+            if not children:
+                del self._children[os.path.dirname(path)]
+        return real_path
+
+    def _write(self, record):
+        self._log.write(json.dumps(record) + '\n')
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+    def _load(self):
+        # replay the log, then start a compacted one
+        log_path = os.path.join(self._files_dir, LOG_NAME)
+        files = {}
+        gone = set()
+        if os.path.exists(log_path):
+            with open(log_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line
+                    if record.get('gone'):
+                        files.pop(record['file'], None)
+                        gone.add(record['file'])
+                    else:
+                        files[record['file']] = record['path']
+                        gone.discard(record['file'])
+        for name in os.listdir(self._files_dir):
+            if name in files:
+                self._add(files[name], os.path.join(self._files_dir, name))
+            elif name in gone:
+                # removed, but the removal never reached the disk
+                os.unlink(os.path.join(self._files_dir, name))
+            elif not name.startswith(LOG_NAME):
+                # its path was lost with the log, the data is kept where it can be found
+                path = '/' + RECOVERED_PREFIX + name
+                log.warning("Landed file %s is missing from the log, recovered as %s", name, path)
+                self._add(path, os.path.join(self._files_dir, name))
+
+        compacted = log_path + '.new'
+        with open(compacted, 'w') as f:
+            for path, real_path in self._landed.items():
+                f.write(json.dumps({'path': path, 'file': os.path.basename(real_path)}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(compacted, log_path)
+        fs.fsync_dir(self._files_dir)
+        self._log = open(log_path, 'a')
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import os
+from landing import LANDING_DIR, LandingTier
+
+
+def never_destage(path, real_path):
+    return False
+
+
+class TestLandingTier(object):
+
+    def test_landed_files_survive_a_remount(self, tmp_path):
+        tier = LandingTier(str(tmp_path), never_destage)
+        real_path = tier.land("/dir/file")
+        open(real_path, "w").close()
+        tier.rename("/dir", "/moved")
+        gone = tier.land("/gone")
+        open(gone, "w").close()
+        tier.forget("/gone")
+        tier.close()
+
+        tier = LandingTier(str(tmp_path), never_destage)
+        assert tier.paths() == {"/moved/file": real_path}
+        assert tier.children("/moved") == ["file"]
+        assert not os.path.exists(gone)
+
+    def test_files_missing_from_the_log_are_recovered(self, tmp_path):
+        os.makedirs(tmp_path / LANDING_DIR)
+        (tmp_path / LANDING_DIR / "stray").write_text("data")
+        tier = LandingTier(str(tmp_path), never_destage)
+        assert tier.paths() == {"/recovered-stray": str(tmp_path / LANDING_DIR / "stray")}
+        assert tier.children("/") == ["recovered-stray"]
+
+    def test_removals_that_never_reached_the_disk_are_redone(self, tmp_path):
+        tier = LandingTier(str(tmp_path), never_destage)
+        gone = tier.land("/gone")
+        tier.forget("/gone")
+        tier.close()
+        open(gone, "w").close()
+
+        tier = LandingTier(str(tmp_path), never_destage)
+        assert tier.paths() == {}
+        assert not os.path.exists(gone)
+
+    def test_only_idle_files_are_destaged(self, tmp_path):
+        destaged = []
+        tier = LandingTier(str(tmp_path), lambda path, real_path: destaged.append(path) or True, idle=60)
+        for path in ("/old", "/new"):
+            open(tier.land(path), "w").close()
+        os.utime(tier.get("/old"), (0, 0))
+        assert tier.destage_idle() == 1
+        assert destaged == ["/old"]
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import queue
+import errno
+import logging
+import threading
+
+from collections import Counter
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+
+class EntryGate():
+    '''Holds back ops on a top-level entry while it is switched to another source.
+
+    Ops pass the gate for the entries they touch. Closing the gate for an
+    entry waits for the ops already inside to finish and keeps new ones out
+    until it is opened again. An op may close the gate for an entry it is
+    inside itself, it then fails with BlockingIOError rather than wait for
+    someone else switching entries.'''
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._closed = set()
+        self._inside = Counter()
+        # an op inside the gate is closing it
+        self._upgrading = False
+
+    @contextmanager
+    def passing(self, entries):
+        if not entries:
+            yield
+            return
+        with self._cond:
+            while self._closed and any(entry in self._closed for entry in entries):
+                self._cond.wait()
+            for entry in entries:
+                self._inside[entry] += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                for entry in entries:
+                    self._inside[entry] -= 1
+                    if not self._inside[entry]:
+                        del self._inside[entry]
+                if self._closed:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def closed(self, entry, held=0):
+        '''Keep ops out of entry, held is how often the caller passed the gate for it itself'''
+        with self._cond:
+            if held:
+                # waiting for another closer while inside could mean waiting for each other
+                if entry in self._closed or self._upgrading:
+                    raise BlockingIOError(errno.EAGAIN, f"{entry} is being switched")
+                self._upgrading = True
+            while entry in self._closed:
+                self._cond.wait()
+            self._closed.add(entry)
+            while self._inside[entry] > held:
+                self._cond.wait()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._closed.discard(entry)
+                if held:
+                    self._upgrading = False
+                self._cond.notify_all()
+
+
+class Migrations():
+    '''Runs requested migrations one at a time on a background thread.
+
+    migrate(entry, destination) does the actual work, the status of every
+    request since the mount is kept for the control interface.'''
+
+    def __init__(self, migrate):
+        self._migrate = migrate
+        self._queue = queue.Queue()
+        self._status = []
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def request(self, entry, destination):
+        status = {'entry': entry, 'to': destination, 'state': 'queued'}
+        with self._lock:
+            self._status.append(status)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='cinchfs-migrate', daemon=True)
+                self._worker.start()
+        self._queue.put(status)
+        return status
+
+    def status(self):
+        with self._lock:
+            return [dict(status) for status in self._status]
+
+    def wait(self):
+        '''Block until every requested migration has finished'''
+        self._queue.join()
+
+    def close(self):
+        if self._worker is not None:
+            self._queue.put(None)
+
+    def _run(self):
+        while True:
+            status = self._queue.get()
+            try:
+                if status is None:
+                    return
+                self._set(status, state='running')
+                self._migrate(status['entry'], status['to'])
+                self._set(status, state='done')
+            except Exception as e:
+                log.exception("Migrating %s to %s failed", status['entry'], status['to'])
+                self._set(status, state='failed', error=str(e))
+            finally:
+                self._queue.task_done()
+
+    def _set(self, status, **changes):
+        with self._lock:
+            status.update(changes)
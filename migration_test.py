@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import time
+import pytest
+import threading
+from migration import EntryGate, Migrations
+
+
+class TestEntryGate(object):
+
+    def test_closing_waits_for_ops_inside(self):
+        gate = EntryGate()
+        closed = threading.Event()
+
+        def close():
+            with gate.closed("dir"):
+                closed.set()
+        with gate.passing(["dir"]):
+            thread = threading.Thread(target=close)
+            thread.start()
+            time.sleep(0.05)
+            assert not closed.is_set()
+        thread.join(1)
+        assert closed.is_set()
+
+    def test_ops_wait_while_closed(self):
+        gate = EntryGate()
+        passed = threading.Event()
+
+        def op():
+            with gate.passing(["dir"]):
+                passed.set()
+        with gate.closed("dir"):
+            thread = threading.Thread(target=op)
+            thread.start()
+            time.sleep(0.05)
+            assert not passed.is_set()
+            with gate.passing(["other"]):
+                pass  # other entries are not held back
+        thread.join(1)
+        assert passed.is_set()
+
+
+    def test_an_op_can_close_the_gate_it_passed(self):
+        gate = EntryGate()
+        with gate.passing(["dir", "other"]):
+            with gate.closed("dir", held=1):
+                pass
+
+    def test_closing_from_inside_fails_while_someone_else_closes(self):
+        gate = EntryGate()
+        closing = threading.Thread(target=lambda: gate.closed("dir").__enter__())
+        with gate.passing(["dir"]):
+            closing.start()
+            while "dir" not in gate._closed:
+                time.sleep(0.01)
+            with pytest.raises(BlockingIOError):
+                with gate.closed("dir", held=1):
+                    pass
+        closing.join(1)
+        assert not closing.is_alive()
+
+
+class TestMigrations(object):
+
+    def test_requests_run_in_order(self):
+        done = []
+        migrations = Migrations(lambda entry, destination: done.append((entry, destination)))
+        migrations.request("a", "/disk1")
+        migrations.request("b", "/disk0")
+        migrations.wait()
+        assert done == [("a", "/disk1"), ("b", "/disk0")]
+        assert [status["state"] for status in migrations.status()] == ["done", "done"]
+
+    def test_failures_are_reported(self):
+        def migrate(entry, destination):
+            raise OSError("disk gone")
+        migrations = Migrations(migrate)
+        migrations.request("a", "/disk1")
+        migrations.wait()
+        assert migrations.status() == [{"entry": "a", "to": "/disk1", "state": "failed", "error": "disk gone"}]
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import time
+import random
+import threading
+import itertools
+
+
+class SourceView():
+    '''What a placement policy gets to see of the sources'''
+
+    def __init__(self, free_blocks, statfs, write_load):
+        self.free_blocks = free_blocks
+        self.statfs = statfs
+        self.write_load = write_load
+
+
+class WriteLoad():
+    '''Recent write activity per source, as a decaying bytes-per-second rate'''
+
+    def __init__(self, half_life=10.0):
+        self.half_life = half_life
+        self._rates = {}
+        self._last_writes = {}
+        self._lock = threading.Lock()
+
+    def record(self, source, nbytes):
+        now = time.monotonic()
+        with self._lock:
+            self._rates[source] = self._decayed(source, now) + nbytes / self.half_life
+            self._last_writes[source] = now
+
+    def rate(self, source):
+        with self._lock:
+            return self._decayed(source, time.monotonic())
+
+    def last_write(self, source):
+        '''monotonic time of the last write, 0 if the source was never written to'''
+        return self._last_writes.get(source, 0)
+
+    def _decayed(self, source, now):
+        rate = self._rates.get(source, 0)
+        if rate:
+            rate *= 0.5 ** ((now - self._last_writes[source]) / self.half_life)
+        return rate
+
+
+class PlacementPolicy():
+    '''Chooses the source for a new top-level entry'''
+
+    def choose(self, sources, view):
+        raise NotImplementedError()
+
+    def _candidates(self, sources, view):
+        # sources that are full or never answered a statfs are only used as a last resort
+        return [source for source in sources if view.free_blocks(source) > 0] or sources
+
+
+class MostFree(PlacementPolicy):
+    def choose(self, sources, view):
+        return max(sources, key=view.free_blocks)
+
+
+class LeastUsedPercentage(PlacementPolicy):
+    def choose(self, sources, view):
+        return min(self._candidates(sources, view), key=lambda source: (self._used(view.statfs(source)), view.write_load.rate(source)))
+
+    def _used(self, stv):
+        if not stv or not stv['f_blocks']:
+            return 1
+        return 1 - stv['f_bfree'] / stv['f_blocks']
+
+
+class RoundRobin(PlacementPolicy):
+    def __init__(self):
+        self._turns = itertools.count()
+
+    def choose(self, sources, view):
+        candidates = self._candidates(sources, view)
+        return candidates[next(self._turns) % len(candidates)]
+
+
+class WeightedRandom(PlacementPolicy):
+    def __init__(self, rng=None):
+        self._rng = rng or random.Random()
+
+    def choose(self, sources, view):
+        candidates = self._candidates(sources, view)
+        weights = [max(view.free_blocks(source), 0) for source in candidates]
+        if not any(weights):
+            return candidates[0]
+        return self._rng.choices(candidates, weights)[0]
+
+
+class LeastRecentlyWritten(PlacementPolicy):
+    def choose(self, sources, view):
+        return min(self._candidates(sources, view), key=lambda source: (view.write_load.last_write(source), -view.free_blocks(source)))
+
+
+PLACEMENT_POLICIES = {
+    'most-free': MostFree,
+    'least-used-percentage': LeastUsedPercentage,
+    'round-robin': RoundRobin,
+    'weighted-random': WeightedRandom,
+    'least-recently-written': LeastRecentlyWritten,
+}
+
+
+def make_placement(name):
+    if name not in PLACEMENT_POLICIES:
+        raise ValueError(f"Unknown placement policy {name}")
+    return PLACEMENT_POLICIES[name]()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import random
+import pytest
+from placement import (LeastRecentlyWritten, LeastUsedPercentage, MostFree, RoundRobin, SourceView,
+                       WeightedRandom, WriteLoad, make_placement)
+
+SOURCES = ["/disk0", "/disk1", "/disk2"]
+
+
+def view(free, total=None, load=None):
+    total = total or dict((source, 1000) for source in free)
+    statfs = lambda source: {'f_bfree': free[source], 'f_blocks': total[source]}
+    return SourceView(free.get, statfs, load or WriteLoad())
+
+
+class TestPlacement(object):
+
+    def test_most_free(self):
+        assert MostFree().choose(SOURCES, view({"/disk0": 50, "/disk1": 100, "/disk2": 75})) == "/disk1"
+
+    def test_most_free_ties_use_first_source(self):
+        assert MostFree().choose(SOURCES, view({"/disk0": 50, "/disk1": 50, "/disk2": 50})) == "/disk0"
+
+    def test_least_used_percentage(self):
+        free = {"/disk0": 500, "/disk1": 600, "/disk2": 100}
+        total = {"/disk0": 1000, "/disk1": 2000, "/disk2": 100}
+        assert LeastUsedPercentage().choose(SOURCES, view(free, total)) == "/disk2"
+
+    def test_round_robin_cycles(self):
+        policy = RoundRobin()
+        sources_view = view({"/disk0": 1, "/disk1": 1, "/disk2": 1})
+        assert [policy.choose(SOURCES, sources_view) for _ in range(4)] == SOURCES + ["/disk0"]
+
+    def test_round_robin_skips_full_sources(self):
+        policy = RoundRobin()
+        sources_view = view({"/disk0": 1, "/disk1": 0, "/disk2": 1})
+        assert [policy.choose(SOURCES, sources_view) for _ in range(3)] == ["/disk0", "/disk2", "/disk0"]
+
+    def test_weighted_random_follows_free_space(self):
+        policy = WeightedRandom(random.Random(42))
+        sources_view = view({"/disk0": 0, "/disk1": 900, "/disk2": 100})
+        choices = [policy.choose(SOURCES, sources_view) for _ in range(1000)]
+        assert "/disk0" not in choices
+        assert choices.count("/disk1") > choices.count("/disk2") * 4
+
+    def test_least_recently_written(self):
+        load = WriteLoad()
+        load.record("/disk0", 10)
+        load.record("/disk2", 10)
+        assert LeastRecentlyWritten().choose(SOURCES, view({"/disk0": 9, "/disk1": 1, "/disk2": 9}, load=load)) == "/disk1"
+
+    def test_write_load_decays(self, monkeypatch):
+        now = [100.0]
+        monkeypatch.setattr("time.monotonic", lambda: now[0])
+        load = WriteLoad(half_life=10)
+        load.record("/disk0", 1000)
+        now[0] += 10
+        assert load.rate("/disk0") == pytest.approx(50)
+
+    def test_unknown_policy_fails(self):
+        with pytest.raises(ValueError):
+            make_placement("anywhere")
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import pstats
+import logging
+import cProfile
+import threading
+
+from collections import Counter
+
+log = logging.getLogger(__name__)
+
+PROFILE_MODES = ('sample', 'cprofile')
+# seconds between two stack samples
+SAMPLE_INTERVAL = 0.005
+# our own background threads are left out of samples, only the threads serving FUSE are of interest
+BACKGROUND_PREFIX = 'cinchfs-'
+
+
+class Profiler():
+    '''Captures where a running mount spends its time, for a set number of seconds.
+
+    The sample mode periodically records the stacks of the threads serving
+    FUSE and writes them as collapsed stacks, the input of flamegraph.pl and
+    speedscope. Time spent waiting in libfuse and the kernel shows up as
+    samples sitting in the FUSE call itself. The cprofile mode profiles
+    every op through run() and writes a pstats file. Newer pythons allow
+    only one active profiler, ops that start while another thread's op is
+    being profiled run unprofiled and are counted as skipped.'''
+
+    def __init__(self, directory, interval=SAMPLE_INTERVAL):
+        self.dir = directory
+        self.interval = interval
+        self.mode = None
+        self.output = None
+        self.capturing = False
+        self._profiles = {}
+        self._skipped = 0
+        self._samples = Counter()
+        self._local = threading.local()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._timer = None
+
+    def start(self, mode='sample', duration=30.0):
+        '''Start capturing, returns the file the capture is written to once stopped'''
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode {mode}")
+        with self._cond:
+            if self.mode is not None:
+                raise RuntimeError("Already profiling")
+            self.mode = mode
+            self._skipped = 0
+            self.output = os.path.join(self.dir, f"cinchfs-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}"
+                                       + ('.collapsed' if mode == 'sample' else '.pstats'))
+            self._stop.clear()
+        if mode == 'sample':
+            self._sampler = threading.Thread(target=self._sample, name='cinchfs-profiler', daemon=True)
+            self._sampler.start()
+        else:
+            self.capturing = True
+        self._timer = threading.Timer(duration, self.stop)
+        self._timer.name = 'cinchfs-profile-timer'
+        self._timer.daemon = True
+        self._timer.start()
+        log.warning("Profiling with %s for %s s", mode, duration)
+        return self.output
+
+    def stop(self):
+        '''Stop capturing and write out the capture, returns where to, None if nothing was running'''
+        with self._cond:
+            mode, self.mode = self.mode, None
+            if mode is None:
+                return None
+            self.capturing = False
+        self._stop.set()
+        if self._timer is not None:
+            self._timer.cancel()
+        if mode == 'sample':
+            self._sampler.join()
+            self._write_samples()
+        else:
+            self._write_profiles()
+        log.warning("Profile written to %s", self.output)
+        return self.output
+
+    def toggle(self, mode='sample', duration=30.0):
+        if self.stop() is None:
+            self.start(mode, duration)
+
+    def running(self):
+        return self.mode is not None
+
+    def profiled(self):
+        '''Whether the current thread is already running under run()'''
+        return getattr(self._local, 'inside', False)
+
+    def run(self, function, *args):
+        '''function(*args), profiled when capturing with cprofile'''
+        if self.profiled():
+            # an op calling another op is already profiled
+            return function(*args)
+        with self._cond:
+            if not self.capturing:
+                profile = None
+            else:
+                ident = threading.get_ident()
+                entry = self._profiles.setdefault(ident, [cProfile.Profile(), 0])
+                entry[1] += 1
+                profile = entry[0]
+        if profile is None:
+            return function(*args)
+        self._local.inside = True
+        try:
+            try:
+                profile.enable()
+            except ValueError:
+                # newer pythons allow only one profiler at a time, this op goes unprofiled
+                with self._cond:
+                    self._skipped += 1
+                return function(*args)
+            try:
+                return function(*args)
+            finally:
+                profile.disable()
+        finally:
+            self._local.inside = False
+            with self._cond:
+                entry[1] -= 1
+                self._cond.notify_all()
+
+    def snapshot(self):
+        return {'state': 'running' if self.mode else 'idle', 'mode': self.mode, 'output': self.output,
+                'skipped_ops': self._skipped}
+
+    def _write_profiles(self):
+        # a profile can only be read once the op running under it has finished,
+        # except for the one of an op stopping the capture itself
+        own = threading.get_ident()
+        with self._cond:
+            if own in self._profiles:
+                self._profiles[own][0].disable()
+                self._profiles[own][1] = 0
+            self._cond.wait_for(lambda: not any(busy for _, busy in self._profiles.values()), timeout=5.0)
+            profiles = [profile for profile, busy in self._profiles.values() if not busy]
+            self._profiles = {}
+            skipped = self._skipped
+        stats = pstats.Stats()
+        for profile in profiles:
+            profile.create_stats()
+            if profile.stats:
+                stats.add(profile)
+        stats.dump_stats(self.output)
+        if skipped:
+            log.warning("%d ops ran while another op was profiled and are missing from %s", skipped, self.output)
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            background = set(thread.ident for thread in threading.enumerate() if thread.name.startswith(BACKGROUND_PREFIX))
+            for ident, frame in sys._current_frames().items():
+                if ident != own and ident not in background:
+                    self._samples[self._stack(frame)] += 1
+
+    def _stack(self, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def _write_samples(self):
+        samples, self._samples = self._samples, Counter()
+        with open(self.output, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
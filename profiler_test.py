@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import os
+import pstats
+import threading
+import pytest
+import profiler
+from profiler import Profiler
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestProfiler(object):
+
+    def test_samples_are_written_as_collapsed_stacks(self, tmp_path):
+        profiler = Profiler(str(tmp_path), interval=0.001)
+        stop = threading.Event()
+        thread = threading.Thread(target=spin, args=(stop,))
+        thread.start()
+        output = profiler.start("sample", 60)
+        stop.wait(0.1)
+        assert profiler.stop() == output
+        stop.set()
+        thread.join()
+        lines = open(output).read().splitlines()
+        assert any("spin (profiler_test.py" in line for line in lines)
+        stack, count = lines[0].rsplit(" ", 1)
+        assert int(count) > 0
+        assert profiler.snapshot()["state"] == "idle"
+
+    def test_cprofile_captures_ops_run_through_it(self, tmp_path):
+        profiler = Profiler(str(tmp_path))
+        assert profiler.run(sum, [1, 2]) == 3
+        output = profiler.start("cprofile", 60)
+        assert profiler.run(lambda: profiler.run(sorted, [2, 1])) == [1, 2]
+        assert profiler.stop() == output
+        functions = [function for _, _, function in pstats.Stats(output).stats]
+        assert "<built-in method builtins.sorted>" in functions
+        assert "<built-in method builtins.sum>" not in functions
+
+    def test_ops_that_could_not_be_profiled_are_counted(self, tmp_path, monkeypatch, caplog):
+        class Busy(object):
+            def enable(self):
+                raise ValueError("Another profiling tool is already active")
+
+            def disable(self):
+                pass
+
+            def create_stats(self):
+                self.stats = {}
+        monkeypatch.setattr(profiler.cProfile, "Profile", Busy)
+        profiling = Profiler(str(tmp_path))
+        output = profiling.start("cprofile", 60)
+        assert profiling.run(sorted, [2, 1]) == [1, 2]
+        assert profiling.snapshot()["skipped_ops"] == 1
+        profiling.stop()
+        assert f"1 ops ran while another op was profiled and are missing from {output}" in caplog.text
+
+    def test_duration_ends_capture(self, tmp_path):
+        profiler = Profiler(str(tmp_path))
+        output = profiler.start("cprofile", 0.01)
+        profiler._timer.join(1)
+        assert not profiler.running()
+        assert os.path.exists(output)
+
+    def test_toggle_and_bad_mode(self, tmp_path):
+        profiler = Profiler(str(tmp_path))
+        with pytest.raises(ValueError):
+            profiler.start("perf")
+        assert profiler.stop() is None
+        profiler.toggle("sample", 60)
+        assert profiler.running()
+        with pytest.raises(RuntimeError):
+            profiler.start("sample")
+        profiler.toggle("sample", 60)
+        assert not profiler.running()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class IndexState():
+    '''The top-level index kept between mounts.
+
+    Every source is stored with the mtime its root had when it was listed,
+    so a later mount only has to list the sources whose root changed.'''
+
+    def __init__(self, state_dir):
+        self.path = os.path.join(state_dir, 'index.json')
+
+    def load(self):
+        '''{source: (root mtime in ns, [top-level entries])}, empty if nothing usable was stored'''
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            log.warning("Ignoring unreadable index state %s", self.path)
+            return {}
+        return dict((source, (listing['mtime'], listing['entries'])) for source, listing in stored.items())
+
+    def save(self, listings):
+        stored = dict((source, {'mtime': mtime, 'entries': entries}) for source, (mtime, entries) in listings.items())
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(stored, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import threading
+
+
+class TouchCounters():
+    '''How often each source saw I/O, broken down by the operation that caused it'''
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def touch(self, source, op):
+        with self._lock:
+            ops = self._counts.setdefault(source, {})
+            ops[op] = ops.get(op, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict((source, dict(ops)) for source, ops in self._counts.items())
+
+
+class Histogram():
+    '''Latencies in power-of-two nanosecond buckets, cheap enough to record every op'''
+
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.bytes = 0
+        self.errors = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, latency_ns, nbytes, error):
+        self.buckets[min(latency_ns.bit_length(), 63)] += 1
+        self.count += 1
+        self.bytes += nbytes
+        self.total += latency_ns
+        if error:
+            self.errors += 1
+        if latency_ns > self.max:
+            self.max = latency_ns
+
+    def percentile(self, fraction):
+        '''upper bound in ns of the bucket holding the given fraction of ops'''
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return min(2 ** bucket, self.max)
+        return 0
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'bytes': self.bytes,
+            'errors': self.errors,
+            'p50_ms': self.percentile(0.5) / 1e6,
+            'p99_ms': self.percentile(0.99) / 1e6,
+            'max_ms': self.max / 1e6,
+            'total_ms': self.total / 1e6,
+        }
+
+
+class OpStats():
+    '''Latency histograms per op and per source'''
+
+    def __init__(self):
+        self._ops = {}
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def record(self, op, source, latency_ns, nbytes=0, error=False):
+        with self._lock:
+            histogram = self._ops.get(op)
+            if histogram is None:
+                histogram = self._ops[op] = Histogram()
+            histogram.record(latency_ns, nbytes, error)
+            if source is not None:
+                histogram = self._sources.get(source)
+                if histogram is None:
+                    histogram = self._sources[source] = Histogram()
+                histogram.record(latency_ns, nbytes, error)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'ops': dict((op, histogram.summary()) for op, histogram in sorted(self._ops.items())),
+                'sources': dict((source, histogram.summary()) for source, histogram in self._sources.items()),
+            }
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+from stats import Histogram, OpStats
+
+
+class TestHistogram(object):
+
+    def test_percentiles_are_bucket_upper_bounds(self):
+        histogram = Histogram()
+        for latency in [1000] * 98 + [1000000, 3000000]:
+            histogram.record(latency, 0, False)
+        assert histogram.percentile(0.5) == 1024
+        assert histogram.percentile(0.99) == 2 ** 20
+        assert histogram.percentile(1) == 3000000
+        assert histogram.max == 3000000
+
+    def test_empty_histogram(self):
+        assert Histogram().summary()["p99_ms"] == 0
+
+
+class TestOpStats(object):
+
+    def test_records_bytes_and_errors(self):
+        stats = OpStats()
+        stats.record("read", "/disk0", 10, 4096)
+        stats.record("read", "/disk1", 10, 0, True)
+        stats.record("statfs", None, 10)
+        snapshot = stats.snapshot()
+        assert snapshot["ops"]["read"]["bytes"] == 4096
+        assert snapshot["ops"]["read"]["errors"] == 1
+        assert snapshot["sources"]["/disk1"]["errors"] == 1
+        assert "statfs" in snapshot["ops"]
+        assert set(snapshot["sources"]) == {"/disk0", "/disk1"}
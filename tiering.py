@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import os
+import stat
+import time
+import queue
+import logging
+import itertools
+import threading
+import fusefs as fs
+
+from collections import Counter, OrderedDict, namedtuple
+
+log = logging.getLogger(__name__)
+
+# kept at the root of every fast source, cinchfs leaves root entries starting with .cinchfs alone
+CACHE_DIR = '.cinchfs-cache'
+# how many files read heat is remembered for before all of it is halved
+HEAT_ENTRIES = 65536
+
+CachedCopy = namedtuple('CachedCopy', 'path dir size mtime_ns')
+
+
+class FastTier():
+    '''Copies of frequently read files on fast sources, like SSDs.
+
+    A file is promoted once promote_after handles have read it, copied on a
+    background thread. The file on its own source stays authoritative: a
+    copy is only served while the original still has the size and mtime it
+    had when it was copied, and changes through the mount drop it at once.
+    Every fast source holds at most capacity bytes of copies, the least
+    recently opened ones are evicted first. Copies of an earlier mount are
+    set aside at once and removed in the background from start().'''
+
+    def __init__(self, dirs, capacity, promote_after=4):
+        self.dirs = dirs
+        self.capacity = capacity
+        self.promote_after = promote_after
+        self._heat = Counter()
+        self._copies = OrderedDict()
+        self._used = dict((fast_dir, 0) for fast_dir in dirs)
+        self._queued = set()
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        self._staging = itertools.count()
+        self._counters = Counter()
+        self._clearing = None
+        for fast_dir in dirs:
+            self._set_aside(fast_dir)
+
+    def start(self):
+        '''Remove the copies set aside, on a thread of the process that serves the mount'''
+        old = [os.path.join(fast_dir, name) for fast_dir in self.dirs
+               for name in os.listdir(fast_dir) if name.startswith(CACHE_DIR + '-old-')]
+        if old:
+            self._clearing = threading.Thread(target=lambda: [fs.remove_tree(path) for path in old],
+                                              name='cinchfs-clear-cache', daemon=True)
+            self._clearing.start()
+
+    def lookup(self, path, real_path):
+        '''The CachedCopy to open path from, None to open real_path itself'''
+        with self._lock:
+            copy = self._copies.get(path)
+            if copy is None:
+                self._counters['misses'] += 1
+                return None
+        try:
+            st = os.stat(real_path)
+        except OSError:
+            st = None
+        if st is None or (st.st_size, st.st_mtime_ns) != (copy.size, copy.mtime_ns):
+            # changed behind our back
+            self.invalidate(path)
+            return None
+        with self._lock:
+            if path not in self._copies:
+                return None
+            self._copies.move_to_end(path)
+            self._counters['hits'] += 1
+        return copy
+
+    def read(self, path, real_path):
+        '''Count a handle reading path, once per handle'''
+        with self._lock:
+            if path in self._copies or path in self._queued:
+                return
+            self._heat[path] += 1
+            if self._heat[path] < self.promote_after:
+                if len(self._heat) > HEAT_ENTRIES:
+                    self._cool()
+                return
+            del self._heat[path]
+            self._queued.add(path)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='cinchfs-promote', daemon=True)
+                self._worker.start()
+        self._queue.put((path, real_path))
+
+    def invalidate(self, path, tree=False):
+        '''Drop the copies of path, or of everything below it too. True if there were any'''
+        prefix = path.rstrip('/') + '/'
+        with self._lock:
+            matches = [cached for cached in self._copies if cached == path or tree and cached.startswith(prefix)]
+            self._queued.difference_update([queued for queued in self._queued if queued == path or tree and queued.startswith(prefix)])
+            dropped = [self._drop(cached) for cached in matches]
+        for copy in dropped:
+            self._unlink(copy.path)
+        return bool(dropped)
+
+    def holds(self, real_path):
+        '''Whether real_path is one of our copies'''
+        return any(real_path.startswith(os.path.join(fast_dir, CACHE_DIR) + '/') for fast_dir in self.dirs)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'hits': self._counters['hits'],
+                'misses': self._counters['misses'],
+                'promotions': self._counters['promotions'],
+                'evictions': self._counters['evictions'],
+                'copies': len(self._copies),
+                'used_bytes': dict(self._used),
+            }
+
+    def wait(self):
+        '''Block until every queued promotion has finished'''
+        self._queue.join()
+
+    def close(self):
+        if self._worker is not None:
+            self._queue.put(None)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._promote(*item)
+            except OSError:
+                log.warning("Promoting %s to the fast tier failed", item[0], exc_info=True)
+                with self._lock:
+                    self._queued.discard(item[0])
+            finally:
+                self._queue.task_done()
+
+    def _promote(self, path, real_path):
+        st = os.stat(real_path)
+        if not stat.S_ISREG(st.st_mode) or st.st_size > self.capacity:
+            with self._lock:
+                self._queued.discard(path)
+            return
+
+        with self._lock:
+            fast_dir = min(self.dirs, key=lambda fast_dir: self._used[fast_dir])
+            evicted = self._make_room(fast_dir, st.st_size)
+            # reserved now, so racing promotions don't overfill the source
+            self._used[fast_dir] += st.st_size
+        for copy in evicted:
+            self._unlink(copy.path)
+
+        copy = CachedCopy(os.path.join(fast_dir, CACHE_DIR, 'files', path.lstrip('/')), fast_dir, st.st_size, st.st_mtime_ns)
+        staging = os.path.join(fast_dir, CACHE_DIR, 'staging', str(next(self._staging)))
+        try:
+            os.makedirs(os.path.dirname(staging), exist_ok=True)
+            fs.copy_file(real_path, staging)
+            after = os.stat(real_path)
+            os.makedirs(os.path.dirname(copy.path), exist_ok=True)
+            os.rename(staging, copy.path)
+        except OSError:
+            self._unlink(staging)
+            with self._lock:
+                self._used[fast_dir] -= st.st_size
+            raise
+
+        with self._lock:
+            # dropped or changed while it was copied
+            if path in self._queued and (after.st_size, after.st_mtime_ns) == (copy.size, copy.mtime_ns):
+                self._queued.discard(path)
+                self._copies[path] = copy
+                self._counters['promotions'] += 1
+                return
+            self._queued.discard(path)
+            self._used[fast_dir] -= st.st_size
+        self._unlink(copy.path)
+
+    def _make_room(self, fast_dir, size):
+        # least recently opened copies first, the caller unlinks them outside the lock
+        evicted = []
+        for path in [path for path, copy in self._copies.items() if copy.dir == fast_dir]:
+            if self._used[fast_dir] + size <= self.capacity:
+                break
+            evicted.append(self._drop(path))
+            self._counters['evictions'] += 1
+        return evicted
+
+    def _drop(self, path):
+        copy = self._copies.pop(path)
+        self._used[copy.dir] -= copy.size
+        return copy
+
+    def _cool(self):
+        # halve all heat, so files that were only hot long ago are forgotten
+        for path, heat in list(self._heat.items()):
+            if heat > 1:
+                self._heat[path] = heat // 2
+            else:
+                del self._heat[path]
+
+    def _unlink(self, path):
+        # readers that still have the copy open keep reading it
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _set_aside(self, fast_dir):
+        # copies from an earlier mount can't be trusted, start() removes them
+        cache_dir = os.path.join(fast_dir, CACHE_DIR)
+        if os.path.lexists(cache_dir):
+            os.rename(cache_dir, f"{cache_dir}-old-{time.time_ns()}")
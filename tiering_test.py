@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import os
+from tiering import CACHE_DIR, FastTier
+
+
+def make_file(tmp_path, name, contents):
+    path = tmp_path / "disk0" / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(contents)
+    return str(path)
+
+
+class TestFastTier(object):
+
+    def fast(self, tmp_path, capacity=1024, promote_after=2):
+        os.makedirs(tmp_path / "ssd", exist_ok=True)
+        return FastTier([str(tmp_path / "ssd")], capacity, promote_after)
+
+    def test_hot_files_are_promoted(self, tmp_path):
+        real_path = make_file(tmp_path, "file", b"hello")
+        tier = self.fast(tmp_path)
+        tier.read("/file", real_path)
+        tier.wait()
+        assert tier.lookup("/file", real_path) is None
+        tier.read("/file", real_path)
+        tier.wait()
+        copy = tier.lookup("/file", real_path)
+        assert copy.path == str(tmp_path / "ssd" / CACHE_DIR / "files" / "file")
+        with open(copy.path, "rb") as f:
+            assert f.read() == b"hello"
+
+    def test_changed_originals_are_not_served(self, tmp_path):
+        real_path = make_file(tmp_path, "file", b"hello")
+        tier = self.fast(tmp_path, promote_after=1)
+        tier.read("/file", real_path)
+        tier.wait()
+        with open(real_path, "ab") as f:
+            f.write(b"!")
+        assert tier.lookup("/file", real_path) is None
+        assert tier.snapshot()["copies"] == 0
+
+    def test_least_recently_opened_copies_are_evicted(self, tmp_path):
+        tier = self.fast(tmp_path, capacity=10, promote_after=1)
+        paths = dict((name, make_file(tmp_path, name, b"12345")) for name in ("a", "b", "c"))
+        for name in ("a", "b"):
+            tier.read("/" + name, paths[name])
+            tier.wait()
+        tier.lookup("/a", paths["a"])
+        tier.read("/c", paths["c"])
+        tier.wait()
+        assert tier.lookup("/a", paths["a"]) is not None
+        assert tier.lookup("/b", paths["b"]) is None
+        assert tier.lookup("/c", paths["c"]) is not None
+        assert tier.snapshot()["evictions"] == 1
+
+    def test_invalidate_tree(self, tmp_path):
+        tier = self.fast(tmp_path, promote_after=1)
+        real_path = make_file(tmp_path, "dir/file", b"hello")
+        tier.read("/dir/file", real_path)
+        tier.wait()
+        assert tier.invalidate("/dir", tree=True)
+        assert not os.path.exists(tmp_path / "ssd" / CACHE_DIR / "files" / "dir" / "file")
+        assert not tier.invalidate("/dir", tree=True)
+
+    def test_copies_of_an_earlier_mount_are_cleared(self, tmp_path):
+        os.makedirs(tmp_path / "ssd" / CACHE_DIR / "files")
+        # set aside by a mount that never got to remove them
+        os.makedirs(tmp_path / "ssd" / (CACHE_DIR + "-old-1"))
+        tier = self.fast(tmp_path)
+        assert not os.path.exists(tmp_path / "ssd" / CACHE_DIR)
+        assert tier.snapshot()["copies"] == 0
+        tier.start()
+        tier._clearing.join()
+        assert os.listdir(tmp_path / "ssd") == []
@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
 
 import os
+import sys
+import json
+import time
 import argparse
-import shutil
+import threading
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.mover import Journal, Mover, OnlineMover, PRIVATE_PREFIX
 
 
 class BalanceSource():
@@ -15,63 +23,148 @@ class BalanceSource():
 
 SourceFile = namedtuple('SourceFile', 'file rel size')
 
+class SizeCache():
+    '''Directory sizes from earlier runs, keyed by directory mtime.
+
+    A directory whose mtime is unchanged is not listed again, only its
+    subdirectories are checked. Files that grew in place without changing
+    their directory's mtime are not noticed until the directory changes.'''
+
+    def __init__(self, path=None):
+        self.path = path
+        self._dirs = {}
+        self._seen = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._dirs = dict((dir_path, tuple(entry)) for dir_path, entry in json.load(f).items())
+
+    def get(self, dir_path, mtime):
+        entry = self._dirs.get(dir_path)
+        if entry is not None and entry[0] == mtime:
+            self._seen[dir_path] = entry
+            return entry[1], entry[2]
+        return None
+
+    def put(self, dir_path, mtime, files_size, subdirs):
+        self._seen[dir_path] = (mtime, files_size, subdirs)
+
+    def save(self):
+        # only directories seen in this run are kept, removed ones drop out
+        if self.path:
+            with open(self.path, 'w') as f:
+                json.dump(self._seen, f)
+
+
+class Progress():
+    '''Reports scan progress on stderr at most once per interval'''
+
+    def __init__(self, interval=5.0, out=sys.stderr):
+        self.interval = interval
+        self.out = out
+        self._entries = 0
+        self._bytes = 0
+        self._reported = time.monotonic()
+        self._lock = threading.Lock()
+
+    def scanned(self, source, rel, size):
+        with self._lock:
+            self._entries += 1
+            self._bytes += size
+            now = time.monotonic()
+            if now - self._reported >= self.interval:
+                self._reported = now
+                print(f"Scanned {self._entries} entries, {self._bytes} bytes (last {rel} on {source})", file=self.out)
+
+
 class Balancer():
 
-    def __init__(self, sources):
+    def __init__(self, sources, size_cache=None, progress=None, mover=None):
         self.sources = sources
+        self.size_cache = size_cache or SizeCache()
+        self.progress = progress
+        self.mover = mover or Mover()
+
+    def balance(self, dry_run=False, tolerance=0):
+        plan = self.plan(tolerance)
+        self.execute(plan, dry_run)
+        return plan
+
+    def plan(self, tolerance=0):
+        '''Work out every move up front, without touching the sources.
 
-    def balance(self, dry_run=False):
+        Moves only go from sources above the target to sources below it, and
+        never push either one past the target. The most overloaded source is
+        planned first, largest entries first, each onto the destination it
+        fills most tightly. Sources within tolerance bytes of the target are
+        left alone.'''
         balance_sources = []
         for source in self.sources:
             (free_bytes, total_bytes, used_bytes) = self._get_source_usage_stats(source)
             balance_source = BalanceSource(path=source, free_bytes=free_bytes, total_bytes=total_bytes, used_bytes=used_bytes)
             balance_sources.append(balance_source)
+        before = dict((source.path, source.used_bytes) for source in balance_sources)
 
         desired_used_bytes = sum([source.used_bytes for source in balance_sources])/len(balance_sources)
-        overloaded_sources = [source for source in balance_sources if source.used_bytes > desired_used_bytes]
-        overloaded_sources.sort(key=lambda x: x.used_bytes)  # most overloaded first
-        underloaded_sources = [source for source in balance_sources if source not in overloaded_sources]
-        underloaded_sources.sort(key=lambda x: (x.used_bytes, x.path), reverse=True)  # most underloaded first
+        overloaded_sources = [source for source in balance_sources if source.used_bytes > desired_used_bytes + tolerance]
+        overloaded_sources.sort(key=lambda x: x.used_bytes, reverse=True)  # most overloaded first
+        underloaded_sources = [source for source in balance_sources if source.used_bytes < desired_used_bytes - tolerance]
+        underloaded_sources.sort(key=lambda x: (x.used_bytes, x.path), reverse=True)  # ties go to the first of these
 
-        for originating_source in overloaded_sources:
-            files = os.listdir(originating_source.path)
-            balanced_files = []
-
-            source_files = []
-            for file in files:
-                orig_path = os.path.join(originating_source.path, file)
-                size = self._get_path_size(orig_path)
-                source_file = SourceFile(file=orig_path, rel=file, size=size)
-                source_files.append(source_file)
+        scanned_sources = self._scan_sources([source.path for source in overloaded_sources])
 
+        moves = []
+        for originating_source in overloaded_sources:
+            source_files = scanned_sources[originating_source.path]
             source_files.sort(key=lambda tup: (tup[2], tup[1]), reverse=True)  # by largest size, then reverse relative path
 
-            for destination_source in underloaded_sources:
-                # filter out files that have already been balanced to other drives
-                unbalanced_source_files = [f for f in source_files if f.rel not in balanced_files]
-                for source_file in unbalanced_source_files:
+            for source_file in source_files:
+                # moving it makes the originator store too little data, or there is nothing to gain
+                if source_file.size == 0 or originating_source.used_bytes - source_file.size < desired_used_bytes:
+                    continue
 
-                    # it doesn't fit on the destination
-                    if destination_source.free_bytes - source_file.size < 0:
-                        continue
+                destination_source = self._best_fit(underloaded_sources, source_file.size, desired_used_bytes)
+                if destination_source is None:
+                    continue
 
-                    # it brings too much data to the destination
-                    if destination_source.used_bytes + source_file.size > desired_used_bytes:
-                        continue
+                moves.append({'entry': source_file.rel, 'from': originating_source.path,
+                              'to': destination_source.path, 'bytes': source_file.size})
+                originating_source.used_bytes = originating_source.used_bytes - source_file.size
+                originating_source.free_bytes = originating_source.free_bytes + source_file.size
+                destination_source.used_bytes = destination_source.used_bytes + source_file.size
+                destination_source.free_bytes = destination_source.free_bytes - source_file.size
 
-                    # it makes the originator store too little data
-                    if originating_source.used_bytes - source_file.size < desired_used_bytes:
-                        continue
+        return {
+            'target_used_bytes': desired_used_bytes,
+            'tolerance_bytes': tolerance,
+            'bytes_moved': sum(move['bytes'] for move in moves),
+            'moves': moves,
+            'sources': dict((source.path, {
+                'total_bytes': source.total_bytes,
+                'used_bytes': before[source.path],
+                'predicted_used_bytes': source.used_bytes,
+                'predicted_free_bytes': source.free_bytes,
+            }) for source in balance_sources),
+        }
 
-                    print(f"Moving {source_file.rel} from {originating_source.path} to {destination_source.path}")
-                    if not dry_run:
-                        shutil.move(source_file.file, os.path.join(destination_source.path, source_file.rel))
+    def _best_fit(self, destinations, size, desired_used_bytes):
+        # the destination left with the least room below the target after taking the entry
+        best = None
+        best_room = None
+        for destination_source in destinations:
+            room = desired_used_bytes - destination_source.used_bytes - size
+            # it brings too much data to the destination, or it doesn't fit
+            if room < 0 or destination_source.free_bytes - size < 0:
+                continue
+            if best is None or room < best_room:
+                best, best_room = destination_source, room
+        return best
 
-                    balanced_files.append(source_file.rel)
-                    originating_source.used_bytes = originating_source.used_bytes - source_file.size
-                    originating_source.free_bytes = originating_source.free_bytes + source_file.size
-                    destination_source.used_bytes = destination_source.used_bytes + source_file.size
-                    destination_source.free_bytes = destination_source.free_bytes - source_file.size
+    def execute(self, plan, dry_run=False):
+        if dry_run:
+            for move in plan['moves']:
+                print(f"Moving {move['entry']} from {move['from']} to {move['to']}")
+            return
+        self.mover.run(plan['moves'])
 
     def _get_source_usage_stats(self, source):
         st = os.statvfs(source)
@@ -80,29 +173,86 @@ class Balancer():
         used_bytes = (st.f_blocks - st.f_bfree) * st.f_frsize
         return free_bytes, total_bytes, used_bytes
 
+    def _scan_sources(self, sources):
+        # every source is its own disk, so they are scanned in parallel
+        with ThreadPoolExecutor(max_workers=max(len(sources), 1)) as executor:
+            scanned = dict(zip(sources, executor.map(self._scan_source, sources)))
+        self.size_cache.save()
+        return scanned
+
+    def _scan_source(self, source):
+        source_files = []
+        for file in os.listdir(source):
+            if file.startswith(PRIVATE_PREFIX):
+                # staging, cache and landing directories of cinchfs
+                continue
+            orig_path = os.path.join(source, file)
+            size = self._get_path_size(orig_path)
+            source_files.append(SourceFile(file=orig_path, rel=file, size=size))
+            if self.progress is not None:
+                self.progress.scanned(source, file, size)
+        return source_files
+
     def _get_path_size(self, path):
-        if os.path.isfile(path):
-            return os.path.getsize(path)
+        st = os.stat(path, follow_symlinks=False)
+        if not os.path.isdir(path) or os.path.islink(path):
+            return st.st_size
 
         # traverse dir and sum file sizes
-        total_size = 0
-        for dirpath, dirnames, filenames in os.walk(path):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
-                total_size += os.path.getsize(fp)
-        return total_size
-            
+        return self._get_dir_size(path, st.st_mtime_ns)
+
+    def _get_dir_size(self, path, mtime):
+        cached = self.size_cache.get(path, mtime)
+        if cached is not None:
+            files_size, subdirs = cached
+            subdirs = [(subdir, os.stat(os.path.join(path, subdir), follow_symlinks=False).st_mtime_ns) for subdir in subdirs]
+        else:
+            files_size = 0
+            subdirs = []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    st = entry.stat(follow_symlinks=False)
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append((entry.name, st.st_mtime_ns))
+                    else:
+                        files_size += st.st_size
+            self.size_cache.put(path, mtime, files_size, [subdir for subdir, _ in subdirs])
+
+        return files_size + sum(self._get_dir_size(os.path.join(path, subdir), subdir_mtime) for subdir, subdir_mtime in subdirs)
+
+
+def main(sources, dry_run, size_cache, tolerance, plan_path, execute_path, journal, bandwidth, online):
+    mover = OnlineMover(online) if online else Mover(Journal(journal), bandwidth)
+    balancer = Balancer(sources, SizeCache(size_cache), Progress(), mover)
+    if execute_path:
+        with open(execute_path) as f:
+            plan = json.load(f)
+        balancer.execute(plan, dry_run)
+        return
 
-def main(sources, dry_run):
-    balancer = Balancer(sources)
-    balancer.balance(dry_run)
+    plan = balancer.plan(tolerance)
+    if plan_path:
+        with open(plan_path, 'w') as f:
+            json.dump(plan, f, indent=2)
+    print(f"Moving {len(plan['moves'])} entries, {plan['bytes_moved']} bytes")
+    for source, usage in plan['sources'].items():
+        print(f"{source}: {usage['used_bytes']} -> {usage['predicted_used_bytes']} bytes used")
+    if not plan_path:
+        balancer.execute(plan, dry_run)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='The Cinch Filesystem Balancer')
     parser.add_argument('--dry-run', action='store_true', help="Don't move any files")
+    parser.add_argument('--size-cache', help="Keep directory sizes in this file so later runs only scan what changed")
+    parser.add_argument('--tolerance', type=int, default=0, help="Leave sources within this many bytes of the target alone")
+    parser.add_argument('--plan', dest='plan_path', help="Only write the move plan to this file for review")
+    parser.add_argument('--execute', dest='execute_path', help="Execute a previously written plan file")
+    parser.add_argument('--journal', help="Record finished moves in this file, so an interrupted run can be resumed")
+    parser.add_argument('--bandwidth', type=int, help="Limit moves to this many bytes per second on every disk")
+    parser.add_argument('--online', metavar='MOUNTPOINT', help="Let the cinchfs mounted here migrate the entries, it must be mounted with the same sources")
     parser.add_argument('sources', action="store")
     args = parser.parse_args()
 
     sources = args.sources.split(',')
-    main(sources, args.dry_run)
+    main(sources, args.dry_run, args.size_cache, args.tolerance, args.plan_path, args.execute_path, args.journal, args.bandwidth, args.online)
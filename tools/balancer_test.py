@@ -1,7 +1,19 @@
 #!/usr/bin/env python3
 
+import io
 import os
-from tools.balancer import Balancer
+import pytest
+import fusefs
+from tools.balancer import Balancer, Progress, SizeCache
+
+
+@pytest.fixture(autouse=True)
+def plain_copies(monkeypatch):
+    # pyfakefs file descriptors are not real ones, the kernel can't copy between them
+    monkeypatch.setattr(fusefs, "USE_REFLINK", False)
+    monkeypatch.setattr(fusefs, "USE_COPY_FILE_RANGE", False)
+    monkeypatch.setattr(fusefs, "USE_SENDFILE", False)
+
 
 class TestBalance(object):
 
@@ -141,3 +153,98 @@ class TestBalance(object):
         assert os.path.exists("/disk0/test2")
         assert os.path.exists("/disk0/test1")
         assert os.path.exists("/disk0/test0")
+
+
+class TestPlan(object):
+
+    def test_plan_predicts_usage_without_moving_anything(self, fs, monkeypatch):
+        monkeypatch.setattr(Balancer, "_get_source_usage_stats", {"/disk0": (0, 200, 200), "/disk1": (200, 200, 0)}.get)
+        fs.add_mount_point("/disk0")
+        fs.add_mount_point("/disk1")
+        fs.create_file("/disk0/test0", contents='a' * 100, encoding='UTF-8')
+        fs.create_file("/disk0/test1", contents='a' * 100, encoding='UTF-8')
+
+        plan = Balancer(["/disk0", "/disk1"]).plan()
+        assert plan['moves'] == [{'entry': 'test1', 'from': '/disk0', 'to': '/disk1', 'bytes': 100}]
+        assert plan['bytes_moved'] == 100
+        assert plan['sources']['/disk0']['predicted_used_bytes'] == 100
+        assert plan['sources']['/disk1']['predicted_used_bytes'] == 100
+        assert os.path.exists("/disk0/test1")
+
+    def test_most_overloaded_source_is_planned_first(self, fs, monkeypatch):
+        monkeypatch.setattr(Balancer, "_get_source_usage_stats", {
+            "/disk0": (40, 300, 260),
+            "/disk1": (100, 300, 200),
+            "/disk2": (260, 300, 40),
+        }.get)
+        for source in ("/disk0", "/disk1", "/disk2"):
+            fs.add_mount_point(source)
+        fs.create_file("/disk0/test0", contents='a' * 90, encoding='UTF-8')
+        fs.create_file("/disk1/test1", contents='a' * 40, encoding='UTF-8')
+
+        plan = Balancer(["/disk0", "/disk1", "/disk2"]).plan()
+        # disk2 only has room below the target for one of them
+        assert [(move['entry'], move['to']) for move in plan['moves']] == [('test0', '/disk2')]
+
+    def test_sources_within_tolerance_are_left_alone(self, fs, monkeypatch):
+        monkeypatch.setattr(Balancer, "_get_source_usage_stats", {"/disk0": (90, 200, 110), "/disk1": (110, 200, 90)}.get)
+        fs.add_mount_point("/disk0")
+        fs.add_mount_point("/disk1")
+        fs.create_file("/disk0/test0", contents='a' * 10, encoding='UTF-8')
+
+        assert Balancer(["/disk0", "/disk1"]).plan(tolerance=10)['moves'] == []
+        assert len(Balancer(["/disk0", "/disk1"]).plan()['moves']) == 1
+
+    def test_execute_skips_stale_moves(self, fs, monkeypatch, capsys):
+        fs.add_mount_point("/disk0")
+        fs.add_mount_point("/disk1")
+        fs.create_file("/disk0/test0", contents='a' * 10, encoding='UTF-8')
+        plan = {'moves': [
+            {'entry': 'gone', 'from': '/disk0', 'to': '/disk1', 'bytes': 10},
+            {'entry': 'test0', 'from': '/disk0', 'to': '/disk1', 'bytes': 10},
+        ]}
+
+        Balancer(["/disk0", "/disk1"]).execute(plan)
+        assert os.path.exists("/disk1/test0")
+        assert "Skipping gone" in capsys.readouterr().out
+
+
+class TestScan(object):
+
+    def test_dir_sizes_include_subdirectories(self, fs):
+        fs.create_file("/disk0/dir/a", contents='a' * 10)
+        fs.create_file("/disk0/dir/sub/b", contents='a' * 20)
+        fs.create_file("/disk0/file", contents='a' * 5)
+        scanned = Balancer(["/disk0"])._scan_sources(["/disk0"])
+        assert sorted((f.rel, f.size) for f in scanned["/disk0"]) == [("dir", 30), ("file", 5)]
+
+    def test_private_dirs_are_not_scanned(self, fs):
+        fs.create_file("/disk0/.cinchfs-moving/dir/a", contents='a' * 10)
+        fs.create_file("/disk0/.cinchfs-landing/b", contents='a' * 10)
+        fs.create_file("/disk0/file", contents='a' * 5)
+        scanned = Balancer(["/disk0"])._scan_sources(["/disk0"])
+        assert [f.rel for f in scanned["/disk0"]] == ["file"]
+
+    def test_unchanged_dirs_come_from_the_size_cache(self, fs, monkeypatch):
+        fs.create_file("/disk0/dir/a", contents='a' * 10)
+        fs.create_file("/disk0/dir/sub/b", contents='a' * 20)
+        Balancer(["/disk0"], SizeCache("/cache.json"))._scan_sources(["/disk0"])
+        monkeypatch.setattr(os, "scandir", None)
+        scanned = Balancer(["/disk0"], SizeCache("/cache.json"))._scan_sources(["/disk0"])
+        assert scanned["/disk0"][0].size == 30
+
+    def test_changed_dirs_are_scanned_again(self, fs):
+        fs.create_file("/disk0/dir/a", contents='a' * 10)
+        fs.create_file("/disk0/dir/sub/b", contents='a' * 20)
+        Balancer(["/disk0"], SizeCache("/cache.json"))._scan_sources(["/disk0"])
+        fs.create_file("/disk0/dir/sub/c", contents='a' * 5)
+        os.utime("/disk0/dir/sub", ns=(1, 1))
+        scanned = Balancer(["/disk0"], SizeCache("/cache.json"))._scan_sources(["/disk0"])
+        assert scanned["/disk0"][0].size == 35
+
+    def test_progress_is_reported(self, fs):
+        fs.create_file("/disk0/a", contents='a' * 10)
+        fs.create_file("/disk1/b", contents='a' * 20)
+        out = io.StringIO()
+        Balancer(["/disk0", "/disk1"], progress=Progress(interval=0, out=out))._scan_sources(["/disk0", "/disk1"])
+        assert "Scanned 2 entries, 30 bytes" in out.getvalue()
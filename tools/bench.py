@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cinchfs import Filesystem, parse_mount_options, split_mount_options
+
+CHUNK = 128 * 1024
+
+
+class Recorder():
+    '''Latencies of one workload'''
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self.elapsed = None
+
+    def time(self, cfs, op, *args):
+        start = time.perf_counter_ns()
+        result = cfs(op, *args)
+        self.latencies.append(time.perf_counter_ns() - start)
+        return result
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.started
+
+    def result(self):
+        latencies = sorted(self.latencies)
+        return {
+            'ops': len(latencies),
+            'seconds': self.elapsed,
+            'ops_per_s': len(latencies) / self.elapsed if self.elapsed else 0,
+            'mb_per_s': self.bytes / self.elapsed / 1e6 if self.elapsed else 0,
+            'p50_us': percentile(latencies, 0.5) / 1e3,
+            'p99_us': percentile(latencies, 0.99) / 1e3,
+            'max_us': latencies[-1] / 1e3 if latencies else 0,
+        }
+
+
+def percentile(latencies, fraction):
+    if not latencies:
+        return 0
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+class Bench():
+    '''Builds real temporary sources and drives Filesystem directly, no mount needed'''
+
+    def __init__(self, scale=1, options=None):
+        self.scale = scale
+        self.options = options or {}
+
+    def run(self, workloads):
+        return dict((name, getattr(self, name)()) for name in workloads)
+
+    def metadata_storm(self):
+        '''readdir and getattr every entry of a deep tree'''
+        with Scratch(4) as scratch:
+            depth, fanout, files = 4, 3, 4 * self.scale
+            for source_idx, source in enumerate(scratch.sources):
+                make_tree(os.path.join(source, f"top{source_idx}"), depth, fanout, files)
+            cfs = scratch.filesystem(self.options)
+            recorder = Recorder('metadata_storm')
+            pending = ['/']
+            while pending:
+                path = pending.pop()
+                for dirent in recorder.time(cfs, 'readdir', path, None):
+                    name = dirent if isinstance(dirent, str) else dirent[0]
+                    if name in ('.', '..'):
+                        continue
+                    child = os.path.join(path, name)
+                    attrs = recorder.time(cfs, 'getattr', child)
+                    if attrs['st_mode'] & 0o040000:
+                        pending.append(child)
+            recorder.stop()
+            return recorder.result()
+
+    def small_files(self):
+        '''create, write and release many small files'''
+        with Scratch(4) as scratch:
+            for source_idx, source in enumerate(scratch.sources):
+                os.mkdir(os.path.join(source, f"dir{source_idx}"))
+            cfs = scratch.filesystem(self.options)
+            recorder = Recorder('small_files')
+            data = b'a' * 4096
+            for idx in range(1000 * self.scale):
+                path = f"/dir{idx % len(scratch.sources)}/file{idx}"
+                fh = recorder.time(cfs, 'create', path, 0o644)
+                recorder.bytes += recorder.time(cfs, 'write', path, data, 0, fh)
+                recorder.time(cfs, 'flush', path, fh)
+                recorder.time(cfs, 'release', path, fh)
+            recorder.stop()
+            cfs.destroy('/')
+            return recorder.result()
+
+    def large_sequential(self):
+        '''write and then read back one large file in FUSE sized chunks'''
+        with Scratch(4) as scratch:
+            cfs = scratch.filesystem(self.options)
+            data = os.urandom(CHUNK)
+            chunks = 256 * self.scale
+            results = {}
+
+            recorder = Recorder('large_write')
+            fh = recorder.time(cfs, 'create', '/large', 0o644)
+            for idx in range(chunks):
+                recorder.bytes += recorder.time(cfs, 'write', '/large', data, idx * CHUNK, fh)
+            recorder.time(cfs, 'release', '/large', fh)
+            recorder.stop()
+            results['write'] = recorder.result()
+
+            recorder = Recorder('large_read')
+            fh = recorder.time(cfs, 'open', '/large', os.O_RDONLY)
+            for idx in range(chunks):
+                recorder.bytes += len(recorder.time(cfs, 'read', '/large', CHUNK, idx * CHUNK, fh))
+            recorder.time(cfs, 'release', '/large', fh)
+            recorder.stop()
+            results['read'] = recorder.result()
+            cfs.destroy('/')
+            return results
+
+    def placement(self):
+        '''place new top-level entries and look up missing ones with 2 to 32 sources'''
+        results = {}
+        for count in (2, 4, 8, 16, 32):
+            with Scratch(count) as scratch:
+                for source_idx, source in enumerate(scratch.sources):
+                    os.mkdir(os.path.join(source, f"existing{source_idx}"))
+                cfs = scratch.filesystem(self.options)
+                recorder = Recorder(f'placement_{count}')
+                for idx in range(200 * self.scale):
+                    recorder.time(cfs, 'mkdir', f"/new{idx}", 0o755)
+                    recorder.time(cfs, 'getattr', f"/existing{idx % count}")
+                    try:
+                        recorder.time(cfs, 'getattr', f"/missing{idx}")
+                    except OSError:
+                        pass
+                recorder.stop()
+                results[str(count)] = recorder.result()
+        return results
+
+
+class Scratch():
+    '''Temporary source directories that are removed afterwards'''
+
+    def __init__(self, count):
+        self.count = count
+
+    def __enter__(self):
+        self.root = tempfile.mkdtemp(prefix='cinchfs-bench-')
+        self.sources = [os.path.join(self.root, f"disk{idx}") for idx in range(self.count)]
+        for source in self.sources:
+            os.mkdir(source)
+        return self
+
+    def __exit__(self, *exc):
+        shutil.rmtree(self.root)
+
+    def filesystem(self, options):
+        return Filesystem(self.sources, os.path.join(self.root, 'mnt'), **options)
+
+
+def make_tree(path, depth, fanout, files):
+    os.makedirs(path)
+    for idx in range(files):
+        with open(os.path.join(path, f"file{idx}"), 'wb') as f:
+            f.write(b'a' * idx)
+    if depth > 1:
+        for idx in range(fanout):
+            make_tree(os.path.join(path, f"dir{idx}"), depth - 1, fanout, files)
+
+
+def compare(baseline, current, tolerance, path=''):
+    '''Yield (workload, baseline ops/s, current ops/s) for every workload that got slower than tolerance allows'''
+    for name, result in current.items():
+        if name not in baseline:
+            continue
+        if 'ops_per_s' in result:
+            before = baseline[name]['ops_per_s']
+            if before and result['ops_per_s'] < before * (1 - tolerance):
+                yield path + name, before, result['ops_per_s']
+        else:
+            yield from compare(baseline[name], result, tolerance, path + name + '.')
+
+
+WORKLOADS = ['metadata_storm', 'small_files', 'large_sequential', 'placement']
+
+
+def main(workloads, scale, options, output, baseline, tolerance):
+    mount_options = parse_mount_options(options)
+    results = Bench(scale, split_mount_options(mount_options)).run(workloads)
+
+    report = json.dumps(results, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = list(compare(json.load(f), results, tolerance))
+        for name, before, after in regressions:
+            print(f"Regression in {name}: {before:.0f} -> {after:.0f} ops/s", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='The Cinch Filesystem Benchmarks')
+    parser.add_argument('--workload', action='append', choices=WORKLOADS, dest='workloads', help="Run only this workload, may be repeated")
+    parser.add_argument('--scale', type=int, default=1, help="Multiply the size of every workload")
+    parser.add_argument('-o', action="store", dest="options", help="cinchfs mount options to build the Filesystem with")
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    parser.add_argument('--compare', dest='baseline', help="A previous JSON report to check for regressions against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Allowed ops/s drop before a regression is reported")
+    args = parser.parse_args()
+
+    sys.exit(main(args.workloads or WORKLOADS, args.scale, args.options, args.output, args.baseline, args.tolerance))
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+
+from tools.bench import Bench, compare
+
+
+class TestBench(object):
+
+    def test_small_files_reports_latencies(self):
+        result = Bench().run(['small_files'])['small_files']
+        assert result['ops'] == 4000
+        assert result['ops_per_s'] > 0
+        assert result['p50_us'] <= result['p99_us'] <= result['max_us']
+
+    def test_compare_finds_regressions(self):
+        baseline = {'small_files': {'ops_per_s': 100}, 'placement': {'2': {'ops_per_s': 100}, '4': {'ops_per_s': 100}}}
+        current = {'small_files': {'ops_per_s': 95}, 'placement': {'2': {'ops_per_s': 50}, '4': {'ops_per_s': 120}}}
+        assert list(compare(baseline, current, 0.1)) == [('placement.2', 100, 50)]
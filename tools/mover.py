@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shlex
+import time
+import errno
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import fusefs as fs
+from utilities import Throttle
+
+# root entries of a source with this prefix belong to cinchfs and its tools, they are never moved
+PRIVATE_PREFIX = '.cinchfs'
+# moves are copied here on the destination first
+STAGING_DIR = PRIVATE_PREFIX + '-moving'
+
+
+class Journal():
+    '''Append-only record of how far every move of a plan got.
+
+    A move is started, then copied once the staged copy is complete and
+    synced, then done once the original is removed. Replaying the journal
+    tells an interrupted run of the same plan where to pick each move up
+    again. Records of other plans are ignored, and the journal is emptied
+    once a plan ran to completion.'''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.plan = None
+        self._states = {}
+        self._lock = threading.Lock()
+        self._file = None
+        if path is None:
+            return
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line of an interrupted run
+                    self._states[record.get('plan'), _key(record)] = record['state']
+        self._file = open(path, 'a')
+
+    def begin(self, moves):
+        '''Look up and record states for the plan made of moves from now on'''
+        self.plan = plan_id(moves)
+
+    def finish(self):
+        '''Forget everything, the plan ran to completion'''
+        with self._lock:
+            self._states = {}
+            if self._file is not None:
+                self._file.truncate(0)
+                os.fsync(self._file.fileno())
+
+    def state(self, move):
+        return self._states.get((self.plan, _key(move)))
+
+    def record(self, move, state):
+        with self._lock:
+            self._states[self.plan, _key(move)] = state
+            if self._file is not None:
+                self._file.write(json.dumps({'plan': self.plan, 'entry': move['entry'], 'from': move['from'],
+                                             'to': move['to'], 'state': state}) + '\n')
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def plan_id(moves):
+    '''Identifies a plan by its moves, the same plan file run again has the same id'''
+    encoded = json.dumps([_key(move) for move in moves]).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def _key(move):
+    return move['entry'], move['from'], move['to']
+
+
+class Mover():
+    '''Runs balancer moves, one stream per source and destination pair.
+
+    Every move is copied into a staging directory on the destination, then
+    renamed into place and only then removed from its source, so no half
+    copied entry ever shows up next to its original. The original is
+    renamed into the staging directory of its source before it is removed,
+    so no half removed one is left next to the copy either.'''
+
+    def __init__(self, journal=None, bandwidth=None):
+        self.journal = journal or Journal()
+        self.bandwidth = bandwidth
+        self._throttles = {}
+        self._lock = threading.Lock()
+
+    def run(self, moves):
+        self.journal.begin(moves)
+        streams = {}
+        for move in moves:
+            streams.setdefault((move['from'], move['to']), []).append(move)
+        with ThreadPoolExecutor(max_workers=max(len(streams), 1)) as executor:
+            futures = [executor.submit(self._run_stream, stream) for stream in streams.values()]
+        for future in futures:
+            future.result()
+        self.journal.finish()
+
+    def _run_stream(self, moves):
+        for move in moves:
+            self.move(move)
+
+    def move(self, move):
+        orig_path = os.path.join(move['from'], move['entry'])
+        dest_path = os.path.join(move['to'], move['entry'])
+        staging_path = os.path.join(move['to'], STAGING_DIR, move['entry'])
+        state = self.journal.state(move)
+
+        if state == 'done':
+            return
+        if state == 'copied':
+            # interrupted between the staged copy and removing the original
+            print(f"Finishing {move['entry']} from {move['from']} to {move['to']}")
+            if os.path.lexists(staging_path):
+                os.rename(staging_path, dest_path)
+            self._finish(move, orig_path)
+            return
+        if os.path.lexists(staging_path):
+            # a copy that never completed
+            fs.remove_tree(staging_path)
+
+        # a reviewed plan may be older than the sources
+        if not os.path.lexists(orig_path) or os.path.lexists(dest_path):
+            print(f"Skipping {move['entry']}, it is no longer on {move['from']} only")
+            return
+
+        print(f"Moving {move['entry']} from {move['from']} to {move['to']}")
+        self.journal.record(move, 'started')
+        try:
+            os.rename(orig_path, dest_path)
+            self.journal.record(move, 'done')
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+        os.makedirs(os.path.dirname(staging_path), exist_ok=True)
+        fs.sync_tree(orig_path, staging_path, paced=self._paced(move['from'], move['to']))
+        self.journal.record(move, 'copied')
+
+        os.rename(staging_path, dest_path)
+        self._finish(move, orig_path)
+
+    def _finish(self, move, orig_path):
+        # the copy must survive a crash before the original is gone
+        fs.fsync_dir(os.path.dirname(os.path.join(move['to'], move['entry'])))
+        retired_path = os.path.join(move['from'], STAGING_DIR, move['entry'])
+        if os.path.lexists(orig_path):
+            # the original leaves the source at once, removing it can take a while
+            os.makedirs(os.path.dirname(retired_path), exist_ok=True)
+            if os.path.lexists(retired_path):
+                fs.remove_tree(retired_path)
+            os.rename(orig_path, retired_path)
+            fs.fsync_dir(move['from'])
+        if os.path.lexists(retired_path):
+            fs.remove_tree(retired_path)
+        self.journal.record(move, 'done')
+
+    def _paced(self, src_disk, dst_disk):
+        # a copy counts against the bandwidth of both disks
+        throttles = (self._throttle(src_disk), self._throttle(dst_disk))
+
+        def paced(nbytes):
+            for throttle in throttles:
+                throttle.wait(nbytes)
+        return paced
+
+    def _throttle(self, disk):
+        with self._lock:
+            if disk not in self._throttles:
+                self._throttles[disk] = Throttle(self.bandwidth)
+            return self._throttles[disk]
+
+
+class OnlineMover():
+    '''Asks a mounted cinchfs to migrate the entries itself, so the mount stays usable.
+
+    The requests go to the control file of the mount, which copies the
+    entries in the background and then switches them over.'''
+
+    def __init__(self, mountpoint, poll_interval=1.0):
+        self.control = os.path.join(mountpoint, '.cinchfs', 'control')
+        self.status = os.path.join(mountpoint, '.cinchfs', 'migrations')
+        self.poll_interval = poll_interval
+
+    def run(self, moves):
+        requested = len(self._migrations())
+        with open(self.control, 'w') as f:
+            for move in moves:
+                print(f"Migrating {move['entry']} from {move['from']} to {move['to']}")
+                f.write(f"migrate {shlex.quote(move['entry'])} {shlex.quote(move['to'])}\n")
+                f.flush()
+
+        while True:
+            migrations = self._migrations()[requested:]
+            if all(migration['state'] in ('done', 'failed') for migration in migrations):
+                break
+            time.sleep(self.poll_interval)
+        for migration in migrations:
+            if migration['state'] == 'failed':
+                print(f"Migrating {migration['entry']} to {migration['to']} failed: {migration.get('error')}")
+
+    def _migrations(self):
+        with open(self.status) as f:
+            return json.load(f)
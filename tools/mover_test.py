@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import errno
+import pytest
+from tools import mover
+from tools.mover import STAGING_DIR, Journal, Mover, OnlineMover
+from utilities import Throttle
+
+
+@pytest.fixture
+def disks(tmp_path, monkeypatch):
+    # the disks share a filesystem here, make renames between them fail like they would across devices
+    disks = [str(tmp_path / f"disk{idx}") for idx in range(2)]
+    for disk in disks:
+        os.mkdir(disk)
+    rename = os.rename
+
+    def cross_device_rename(src, dst):
+        if os.path.relpath(src, tmp_path).split(os.sep)[0] != os.path.relpath(dst, tmp_path).split(os.sep)[0]:
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        rename(src, dst)
+    monkeypatch.setattr(mover.os, "rename", cross_device_rename)
+    return disks
+
+
+def move_of(entry, disks):
+    return {'entry': entry, 'from': disks[0], 'to': disks[1], 'bytes': 0}
+
+
+class TestMover(object):
+
+    def test_copies_are_paced_on_both_disks(self, disks, monkeypatch):
+        waited = []
+        monkeypatch.setattr(Throttle, "wait", lambda throttle, nbytes: waited.append(nbytes))
+        with open(os.path.join(disks[0], "file"), "wb") as f:
+            f.write(b"a" * 100)
+
+        Mover(bandwidth=1000).move(move_of("file", disks))
+        assert sum(waited) == 200
+
+    def test_moves_across_disks_through_staging(self, disks):
+        os.makedirs(os.path.join(disks[0], "dir", "sub"))
+        with open(os.path.join(disks[0], "dir", "sub", "file"), "w") as f:
+            f.write("data")
+
+        Mover().move(move_of("dir", disks))
+        assert not os.path.exists(os.path.join(disks[0], "dir"))
+        with open(os.path.join(disks[1], "dir", "sub", "file")) as f:
+            assert f.read() == "data"
+        assert os.listdir(os.path.join(disks[1], STAGING_DIR)) == []
+
+    def test_resumes_a_copied_move(self, disks, tmp_path):
+        move = move_of("file", disks)
+        with open(os.path.join(disks[0], "file"), "w") as f:
+            f.write("data")
+        os.makedirs(os.path.join(disks[1], STAGING_DIR))
+        with open(os.path.join(disks[1], STAGING_DIR, "file"), "w") as f:
+            f.write("data")
+        journal = Journal(str(tmp_path / "journal"))
+        journal.record(move, 'started')
+        journal.record(move, 'copied')
+        journal.close()
+
+        Mover(Journal(str(tmp_path / "journal"))).move(move)
+        assert not os.path.exists(os.path.join(disks[0], "file"))
+        assert os.path.exists(os.path.join(disks[1], "file"))
+        assert Journal(str(tmp_path / "journal")).state(move) == 'done'
+
+    def test_interrupted_removals_leave_no_original_behind(self, disks, tmp_path, monkeypatch):
+        move = move_of("dir", disks)
+        os.makedirs(os.path.join(disks[0], "dir"))
+        for name in ("a", "b"):
+            with open(os.path.join(disks[0], "dir", name), "w") as f:
+                f.write("data")
+        remove_tree = mover.fs.remove_tree
+
+        def interrupted(path):
+            os.unlink(os.path.join(path, "a"))
+            raise KeyboardInterrupt()
+        monkeypatch.setattr(mover.fs, "remove_tree", interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            Mover(Journal(str(tmp_path / "journal"))).move(move)
+        assert os.listdir(disks[0]) == [STAGING_DIR]
+        assert sorted(os.listdir(os.path.join(disks[1], "dir"))) == ["a", "b"]
+
+        monkeypatch.setattr(mover.fs, "remove_tree", remove_tree)
+        Mover(Journal(str(tmp_path / "journal"))).move(move)
+        assert os.listdir(os.path.join(disks[0], STAGING_DIR)) == []
+        assert Journal(str(tmp_path / "journal")).state(move) == 'done'
+
+    def test_half_copied_entries_are_copied_again(self, disks, tmp_path):
+        move = move_of("file", disks)
+        with open(os.path.join(disks[0], "file"), "w") as f:
+            f.write("data")
+        os.makedirs(os.path.join(disks[1], STAGING_DIR))
+        with open(os.path.join(disks[1], STAGING_DIR, "file"), "w") as f:
+            f.write("da")
+        journal = Journal(str(tmp_path / "journal"))
+        journal.record(move, 'started')
+
+        Mover(journal).move(move)
+        with open(os.path.join(disks[1], "file")) as f:
+            assert f.read() == "data"
+
+    def test_done_moves_are_skipped(self, disks, tmp_path):
+        move = move_of("file", disks)
+        with open(os.path.join(disks[0], "file"), "w") as f:
+            f.write("new")
+        journal = Journal(str(tmp_path / "journal"))
+        journal.begin([move])
+        journal.record(move, 'done')
+        journal.close()
+
+        Mover(Journal(str(tmp_path / "journal"))).run([move])
+        assert os.path.exists(os.path.join(disks[0], "file"))
+        assert not os.path.exists(os.path.join(disks[1], "file"))
+
+    def test_torn_journal_lines_are_ignored(self, tmp_path):
+        (tmp_path / "journal").write_text('{"plan": null, "entry": "a", "from": "/d0", "to": "/d1", "state": "done"}\n{"entry": "b", "fr')
+        journal = Journal(str(tmp_path / "journal"))
+        assert journal.state({'entry': 'a', 'from': '/d0', 'to': '/d1'}) == 'done'
+        assert journal.state({'entry': 'b', 'from': '/d0', 'to': '/d1'}) is None
+
+    def test_a_later_plan_repeats_a_finished_move(self, disks, tmp_path):
+        move = move_of("file", disks)
+        with open(os.path.join(disks[0], "file"), "w") as f:
+            f.write("data")
+        Mover(Journal(str(tmp_path / "journal"))).run([move])
+        assert (tmp_path / "journal").read_text() == ""
+        # moved back by hand, then planned again
+        os.unlink(os.path.join(disks[1], "file"))
+        with open(os.path.join(disks[0], "file"), "w") as f:
+            f.write("data")
+
+        Mover(Journal(str(tmp_path / "journal"))).run([move])
+        assert os.path.exists(os.path.join(disks[1], "file"))
+
+    def test_journals_of_other_plans_are_ignored(self, tmp_path):
+        first, second = move_of("a", ["/d0", "/d1"]), move_of("b", ["/d0", "/d1"])
+        journal = Journal(str(tmp_path / "journal"))
+        journal.begin([first, second])
+        journal.record(first, 'done')
+        journal.close()
+
+        journal = Journal(str(tmp_path / "journal"))
+        journal.begin([first])
+        assert journal.state(first) is None
+        journal.begin([first, second])
+        assert journal.state(first) == 'done'
+
+
+class TestOnlineMover(object):
+
+    def test_requests_migrations_from_the_mount(self, tmp_path):
+        os.makedirs(tmp_path / ".cinchfs")
+        (tmp_path / ".cinchfs" / "migrations").write_text(json.dumps([{"entry": "old", "to": "/disk0", "state": "done"}]))
+        OnlineMover(str(tmp_path)).run([{"entry": "my file", "from": "/disk0", "to": "/disk1", "bytes": 5}])
+        assert (tmp_path / ".cinchfs" / "control").read_text() == "migrate 'my file' /disk1\n"
+
+
+class TestThrottle(object):
+
+    def test_paces_to_the_rate(self, monkeypatch):
+        sleeps = []
+        monkeypatch.setattr(mover.time, "sleep", sleeps.append)
+        throttle = Throttle(1000)
+        throttle.wait(500)
+        throttle.wait(500)
+        assert len(sleeps) == 1
+        assert 0.4 < sleeps[0] <= 0.5
+
+    def test_unlimited_never_sleeps(self, monkeypatch):
+        sleeps = []
+        monkeypatch.setattr(mover.time, "sleep", sleeps.append)
+        Throttle().wait(1 << 30)
+        assert sleeps == []
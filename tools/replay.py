@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cinchfs import Filesystem, parse_mount_options, split_mount_options
+from tracing import read_trace
+
+CREATING_OPS = ('create', 'mkdir', 'mknod', 'symlink', 'link')
+
+
+class Replayer():
+    '''Re-executes a recorded trace against a Filesystem built over scratch sources'''
+
+    def __init__(self, records, sources, options=None):
+        self.records = list(records)
+        self.sources = sources
+        self.options = options or {}
+        self._fhs = {}
+
+    def prepare(self):
+        '''Recreate the files and directories the trace used before creating them itself'''
+        files, dirs = initial_namespace(self.records)
+        for idx, path in enumerate(sorted(set(top_level(path) for path in set(files) | dirs))):
+            # spread the top-level entries over the sources
+            source = self.sources[idx % len(self.sources)]
+            for directory in sorted(dirs):
+                if top_level(directory) == path:
+                    os.makedirs(os.path.join(source, directory.lstrip('/')), exist_ok=True)
+            for file, size in files.items():
+                if top_level(file) == path:
+                    real_path = os.path.join(source, file.lstrip('/'))
+                    os.makedirs(os.path.dirname(real_path), exist_ok=True)
+                    with open(real_path, 'wb') as f:
+                        f.truncate(size)
+
+    def replay(self, original_timing=False):
+        cfs = Filesystem(self.sources, '/', **self.options)
+        mismatches = 0
+        started = time.perf_counter_ns()
+        for record in self.records:
+            if original_timing:
+                delay = record.timestamp - (time.perf_counter_ns() - started)
+                if delay > 0:
+                    time.sleep(delay / 1e9)
+            if self._execute(cfs, record) != record.errno:
+                mismatches += 1
+        elapsed = (time.perf_counter_ns() - started) / 1e9
+        cfs.destroy('/')
+
+        recorded = sum(record.latency for record in self.records) / 1e9
+        stats = cfs.stats()
+        return {
+            'ops': len(self.records),
+            'seconds': elapsed,
+            'ops_per_s': len(self.records) / elapsed if elapsed else 0,
+            'recorded_op_seconds': recorded,
+            'replayed_op_seconds': sum(op['total_ms'] for op in stats['ops'].values()) / 1e3,
+            'errno_mismatches': mismatches,
+            'ops_detail': stats['ops'],
+        }
+
+    def _execute(self, cfs, record):
+        try:
+            result = cfs(record.op, *self._arguments(record))
+            if record.op in ('open', 'create'):
+                self._fhs[record.fh] = result
+            elif record.op == 'release':
+                self._fhs.pop(record.fh, None)
+            return 0
+        except OSError as e:
+            return e.errno
+
+    def _arguments(self, record):
+        fh = self._fhs.get(record.fh, record.fh) if record.fh else None
+        op = record.op
+        if op == 'read':
+            return record.path, record.a, record.b, fh
+        if op == 'write':
+            return record.path, b'\0' * record.a, record.b, fh
+        if op == 'open':
+            # never replay O_CREAT | O_EXCL races against the prepared namespace
+            return record.path, record.a & ~os.O_EXCL
+        if op in ('create', 'mkdir', 'chmod', 'access'):
+            return record.path, record.a
+        if op in ('mknod', 'chown'):
+            return record.path, record.a, record.b
+        if op == 'truncate':
+            return record.path, record.a, fh
+        if op == 'fsync':
+            return record.path, record.a, fh
+        if op in ('flush', 'release', 'getattr', 'readdir'):
+            return record.path, fh
+        if op in ('rename', 'link', 'symlink'):
+            return record.path, record.path2
+        return (record.path,)
+
+
+def top_level(path):
+    return '/' + path.strip('/').split('/')[0]
+
+
+def initial_namespace(records):
+    '''({file: size}, {dir}) of the paths a trace used without creating them first'''
+    files = {}
+    dirs = set()
+    created = set()
+    for record in records:
+        paths = [record.path] + ([record.path2] if record.op in ('rename', 'link') else [])
+        for path in paths:
+            if not path or path == '/':
+                continue
+            parent = os.path.dirname(path)
+            while parent != '/' and parent not in created:
+                dirs.add(parent)
+                parent = os.path.dirname(parent)
+        if record.op in CREATING_OPS:
+            created.add(record.path)
+            continue
+        if record.path in created or record.errno or record.path == '/':
+            continue
+        if record.op in ('readdir', 'rmdir'):
+            dirs.add(record.path)
+        elif record.op in ('read', 'write'):
+            files[record.path] = max(files.get(record.path, 0), record.a + record.b)
+        elif record.op in ('open', 'unlink', 'truncate') or (record.op == 'rename' and record.path not in dirs):
+            files.setdefault(record.path, 0)
+    for directory in dirs:
+        files.pop(directory, None)
+    return files, dirs
+
+
+def main(trace, source_count, options, original_timing, output):
+    records = read_trace(trace)
+    scratch = tempfile.mkdtemp(prefix='cinchfs-replay-')
+    try:
+        sources = [os.path.join(scratch, f"disk{idx}") for idx in range(source_count)]
+        for source in sources:
+            os.mkdir(source)
+        replayer = Replayer(records, sources, split_mount_options(parse_mount_options(options)))
+        replayer.prepare()
+        result = replayer.replay(original_timing)
+    finally:
+        shutil.rmtree(scratch)
+
+    report = json.dumps(result, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a cinchfs trace')
+    parser.add_argument('trace', action="store")
+    parser.add_argument('--sources', type=int, default=4, help="Number of scratch sources to replay onto")
+    parser.add_argument('-o', action="store", dest="options", help="cinchfs mount options to build the Filesystem with")
+    parser.add_argument('--original-timing', action='store_true', help="Keep the recorded gaps between ops instead of replaying as fast as possible")
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    main(args.trace, args.sources, args.options, args.original_timing, args.output)
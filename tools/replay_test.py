@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import os
+from cinchfs import Filesystem
+from tools.replay import Replayer, initial_namespace
+from tracing import TraceRecord, read_trace
+
+
+def record(op, path, a=0, b=0, fh=0, errno=0, path2=''):
+    return TraceRecord(0, 1000, op, errno, a, b, fh, path, path2)
+
+
+class TestReplay(object):
+
+    def test_initial_namespace_skips_created_paths(self):
+        files, dirs = initial_namespace([
+            record("read", "/dir/old", 100, 50, 1),
+            record("create", "/dir/new", 0o644, fh=2),
+            record("write", "/dir/new", 10, 0, 2),
+            record("readdir", "/other"),
+            record("getattr", "/missing", errno=2),
+        ])
+        assert files == {"/dir/old": 150}
+        assert dirs == {"/dir", "/other"}
+
+    def test_replays_a_recorded_trace(self, tmp_path):
+        recorded = tmp_path / "recorded"
+        recorded.mkdir()
+        (recorded / "existing").write_bytes(b"a" * 100)
+        trace = str(tmp_path / "trace")
+        cfs = Filesystem([str(recorded)], "/cfsroot", trace=trace)
+        fh = cfs("open", "/existing", os.O_RDONLY)
+        cfs("read", "/existing", 50, 25, fh)
+        cfs("release", "/existing", fh)
+        fh = cfs("create", "/new", 0o644)
+        cfs("write", "/new", b"b" * 10, 0, fh)
+        cfs("release", "/new", fh)
+        cfs.destroy("/")
+
+        sources = [str(tmp_path / "disk0"), str(tmp_path / "disk1")]
+        for source in sources:
+            os.mkdir(source)
+        replayer = Replayer(read_trace(trace), sources)
+        replayer.prepare()
+        result = replayer.replay()
+        assert result["ops"] == 6
+        assert result["errno_mismatches"] == 0
+        assert result["ops_detail"]["read"]["bytes"] == 50
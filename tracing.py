@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import struct
+import threading
+
+from collections import namedtuple
+
+MAGIC = b'CFST\x01'
+
+# timestamp ns, latency ns, op, errno, a, b, fh, path length, second path length
+RECORD = struct.Struct('<QQBHqqQHH')
+
+OPS = ['access', 'chmod', 'chown', 'create', 'flush', 'fsync', 'getattr', 'link', 'mkdir', 'mknod',
+       'open', 'read', 'readdir', 'readlink', 'release', 'rename', 'rmdir', 'statfs', 'symlink',
+       'truncate', 'unlink', 'utimens', 'write']
+OP_IDS = dict((op, idx) for idx, op in enumerate(OPS))
+
+TraceRecord = namedtuple('TraceRecord', 'timestamp latency op errno a b fh path path2')
+
+
+def _numbers(op, args, result):
+    '''(a, b, fh) of an op, the numeric arguments that matter for replaying it'''
+    if op == 'read':
+        return args[1], args[2], args[3]
+    if op == 'write':
+        return len(args[1]), args[2], args[3]
+    if op in ('open', 'create'):
+        return args[1], 0, result or 0
+    if op == 'truncate':
+        return args[1], 0, args[2] if len(args) > 2 and args[2] else 0
+    if op == 'fsync':
+        return args[1], 0, args[2]
+    if op in ('flush', 'release'):
+        return 0, 0, args[1]
+    if op in ('getattr', 'readdir'):
+        return 0, 0, args[1] if len(args) > 1 and args[1] else 0
+    if op in ('mkdir', 'chmod', 'access'):
+        return args[1], 0, 0
+    if op in ('mknod', 'chown'):
+        return args[1], args[2], 0
+    return 0, 0, 0
+
+
+class TraceWriter():
+    '''Appends a compact binary record per op to a trace file, without any file contents'''
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._lock = threading.Lock()
+        self._started = None
+
+    def record(self, op, args, result, start_ns, latency_ns, errno=0):
+        op_id = OP_IDS.get(op)
+        if op_id is None:
+            return
+        a, b, fh = _numbers(op, args, result)
+        path = (args[0] or '').encode()
+        path2 = args[1].encode() if op in ('rename', 'link', 'symlink') else b''
+        with self._lock:
+            if self._started is None:
+                self._started = start_ns
+            self._file.write(RECORD.pack(start_ns - self._started, latency_ns, op_id, errno, a, b, fh, len(path), len(path2)))
+            self._file.write(path)
+            self._file.write(path2)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_trace(path):
+    '''Yield the TraceRecords of a trace file in the order they were written'''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a cinchfs trace")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, latency, op_id, errno, a, b, fh, path_length, path2_length = RECORD.unpack(header)
+            path = f.read(path_length).decode()
+            path2 = f.read(path2_length).decode()
+            yield TraceRecord(timestamp, latency, OPS[op_id], errno, a, b, fh, path, path2)
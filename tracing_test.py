@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+import os
+import pytest
+from cinchfs import Filesystem
+from tracing import read_trace
+
+
+class TestTracing(object):
+
+    def test_ops_are_recorded_without_payload(self, tmp_path):
+        source = tmp_path / "disk0"
+        source.mkdir()
+        trace = str(tmp_path / "trace")
+        cfs = Filesystem([str(source)], "/cfsroot", trace=trace)
+        fh = cfs("create", "/test", 0o644)
+        cfs("write", "/test", b"secret", 3, fh)
+        cfs("release", "/test", fh)
+        cfs("rename", "/test", "/renamed")
+        with pytest.raises(OSError):
+            cfs("getattr", "/missing")
+        cfs.destroy("/")
+
+        records = list(read_trace(trace))
+        assert [record.op for record in records] == ["create", "write", "release", "rename", "getattr"]
+        assert (records[1].a, records[1].b, records[1].fh) == (6, 3, fh)
+        assert records[3].path2 == "/renamed"
+        assert records[4].errno == 2
+        assert b"secret" not in open(trace, "rb").read()
+
+    def test_not_a_trace(self, tmp_path):
+        path = tmp_path / "junk"
+        path.write_bytes(b"junk")
+        with pytest.raises(ValueError):
+            list(read_trace(str(path)))
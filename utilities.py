@@ -1,4 +1,7 @@
 #!/usr/bin/env python3
+
+import time
+import threading
  
 def first(iterable, default=None, key=None):
     if key is None:
@@ -10,3 +13,22 @@ def first(iterable, default=None, key=None):
             if key(el) is not None:
                 return el
     return default
+
+
+class Throttle():
+    '''Paces copies on one disk to at most rate bytes per second, None is unlimited'''
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self, nbytes):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + nbytes / self.rate
+        if start > now:
+            time.sleep(start - now)
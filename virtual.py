@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import os
+import stat
+import time
+import errno
+import itertools
+
+from fuse import FuseOSError
+
+VIRTUAL_ROOT = '/.cinchfs'
+
+
+class VirtualFiles():
+    '''The /.cinchfs namespace: files generated in memory that never touch the sources.
+
+    Every file is rendered when it is opened, so a reader sees one consistent
+    snapshot no matter how many reads it takes. Control files are the only
+    writable ones, every line written to them is handed to their handler.'''
+
+    def __init__(self):
+        self._files = {}
+        self._controls = {}
+        self._open = {}
+        self._numbers = itertools.count(1)
+        self._mounted_at = time.time()
+
+    def __call__(self, op, *args):
+        if op not in ('getattr', 'access', 'open', 'read', 'write', 'truncate', 'flush', 'release', 'readdir', 'statfs'):
+            raise FuseOSError(errno.EROFS)
+        return getattr(self, op)(*args)
+
+    def register(self, name, render):
+        '''render() returns the current contents of /.cinchfs/<name> as bytes'''
+        self._files[name] = render
+
+    def register_control(self, name, handle):
+        '''handle(line) is called for every line written to /.cinchfs/<name>, raising OSError rejects the write'''
+        self._controls[name] = handle
+
+    def owns(self, path):
+        # path is None for ops on already open files when FUSE leaves it out
+        return path is not None and (path == VIRTUAL_ROOT or path.startswith(VIRTUAL_ROOT + '/'))
+
+    def getattr(self, path, fh=None):
+        if path == VIRTUAL_ROOT:
+            return self._attrs(stat.S_IFDIR | 0o555, 0, nlink=2)
+        if self._control(path) is not None:
+            return self._attrs(stat.S_IFREG | 0o200, 0)
+        render = self._render_function(path)
+        return self._attrs(stat.S_IFREG | 0o444, len(render()))
+
+    def access(self, path, mode):
+        if mode & os.W_OK and self._control(path) is None:
+            raise FuseOSError(errno.EACCES)
+        self.getattr(path)
+
+    def open(self, path, flags):
+        if self._control(path) is not None:
+            fh = next(self._numbers)
+            self._open[fh] = bytearray()
+            return fh
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise FuseOSError(errno.EACCES)
+        contents = self._render_function(path)()
+        fh = next(self._numbers)
+        self._open[fh] = contents
+        return fh
+
+    def read(self, path, length, offset, fh):
+        if self._control(path) is not None:
+            return b''
+        contents = self._open.get(fh)
+        if contents is None:
+            contents = self._render_function(path)()
+        return contents[offset:offset + length]
+
+    def write(self, path, buf, offset, fh):
+        pending = self._open.get(fh)
+        handle = self._control(path)
+        if handle is None or pending is None:
+            raise FuseOSError(errno.EBADF)
+        pending += buf
+        while b'\n' in pending:
+            line, _, rest = bytes(pending).partition(b'\n')
+            pending[:] = rest
+            self._handle_line(handle, line)
+        return len(buf)
+
+    def truncate(self, path, length, fh=None):
+        # opening a control file with O_TRUNC
+        if self._control(path) is None:
+            raise FuseOSError(errno.EROFS)
+        return 0
+
+    def flush(self, path, fh):
+        # a last line without a newline
+        pending = self._open.get(fh)
+        handle = self._control(path)
+        if handle is not None and pending:
+            line = bytes(pending)
+            pending.clear()
+            self._handle_line(handle, line)
+
+    def release(self, path, fh):
+        self._open.pop(fh, None)
+
+    def readdir(self, path, fh):
+        if path != VIRTUAL_ROOT:
+            raise FuseOSError(errno.ENOTDIR)
+        return ['.', '..'] + sorted(list(self._files) + list(self._controls))
+
+    def statfs(self, path):
+        return {}
+
+    def _control(self, path):
+        return self._controls.get(path[len(VIRTUAL_ROOT) + 1:])
+
+    def _handle_line(self, handle, line):
+        line = line.decode(errors='replace').strip()
+        if line:
+            handle(line)
+
+    def _render_function(self, path):
+        render = self._files.get(path[len(VIRTUAL_ROOT) + 1:])
+        if render is None:
+            raise FuseOSError(errno.ENOENT)
+        return render
+
+    def _attrs(self, mode, size, nlink=1):
+        return {
+            'st_mode': mode, 'st_nlink': nlink, 'st_size': size, 'st_uid': os.getuid(), 'st_gid': os.getgid(),
+            'st_atime': self._mounted_at, 'st_mtime': time.time(), 'st_ctime': self._mounted_at, 'st_blocks': 0,
+        }
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import threading
+
+# a buffer is written out once it holds this much, and larger writes are not buffered at all
+WRITEBACK_CHUNK = 1024 * 1024
+
+
+class _Buffer():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.offset = 0
+        self.data = bytearray()
+        # a failure to write out on behalf of another op, raised to the handle's own next op
+        self.error = None
+
+
+class WriteBuffers():
+    '''Merges small sequential writes on a handle into large ones.
+
+    write(handle, data, offset) does the actual writing. Buffered data is
+    written out once the handle writes somewhere else, once its buffer is
+    full and whenever flush() is called for it. Everything buffered across
+    all handles is kept below capacity bytes, writes that don't fit go
+    straight through. A failure to write out buffered data is raised by the
+    next write or flush of its handle, also when flush_path() or
+    flush_tree() wrote it out for another op.'''
+
+    def __init__(self, capacity, write, chunk=WRITEBACK_CHUNK):
+        self.capacity = capacity
+        self.chunk = chunk
+        self._write = write
+        self._buffers = {}
+        self._buffered = 0
+        self._lock = threading.Lock()
+
+    def write(self, handle, buf, offset):
+        if len(buf) >= self.chunk:
+            self.flush(handle)
+            return self._write(handle, buf, offset)
+        buffer = self._buffer(handle)
+        with buffer.lock:
+            self._raise_error(buffer)
+            if buffer.data and buffer.offset + len(buffer.data) != offset:
+                self._write_out(handle, buffer)
+            if not self._reserve(len(buf)):
+                self._write_out(handle, buffer)
+                return self._write(handle, buf, offset)
+            if not buffer.data:
+                buffer.offset = offset
+            buffer.data += buf
+            if len(buffer.data) >= self.chunk:
+                self._write_out(handle, buffer)
+        return len(buf)
+
+    def flush(self, handle):
+        '''Write out what is buffered for handle'''
+        buffer = self._buffers.get(handle)
+        if buffer is None:
+            return
+        with buffer.lock:
+            self._raise_error(buffer)
+            self._write_out(handle, buffer)
+
+    def flush_path(self, path):
+        '''Write out what is buffered for every handle on path'''
+        self._flush_matching(lambda handle: handle.path == path)
+
+    def flush_tree(self, path):
+        '''Write out what is buffered for handles on path or below it'''
+        prefix = path.rstrip('/') + '/'
+        self._flush_matching(lambda handle: handle.path == path or handle.path.startswith(prefix))
+
+    def release(self, handle):
+        '''Write out what is buffered for handle and forget it'''
+        try:
+            self.flush(handle)
+        finally:
+            with self._lock:
+                self._buffers.pop(handle, None)
+
+    def buffered(self):
+        return self._buffered
+
+    def _flush_matching(self, matches):
+        if not self._buffers:
+            return
+        with self._lock:
+            handles = [handle for handle in self._buffers if matches(handle)]
+        for handle in handles:
+            buffer = self._buffers.get(handle)
+            if buffer is None:
+                continue
+            with buffer.lock:
+                try:
+                    self._write_out(handle, buffer)
+                except OSError as e:
+                    # the op flushing is not the one that wrote the data
+                    buffer.error = buffer.error or e
+
+    def _buffer(self, handle):
+        buffer = self._buffers.get(handle)
+        if buffer is None:
+            with self._lock:
+                buffer = self._buffers.setdefault(handle, _Buffer())
+        return buffer
+
+    def _reserve(self, nbytes):
+        with self._lock:
+            if self._buffered + nbytes > self.capacity:
+                return False
+            self._buffered += nbytes
+            return True
+
+    def _raise_error(self, buffer):
+        error, buffer.error = buffer.error, None
+        if error is not None:
+            raise error
+
+    def _write_out(self, handle, buffer):
+        # called with buffer.lock held, the data is dropped even if writing it fails
+        if not buffer.data:
+            return
+        data, offset = bytes(buffer.data), buffer.offset
+        buffer.data.clear()
+        with self._lock:
+            self._buffered -= len(data)
+        written = 0
+        while written < len(data):
+            written += self._write(handle, data[written:], offset + written)
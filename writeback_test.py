@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import errno
+import pytest
+from writeback import WriteBuffers
+
+
+class Handle(object):
+
+    def __init__(self, path):
+        self.path = path
+
+
+class Disk(object):
+
+    def __init__(self):
+        self.writes = []
+        self.fail = False
+
+    def write(self, handle, buf, offset):
+        if self.fail:
+            raise OSError(errno.ENOSPC, "full")
+        self.writes.append((handle.path, bytes(buf), offset))
+        return len(buf)
+
+
+class TestWriteBuffers(object):
+
+    def test_sequential_writes_are_merged(self):
+        disk = Disk()
+        buffers = WriteBuffers(1 << 20, disk.write, chunk=16)
+        handle = Handle("/test")
+        for i in range(3):
+            assert buffers.write(handle, b"abcd", i * 4) == 4
+        assert disk.writes == []
+        assert buffers.buffered() == 12
+        buffers.flush(handle)
+        assert disk.writes == [("/test", b"abcdabcdabcd", 0)]
+        assert buffers.buffered() == 0
+
+    def test_full_buffer_is_written_out(self):
+        disk = Disk()
+        buffers = WriteBuffers(1 << 20, disk.write, chunk=8)
+        handle = Handle("/test")
+        buffers.write(handle, b"abcd", 0)
+        buffers.write(handle, b"efgh", 4)
+        assert disk.writes == [("/test", b"abcdefgh", 0)]
+
+    def test_large_writes_go_straight_through(self):
+        disk = Disk()
+        buffers = WriteBuffers(1 << 20, disk.write, chunk=8)
+        handle = Handle("/test")
+        buffers.write(handle, b"ab", 0)
+        buffers.write(handle, b"cdefghij", 2)
+        assert disk.writes == [("/test", b"ab", 0), ("/test", b"cdefghij", 2)]
+
+    def test_non_contiguous_write_writes_out_first(self):
+        disk = Disk()
+        buffers = WriteBuffers(1 << 20, disk.write, chunk=16)
+        handle = Handle("/test")
+        buffers.write(handle, b"ab", 0)
+        buffers.write(handle, b"cd", 10)
+        assert disk.writes == [("/test", b"ab", 0)]
+        buffers.release(handle)
+        assert disk.writes[-1] == ("/test", b"cd", 10)
+
+    def test_capacity_is_shared_by_all_handles(self):
+        disk = Disk()
+        buffers = WriteBuffers(6, disk.write, chunk=16)
+        first = Handle("/first")
+        second = Handle("/second")
+        buffers.write(first, b"abcd", 0)
+        buffers.write(second, b"efgh", 0)
+        assert disk.writes == [("/second", b"efgh", 0)]
+        assert buffers.buffered() == 4
+
+    def test_flush_tree(self):
+        disk = Disk()
+        buffers = WriteBuffers(1 << 20, disk.write, chunk=16)
+        inside = Handle("/dir/test")
+        outside = Handle("/dirt")
+        buffers.write(inside, b"a", 0)
+        buffers.write(outside, b"b", 0)
+        buffers.flush_tree("/dir")
+        assert disk.writes == [("/dir/test", b"a", 0)]
+
+    def test_failed_write_out_is_raised_once(self):
+        disk = Disk()
+        buffers = WriteBuffers(1 << 20, disk.write, chunk=16)
+        handle = Handle("/test")
+        buffers.write(handle, b"ab", 0)
+        disk.fail = True
+        with pytest.raises(OSError):
+            buffers.flush(handle)
+        assert buffers.buffered() == 0
+        buffers.flush(handle)
+
+    def test_failed_write_out_for_another_op_goes_to_the_handle(self):
+        disk = Disk()
+        buffers = WriteBuffers(1 << 20, disk.write, chunk=16)
+        handle = Handle("/test")
+        buffers.write(handle, b"ab", 0)
+        disk.fail = True
+        buffers.flush_path("/test")
+        disk.fail = False
+        with pytest.raises(OSError) as e:
+            buffers.write(handle, b"cd", 2)
+        assert e.value.errno == errno.ENOSPC
+        buffers.write(handle, b"cd", 2)
+        buffers.flush(handle)
+        assert disk.writes == [("/test", b"cd", 2)]
+
+    def test_failed_write_out_for_another_op_is_raised_by_flush(self):
+        disk = Disk()
+        buffers = WriteBuffers(1 << 20, disk.write, chunk=16)
+        handle = Handle("/dir/test")
+        buffers.write(handle, b"ab", 0)
+        disk.fail = True
+        buffers.flush_tree("/dir")
+        with pytest.raises(OSError):
+            buffers.flush(handle)
+        buffers.flush(handle)